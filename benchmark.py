@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 16:20:11 2026
+
+@author: anwar
+'''
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+import mock_fhir_server
+from generate_dataset import Dataset_Generator
+
+#----------------------------------------------------------------------------
+def benchmark_request_json(row):
+  # the JSON a clinic system posts to collect_from_request, dates already in FHIR format
+  request_json = dict()
+  for column, value in row.items():
+    if value is None:
+      value = ''
+    elif isinstance(value, datetime):
+      value = value.strftime('%Y-%m-%dT%H:%M:%S+07:00')
+
+    request_json[column] = value
+
+  return request_json
+
+
+#============================================================================
+class Benchmark_Request:
+  # the part of flask.Request that collect_from_request uses
+
+#----------------------------------------------------------------------------
+  def __init__(self, request_json):
+    self.request_json = request_json
+
+#----------------------------------------------------------------------------
+  def get_json(self, silent=False):
+    return self.request_json
+
+
+#----------------------------------------------------------------------------
+def mock_request(mock_url, path, method='GET'):
+  request = urllib.request.Request(f'{mock_url}{path}', method=method, data=b'' if method == 'POST' else None)
+  with urllib.request.urlopen(request) as response:
+    return json.loads(response.read() or b'{}')
+
+#----------------------------------------------------------------------------
+def run_scenario(scenario, rows, mock_url, input_path, result_queue, metrics_filename=''):
+  # runs in its own process so peak RSS and import/cache state belong to this scenario only
+  import epus_kunjungan
+  from epus_kunjungan import FHIR_Base, epus_Kunjungan
+  from epus_metrics import metrics
+
+  FHIR_Base.FHIR_BASE_URL = f'{mock_url}/fhir/'
+  FHIR_Base.KEYCLOAK_URL  = mock_url
+  FHIR_Base.REALM_NAME    = 'benchmark'
+  FHIR_Base.CLIENT_ID     = 'benchmark'
+  FHIR_Base.CLIENT_SECRET = 'benchmark'
+
+  kunjungan = epus_Kunjungan()
+  kunjungan.token_filename = os.path.join(tempfile.mkdtemp(), 'token-benchmark.key')
+  kunjungan.testing = False
+  kunjungan.debug   = False
+
+  latencies = []
+  errors    = 0
+  started   = time.perf_counter()
+  with contextlib.redirect_stdout(io.StringIO()) as output:
+    if scenario == 'csv':
+      data_list = kunjungan.iter_csv_data('', input_path, rows)
+    elif scenario == 'excel':
+      data_list = kunjungan.iter_excel_data('', input_path, rows)
+    else:
+      data_list = (kunjungan.request_json_to_data(Benchmark_Request(benchmark_request_json(row)).get_json(silent=True)) for row in Dataset_Generator(rows).iter_rows())
+
+    for data in data_list:
+      visit_start = time.perf_counter()
+      try:
+        kunjungan.json_to_fhir(data)
+      except Exception:
+        errors += 1
+
+      latencies.append(time.perf_counter() - visit_start)
+      output.seek(0)
+      output.truncate()
+
+  elapsed = time.perf_counter() - started
+  if metrics_filename:
+    metrics.dump(metrics_filename)
+
+  result_queue.put({
+    'elapsed': elapsed,
+    'latencies': latencies,
+    'errors': errors,
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  })
+
+#----------------------------------------------------------------------------
+def percentile(values, fraction):
+  if not values: return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+#----------------------------------------------------------------------------
+def benchmark(scenario, rows, mock_url, input_path='', metrics_filename=''):
+  mock_request(mock_url, '/_mock/reset', 'POST')
+
+  result_queue = multiprocessing.Queue()
+  process = multiprocessing.Process(target=run_scenario, args=(scenario, rows, mock_url, input_path, result_queue, metrics_filename))
+  process.start()
+  result = result_queue.get()
+  process.join()
+
+  stats  = mock_request(mock_url, '/_mock/stats')
+  visits = len(result['latencies'])
+  return {
+    'scenario': scenario,
+    'rows': visits,
+    'seconds': round(result['elapsed'], 3),
+    'rows_per_sec': round(visits / result['elapsed'], 1) if result['elapsed'] else 0.0,
+    'requests': stats['requests'],
+    'requests_per_visit': round(stats['requests'] / visits, 2) if visits else 0.0,
+    'bytes_sent_per_visit': round(stats['bytes_received'] / visits) if visits else 0,
+    'p50_ms': round(percentile(result['latencies'], 0.50) * 1000, 2),
+    'p99_ms': round(percentile(result['latencies'], 0.99) * 1000, 2),
+    'errors': result['errors'],
+    'peak_rss_mb': round(result['peak_rss_mb'], 1),
+    'requests_by_type': stats['by_type'],
+    'responses_by_status': stats['by_status']
+  }
+
+
+#===========================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='throughput benchmark of epus_Kunjungan against a local mock FHIR server')
+  parser.add_argument('--rows', default='100,1000', help='comma separated row counts')
+  parser.add_argument('--scenarios', default='csv,excel,request', help='csv, excel, request')
+  parser.add_argument('--latency', type=float, default=0.005)
+  parser.add_argument('--jitter', type=float, default=0.0)
+  parser.add_argument('--error-rate', type=float, default=0.0)
+  parser.add_argument('--unauthorized-rate', type=float, default=0.0)
+  parser.add_argument('--output', default='', help='append the JSON report to this file')
+  parser.add_argument('--metrics-dir', default='', help='write the per-stage metrics of each run here as <scenario>_<rows>.prom')
+  args = parser.parse_args()
+
+  mock_server = mock_fhir_server.start_mock_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, unauthorized_rate=args.unauthorized_rate)
+  mock_url    = f'http://127.0.0.1:{mock_server.server_address[1]}'
+  work_dir    = tempfile.mkdtemp(prefix='epus-benchmark-')
+
+  report = []
+  print('scenario     rows   rows/s  req/visit   p50 ms   p99 ms  errors  peak MB')
+  for scenario in args.scenarios.split(','):
+    for rows in [int(rows) for rows in args.rows.split(',')]:
+      input_path = ''
+      if scenario == 'csv':
+        input_path = os.path.join(work_dir, f'benchmark_{rows}.csv')
+        Dataset_Generator(rows).write_csv(input_path)
+      elif scenario == 'excel':
+        input_path = os.path.join(work_dir, f'benchmark_{rows}.xlsx')
+        Dataset_Generator(rows).write_excel(input_path)
+
+      metrics_filename = os.path.join(args.metrics_dir, f'{scenario}_{rows}.prom') if args.metrics_dir else ''
+      result = benchmark(scenario, rows, mock_url, input_path, metrics_filename)
+      report.append(result)
+      print(f'{scenario:<10} {result["rows"]:>6} {result["rows_per_sec"]:>8} {result["requests_per_visit"]:>10} {result["p50_ms"]:>8} {result["p99_ms"]:>8} {result["errors"]:>7} {result["peak_rss_mb"]:>8}')
+
+  if args.output:
+    with open(args.output, 'a') as fout:
+      fout.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'latency': args.latency, 'error_rate': args.error_rate, 'unauthorized_rate': args.unauthorized_rate, 'results': report}) + '\n')
+
+  mock_server.shutdown()
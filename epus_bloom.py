@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 22:31:18 2026
+
+@author: anwar
+'''
+
+import hashlib
+import json
+import math
+import threading
+
+from epus_metrics import metrics
+from epus_logging import get_logger, setup_logging
+
+log_bloom = get_logger('bloom')
+
+#============================================================================
+class epus_Bloom_Filter:
+
+#----------------------------------------------------------------------------
+  def __init__(self, capacity=1000000, error_rate=0.01):
+    # the optimal size for capacity keys at error_rate false positives
+    self.size   = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, round(self.size / capacity * math.log(2)))
+    self.bits   = bytearray((self.size + 7) // 8)
+    self.count  = 0
+    self.lock   = threading.Lock()
+
+#----------------------------------------------------------------------------
+  def positions(self, key):
+    # double hashing, h1 + i * h2, from one 128 bit digest
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    h1     = int.from_bytes(digest[:8], 'little')
+    h2     = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + no * h2) % self.size for no in range(self.hashes)]
+
+#----------------------------------------------------------------------------
+  def add(self, key):
+    # count is the keys that set a bit, a key already in the filter adds nothing
+    positions = self.positions(key)
+    with self.lock:
+      changed = False
+      for position in positions:
+        mask = 1 << (position & 7)
+        if not self.bits[position >> 3] & mask:
+          self.bits[position >> 3] |= mask
+          changed = True
+
+      if changed: self.count += 1
+
+#----------------------------------------------------------------------------
+  def __contains__(self, key):
+    bits = self.bits
+    return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+#----------------------------------------------------------------------------
+  def estimated_false_positive_rate(self):
+    return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+#----------------------------------------------------------------------------
+  def save(self, filename):
+    with open(filename, 'wb') as fout:
+      fout.write(json.dumps({'size': self.size, 'hashes': self.hashes, 'count': self.count}).encode('utf-8') + b'\n')
+      fout.write(self.bits)
+
+#----------------------------------------------------------------------------
+  def load(self, filename):
+    with open(filename, 'rb') as fin:
+      header = json.loads(fin.readline())
+      bits   = bytearray(fin.read())
+
+    with self.lock:
+      self.size   = header['size']
+      self.hashes = header['hashes']
+      self.count  = header['count']
+      self.bits   = bits
+
+
+#============================================================================
+class epus_Identifier_Index:
+  # identifiers known to exist on the server; a lookup for one the index never saw
+  # is answered empty without a request. It only knows what the export and our own
+  # transactions showed it, build it right before the run
+  index_types = ('Encounter', 'Observation', 'Condition', 'AllergyIntolerance')
+
+#----------------------------------------------------------------------------
+  def __init__(self, capacity=1000000, error_rate=0.01, resource_types=None):
+    self.bloom_filter   = epus_Bloom_Filter(capacity, error_rate)
+    self.resource_types = tuple(resource_types or self.index_types)
+
+#----------------------------------------------------------------------------
+  def key(self, resource_type, identifier):
+    return f'{resource_type}|{identifier}'
+
+#----------------------------------------------------------------------------
+  def add(self, resource_type, identifier):
+    self.bloom_filter.add(self.key(resource_type, identifier))
+
+#----------------------------------------------------------------------------
+  def add_resource(self, resource):
+    # searchable as identifier=<value> and identifier=<system>|<value>
+    resource_type = resource.get('resourceType', '')
+    if resource_type not in self.resource_types: return
+
+    for identifier in resource.get('identifier', []):
+      self.add(resource_type, identifier.get('value'))
+      self.add(resource_type, f'{identifier.get("system")}|{identifier.get("value")}')
+
+#----------------------------------------------------------------------------
+  def add_transaction(self, entries, response_json):
+    for entry, response_entry in zip(entries, response_json.get('entry', [])):
+      if not response_entry.get('response', {}).get('status', '').startswith(('200', '201')): continue
+
+      resource_type, _, identifier = entry.get('request', {}).get('url', '').partition('?identifier=')
+      if resource_type in self.resource_types and identifier:
+        self.add(resource_type, identifier)
+
+      self.add_resource(entry.get('resource', {}))
+
+#----------------------------------------------------------------------------
+  def might_exist(self, resource_type, identifier):
+    if resource_type not in self.resource_types: return True
+
+    exists = self.key(resource_type, identifier) in self.bloom_filter
+    metrics.inc('epus_bloom_lookups_total', type=resource_type, result='maybe' if exists else 'skipped')
+    return exists
+
+#----------------------------------------------------------------------------
+  def observe(self, resource_type, found):
+    # a 'maybe' the server answered empty is a false positive
+    if resource_type not in self.resource_types: return
+    metrics.inc('epus_bloom_answers_total', type=resource_type, result='found' if found else 'false_positive')
+
+#----------------------------------------------------------------------------
+  def export(self, client, page_size=1000):
+    # identifier-only paged search of every indexed type, following the next links
+    for resource_type in self.resource_types:
+      url    = client.base_url + resource_type
+      params = {'_elements': 'identifier', '_count': page_size}
+      count  = 0
+      while url:
+        response = client.send_request('GET', url, params=params)
+        if response.status_code != 200:
+          raise Exception(f'Error: {response.status_code} - {response.text}')
+
+        bundle_json = response.json()
+        for entry in bundle_json.get('entry', []):
+          self.add_resource(dict(entry.get('resource', {}), resourceType=resource_type))
+          count += 1
+
+        url    = next((link.get('url', '') for link in bundle_json.get('link', []) if link.get('relation') == 'next'), '')
+        params = None
+        if url and '://' not in url: url = client.base_url + url
+
+      log_bloom.info('%s identifiers of %s exported', count, resource_type)
+
+    self.report()
+
+#----------------------------------------------------------------------------
+  def report(self):
+    rate = self.bloom_filter.estimated_false_positive_rate()
+    metrics.gauge('epus_bloom_estimated_false_positive_rate', rate)
+    metrics.gauge('epus_bloom_keys', self.bloom_filter.count)
+    log_bloom.info('%s keys in %s KiB, estimated false positive rate %.4f', self.bloom_filter.count, len(self.bloom_filter.bits) // 1024, rate)
+
+    return rate
+
+#----------------------------------------------------------------------------
+  def save(self, filename):
+    self.bloom_filter.save(filename)
+
+#----------------------------------------------------------------------------
+  def load(self, filename):
+    self.bloom_filter.load(filename)
+    self.report()
+
+
+#===========================================================================
+if __name__ == '__main__':
+  from epus_kunjungan import epus_Kunjungan
+
+  setup_logging('INFO')
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing = False
+  epus_Kunjungan_Garut.debug   = False
+
+  epus_Index_Garut = epus_Identifier_Index(capacity=5000000)
+  epus_Index_Garut.export(epus_Kunjungan_Garut)
+  epus_Index_Garut.save('sql_dump/identifiers.bloom')
+
+  epus_Kunjungan_Garut.set_identifier_index(epus_Index_Garut)
+  epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
+  epus_Index_Garut.report()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 23:41:27 2026
+
+@author: anwar
+'''
+
+import collections
+import threading
+import time
+
+from epus_kunjungan import FHIR_Circuit_Open
+from epus_metrics import metrics
+from epus_logging import get_logger, setup_logging
+
+log_circuit = get_logger('circuit')
+
+#============================================================================
+class epus_Circuit_Breaker:
+  # one circuit per endpoint, the request type of FHIR_Base ('POST transaction', 'POST batch',
+  # 'GET search', ...). Closed while the last window calls are fine; a call fails on a network
+  # error, a 5xx, 408 or 429, or when it takes longer than latency_threshold seconds. Opens when
+  # error_threshold of them failed and refuses every call for open_seconds, then half-open lets
+  # that many probe calls through: a good one closes it, a failed one opens it again.
+  # latency_thresholds and error_thresholds override the two per endpoint, e.g.
+  # {'GET search': 2.0, 'POST transaction': 30.0}
+  states = {'closed': 0, 'half_open': 1, 'open': 2}
+
+#----------------------------------------------------------------------------
+  def __init__(self, error_threshold=0.5, latency_threshold=10.0, window=20, min_calls=5, open_seconds=30.0, probes=1, error_thresholds=None, latency_thresholds=None):
+    self.error_threshold    = error_threshold
+    self.latency_threshold  = latency_threshold
+    self.error_thresholds   = error_thresholds or dict()
+    self.latency_thresholds = latency_thresholds or dict()
+    self.window             = window
+    self.min_calls          = min_calls
+    self.open_seconds       = open_seconds
+    self.probes             = probes
+    self.lock               = threading.Lock()
+    self.circuits           = dict()
+
+#----------------------------------------------------------------------------
+  def circuit(self, endpoint):
+    circuit = self.circuits.get(endpoint)
+    if circuit is None:
+      circuit = self.circuits[endpoint] = {'state': 'closed', 'results': collections.deque(maxlen=self.window), 'opened_at': 0.0, 'probing': 0}
+
+    return circuit
+
+#----------------------------------------------------------------------------
+  def set_state(self, endpoint, circuit, state):
+    log_circuit.warning('circuit of %s %s -> %s', endpoint, circuit['state'], state)
+    circuit['state'] = state
+    circuit['results'].clear()
+    if state == 'open': circuit['opened_at'] = time.monotonic()
+
+    metrics.inc('epus_circuit_transitions_total', endpoint=endpoint, state=state)
+    metrics.gauge('epus_circuit_state', self.states[state], endpoint=endpoint)
+
+#----------------------------------------------------------------------------
+  def before(self, endpoint):
+    # raises FHIR_Circuit_Open instead of letting the call through, True when the call is a probe
+    with self.lock:
+      circuit = self.circuit(endpoint)
+      if circuit['state'] == 'open' and time.monotonic() - circuit['opened_at'] >= self.open_seconds:
+        self.set_state(endpoint, circuit, 'half_open')
+
+      if circuit['state'] == 'closed': return False
+
+      if circuit['state'] == 'half_open' and circuit['probing'] < self.probes:
+        circuit['probing'] += 1
+        return True
+
+    metrics.inc('epus_circuit_rejected_total', endpoint=endpoint)
+    raise FHIR_Circuit_Open(endpoint)
+
+#----------------------------------------------------------------------------
+  def after(self, endpoint, seconds, status=None, probe=False):
+    # status None is a call that got no answer at all
+    failed = status is None or status >= 500 or status in (408, 429) or seconds > self.latency_thresholds.get(endpoint, self.latency_threshold)
+    with self.lock:
+      circuit = self.circuit(endpoint)
+      if probe:
+        circuit['probing'] -= 1
+        if circuit['state'] == 'half_open':
+          self.set_state(endpoint, circuit, 'open' if failed else 'closed')
+
+        return
+
+      # late answers of calls that started before the circuit opened
+      if circuit['state'] != 'closed': return
+
+      circuit['results'].append(failed)
+      calls = len(circuit['results'])
+      if calls >= self.min_calls and sum(circuit['results']) >= self.error_thresholds.get(endpoint, self.error_threshold) * calls:
+        self.set_state(endpoint, circuit, 'open')
+
+#----------------------------------------------------------------------------
+  def state(self, endpoint):
+    with self.lock:
+      return self.circuit(endpoint)['state']
+
+
+#===========================================================================
+if __name__ == '__main__':
+  from epus_kunjungan import epus_Kunjungan
+  from epus_spool import epus_Spool, epus_Spool_Drain
+
+  setup_logging('INFO')
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing         = False
+  epus_Kunjungan_Garut.debug           = False
+  epus_Kunjungan_Garut.request_timeout = 15
+  epus_Kunjungan_Garut.set_circuit_breaker(epus_Circuit_Breaker(latency_threshold=5.0, open_seconds=60.0, latency_thresholds={'GET search': 2.0, 'POST transaction': 30.0}))
+
+  # posted right away, the visits that meet an open circuit wait in the spool for the drain
+  epus_Spool_Garut = epus_Spool('sql_dump/spool/')
+  epus_Kunjungan_Garut.set_spool(epus_Spool_Garut, park_only=True)
+  epus_Drain_Garut = epus_Spool_Drain(epus_Spool_Garut, epus_Kunjungan_Garut, workers=2)
+  epus_Drain_Garut.start()
+
+  epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
+  epus_Drain_Garut.stop(wait=True)
+  epus_Spool_Garut.close()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 13:40:22 2026
+
+@author: anwar
+'''
+
+import functools
+import json
+import os
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from epus_kunjungan import epus_Kunjungan
+from epus_logging import get_logger, setup_logging
+
+log_bulk = get_logger('bulk')
+
+#============================================================================
+class epus_Bulk_Import:
+  # master data repeats across visits, it is merged in memory and written once at close()
+  master_types = ['Organization', 'Location', 'Practitioner', 'Patient']
+  import_order = ['Organization', 'Location', 'Practitioner', 'Patient', 'Encounter', 'Condition', 'Observation', 'AllergyIntolerance']
+
+#----------------------------------------------------------------------------
+  def __init__(self, directory, kunjungan=None, snapshot_filename=''):
+    self.directory = directory
+    self.kunjungan = kunjungan or epus_Kunjungan()
+    self.kunjungan.set_offline('', snapshot_filename)
+    self.kunjungan.debug = False
+
+    self.files            = dict()
+    self.master_resources = dict()
+    self.counts           = dict()
+    self.unresolved       = 0
+    os.makedirs(self.directory, exist_ok=True)
+
+#----------------------------------------------------------------------------
+  def write_resource(self, resource):
+    resource_type = resource['resourceType']
+    if resource_type not in self.files:
+      self.files[resource_type] = open(os.path.join(self.directory, f'{resource_type}.ndjson'), 'w')
+
+    self.files[resource_type].write(json.dumps(resource) + '\n')
+    self.counts[resource_type] = self.counts.get(resource_type, 0) + 1
+
+#----------------------------------------------------------------------------
+  def count_unresolved(self, element):
+    if isinstance(element, dict):
+      for key, value in element.items():
+        if key == 'reference' and isinstance(value, str) and value.startswith('urn:uuid:'):
+          self.unresolved += 1
+        else:
+          self.count_unresolved(value)
+
+    elif isinstance(element, list):
+      for item in element:
+        self.count_unresolved(item)
+
+#----------------------------------------------------------------------------
+  def add_visit(self, data):
+    entries = self.kunjungan.build_bundle_entries(data)
+    self.kunjungan.assign_deterministic_ids(entries)
+
+    # the same resource can appear twice in one visit (anamnesa and diagnosis Condition),
+    # fold it the way consecutive conditional PUTs would
+    visit_resources = dict()
+    for entry in entries:
+      resource = entry['resource']
+      key      = (resource['resourceType'], resource['id'])
+      self.count_unresolved(resource)
+
+      if resource['resourceType'] in self.master_types:
+        target = self.master_resources
+      else:
+        target = visit_resources
+
+      if key in target:
+        self.kunjungan.update_fhir_json(target[key], resource)
+      else:
+        target[key] = resource
+
+    for resource in visit_resources.values():
+      self.write_resource(resource)
+
+#----------------------------------------------------------------------------
+  def collect_from_data(self, data_list):
+    for data in data_list:
+      self.add_visit(data)
+
+#----------------------------------------------------------------------------
+  def collect_from_csv(self, directory='', filename='', limit=0):
+    self.collect_from_data(self.kunjungan.iter_csv_data(directory, filename, limit))
+
+#----------------------------------------------------------------------------
+  def collect_from_excel(self, directory='', filename='', limit=0):
+    self.collect_from_data(self.kunjungan.iter_excel_data(directory, filename, limit))
+
+#----------------------------------------------------------------------------
+  def close(self):
+    for resource in self.master_resources.values():
+      self.write_resource(resource)
+
+    self.master_resources = dict()
+    for fout in self.files.values():
+      fout.close()
+
+    self.files = dict()
+    log_bulk.info('bulk files in %s: %s', self.directory, self.counts)
+    if self.unresolved:
+      log_bulk.warning('%s references point to resources that are not in the export', self.unresolved)
+
+    return [resource_type for resource_type in self.import_order if resource_type in self.counts]
+
+#----------------------------------------------------------------------------
+  def submit_import(self, input_source, resource_types):
+    # input_source is where the FHIR server can download <resource_type>.ndjson from
+    parameters = [
+      {'name': 'inputFormat', 'valueCode': 'application/fhir+ndjson'},
+      {'name': 'inputSource', 'valueUri': input_source},
+      {'name': 'storageDetail', 'part': [{'name': 'type', 'valueCode': 'https'}]}
+    ]
+
+    for resource_type in resource_types:
+      parameters.append({
+        'name': 'input',
+        'part': [
+          {'name': 'type', 'valueCode': resource_type},
+          {'name': 'url', 'valueUri': f'{input_source.rstrip("/")}/{resource_type}.ndjson'}
+        ]
+      })
+
+    parameters_json = {
+      'resourceType': 'Parameters',
+      'parameter': parameters
+    }
+
+    headers  = {'Prefer': 'respond-async', 'Content-Type': 'application/fhir+json'}
+    response = self.kunjungan.send_request('POST', f'{self.kunjungan.base_url}$import', headers=headers, data=json.dumps(parameters_json))
+
+    if response.status_code != 202:
+      raise Exception(f'Error: {response.status_code} - {response.text}')
+
+    return response.headers['Content-Location']
+
+#----------------------------------------------------------------------------
+  def poll_import(self, status_url, interval=5, timeout=0):
+    started = time.monotonic()
+    while True:
+      response = self.kunjungan.send_request('GET', status_url)
+      if response.status_code == 200:
+        log_bulk.info('success bulk import')
+        return response.json() if response.content else {}
+
+      if response.status_code != 202:
+        raise Exception(f'Error: {response.status_code} - {response.text}')
+
+      log_bulk.info('bulk import in progress %s', response.headers.get('X-Progress', ''))
+      if timeout and time.monotonic() - started > timeout:
+        raise Exception(f'Error: bulk import still running after {timeout}s - {status_url}')
+
+      time.sleep(interval)
+
+#----------------------------------------------------------------------------
+  def run_import(self, input_source, interval=5, timeout=0):
+    resource_types = self.close()
+    status_url     = self.submit_import(input_source, resource_types)
+    return self.poll_import(status_url, interval, timeout)
+
+
+#============================================================================
+def serve_directory(directory, host='0.0.0.0', port=8000):
+  # stand-in file server so a FHIR server on the network (or a test one) can fetch the NDJSON files
+  handler = functools.partial(SimpleHTTPRequestHandler, directory=directory)
+  server  = ThreadingHTTPServer((host, port), handler)
+  thread  = threading.Thread(target=server.serve_forever, name='epus-bulk-files', daemon=True)
+  thread.start()
+
+  return server
+
+
+#===========================================================================
+if __name__ == '__main__':
+  setup_logging('INFO')
+  epus_Bulk_Garut = epus_Bulk_Import('bulk/20241017/')
+  epus_Bulk_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
+
+  file_server = serve_directory('bulk/20241017/', port=8000)
+  epus_Bulk_Garut.run_import('http://127.0.0.1:8000/')
+  file_server.shutdown()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Tue Oct 20 00:12:53 2026
+
+@author: anwar
+'''
+
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from epus_kunjungan import FHIR_Base, FHIR_Error, epus_Kunjungan
+from epus_pipeline import epus_Pipeline
+from epus_metrics import metrics
+from epus_logging import get_logger, setup_logging
+
+log_dead_letter = get_logger('dead_letter')
+
+#============================================================================
+class epus_Dead_Letter:
+  # the visits that failed for good, one row per id_pendaftaran with its normalized data, the
+  # bundle when it was built, the HTTP status and OperationOutcome of the last failure;
+  # replay builds them again from data, the row stays until a replay sent it
+  # (resolved_at is set then)
+
+#----------------------------------------------------------------------------
+  def __init__(self, filename='dead_letter.sqlite'):
+    self.filename   = filename
+    self.lock       = threading.Lock()
+    self.connection = sqlite3.connect(filename, check_same_thread=False)
+    with self.lock, self.connection:
+      self.connection.execute('''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+          id_pendaftaran TEXT PRIMARY KEY, stage TEXT, status INTEGER, error TEXT, outcome TEXT,
+          data TEXT, entries TEXT, attempts INTEGER, failed_at REAL, resolved_at REAL
+        )
+      ''')
+
+#----------------------------------------------------------------------------
+  def close(self):
+    with self.lock:
+      self.connection.close()
+
+#----------------------------------------------------------------------------
+  def operation_outcome(self, error):
+    # FHIR_Error keeps the response body, the server explains a refusal in an OperationOutcome
+    try:
+      outcome = json.loads(getattr(error, 'text', '') or 'null')
+    except ValueError:
+      return None
+
+    return outcome if isinstance(outcome, dict) and outcome.get('resourceType') == 'OperationOutcome' else None
+
+#----------------------------------------------------------------------------
+  def add(self, data, entries, error, stage=''):
+    # failing again updates the row, attempts counts the failures
+    status  = getattr(error, 'status', None)
+    outcome = self.operation_outcome(error)
+    with self.lock, self.connection:
+      self.connection.execute('''
+        INSERT INTO dead_letters VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?, NULL)
+        ON CONFLICT (id_pendaftaran) DO UPDATE SET
+          stage = excluded.stage, status = excluded.status, error = excluded.error, outcome = excluded.outcome,
+          data = excluded.data, entries = excluded.entries, attempts = attempts + 1, failed_at = excluded.failed_at, resolved_at = NULL
+      ''', (str(data['id_pendaftaran']), stage, status, str(error), json.dumps(outcome) if outcome else None, json.dumps(data, default=str), json.dumps(entries, default=str) if entries is not None else None, time.time()))
+
+    metrics.inc('epus_dead_letters_total', stage=stage, status=status or '')
+    log_dead_letter.error('visit %s dead-lettered at %s: %s', data['id_pendaftaran'], stage or 'visit', error)
+
+#----------------------------------------------------------------------------
+  def resolve(self, id_pendaftaran_list):
+    with self.lock, self.connection:
+      self.connection.executemany('UPDATE dead_letters SET resolved_at = ? WHERE id_pendaftaran = ? AND resolved_at IS NULL', [(time.time(), str(id_pendaftaran)) for id_pendaftaran in id_pendaftaran_list])
+
+    metrics.inc('epus_dead_letters_resolved_total', len(id_pendaftaran_list))
+
+#----------------------------------------------------------------------------
+  def pending(self, limit=0, status=None, stage=None):
+    # the open rows oldest first, each as a dict with data, entries and outcome decoded
+    query  = 'SELECT id_pendaftaran, stage, status, error, outcome, data, entries, attempts, failed_at FROM dead_letters WHERE resolved_at IS NULL'
+    params = []
+    if status is not None:
+      query += ' AND status = ?'
+      params.append(status)
+    if stage:
+      query += ' AND stage = ?'
+      params.append(stage)
+
+    query += ' ORDER BY failed_at'
+    if limit: query += f' LIMIT {int(limit)}'
+
+    with self.lock:
+      rows = self.connection.execute(query, params).fetchall()
+
+    return [{
+      'id_pendaftaran': row[0],
+      'stage': row[1],
+      'status': row[2],
+      'error': row[3],
+      'outcome': json.loads(row[4]) if row[4] else None,
+      'data': json.loads(row[5]),
+      'entries': json.loads(row[6]) if row[6] else None,
+      'attempts': row[7],
+      'failed_at': row[8]
+    } for row in rows]
+
+#----------------------------------------------------------------------------
+  def summary(self):
+    # open rows per (stage, status)
+    with self.lock:
+      return self.connection.execute('SELECT stage, status, COUNT(*) FROM dead_letters WHERE resolved_at IS NULL GROUP BY stage, status ORDER BY 3 DESC').fetchall()
+
+#----------------------------------------------------------------------------
+  def replay(self, kunjungan, workers=4, batch_size=10, limit=0, status=None, stage=None):
+    # every open visit through a pipeline, built again with fresh reads and sent batch_size
+    # visits per transaction; sent ones are resolved, failed ones come back with attempts + 1
+    records = self.pending(limit, status, stage)
+    log_dead_letter.info('replay of %s visits', len(records))
+    if not records: return {'ok': 0, 'error': 0, 'parked': 0}
+
+    kunjungan.set_dead_letter(self)
+    pipeline = epus_Pipeline(kunjungan, workers={'prefetch': workers, 'send': workers}, batch_sizes={'prefetch': batch_size, 'send': batch_size})
+    pipeline.on_sent = lambda items: self.resolve([item['data']['id_pendaftaran'] for item in items])
+
+    return pipeline.run(record['data'] for record in records)
+
+
+#----------------------------------------------------------------------------
+def replay_check(rows=20):
+  # against the local mock: a replay while every FHIR request is answered 503 parks the visits
+  # in the spool and leaves every row open, the same replay resolves them once the server is back
+  import mock_fhir_server
+  from epus_spool import epus_Spool
+  from generate_dataset import Dataset_Generator
+
+  mock_server = mock_fhir_server.start_mock_server(error_rate=1.0, error_status=503)
+  work_dir    = tempfile.mkdtemp(prefix='epus-replay-check-')
+  FHIR_Base.FHIR_BASE_URL = mock_server.store.base_url
+  FHIR_Base.KEYCLOAK_URL  = f'http://127.0.0.1:{mock_server.server_address[1]}'
+
+  kunjungan = epus_Kunjungan()
+  kunjungan.testing        = False
+  kunjungan.debug          = False
+  kunjungan.token_filename = os.path.join(work_dir, 'token-check.key')
+  kunjungan.set_spool(epus_Spool(os.path.join(work_dir, 'spool')), park_only=True)
+
+  csv_filename = os.path.join(work_dir, 'replay_check.csv')
+  Dataset_Generator(rows).write_csv(csv_filename)
+  dead_letter = epus_Dead_Letter(os.path.join(work_dir, 'dead_letter.sqlite'))
+  for data in kunjungan.iter_csv_data('', csv_filename):
+    dead_letter.add(data, None, FHIR_Error(503, 'replay check'), 'check')
+
+  unavailable = dead_letter.replay(kunjungan)
+  still_open  = len(dead_letter.pending())
+
+  mock_server.store.error_rate = 0.0
+  available = dead_letter.replay(kunjungan)
+  left_open = len(dead_letter.pending())
+
+  dead_letter.close()
+  kunjungan.spool.close()
+  mock_server.shutdown()
+
+  passed = unavailable['ok'] == 0 and still_open == rows and available['ok'] == rows and left_open == 0
+  log_dead_letter.info('replay check %s: 503 %s, %s open; 200 %s, %s open', 'passed' if passed else 'FAILED', unavailable, still_open, available, left_open)
+  return passed
+
+
+#===========================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='list and replay the visits of a dead-letter store, check runs a replay against the local mock')
+  parser.add_argument('command', choices=('list', 'replay', 'check'))
+  parser.add_argument('filename', nargs='?', default='', help='dead-letter store, e.g. sql_dump/dead_letter.sqlite')
+  parser.add_argument('--workers', type=int, default=4, help='concurrent prefetch and send workers')
+  parser.add_argument('--batch-size', type=int, default=10, help='visits per transaction bundle')
+  parser.add_argument('--limit', type=int, default=0, help='oldest N visits only')
+  parser.add_argument('--status', type=int, default=None, help='only the visits that failed with this HTTP status')
+  parser.add_argument('--stage', default=None, help='only the visits that failed in this stage')
+  parser.add_argument('--token-file', default='', help='bearer token file')
+  args = parser.parse_args()
+
+  setup_logging('INFO')
+  if args.command == 'check': exit(0 if replay_check() else 1)
+  if not args.filename: parser.error('the list and replay commands need the dead-letter store')
+
+  epus_Dead_Letter_Garut = epus_Dead_Letter(args.filename)
+  if args.command == 'list':
+    for stage, status, count in epus_Dead_Letter_Garut.summary():
+      print(f'{stage or "visit":10} {status or "-":>5} {count}')
+
+    for record in epus_Dead_Letter_Garut.pending(args.limit or 20, args.status, args.stage):
+      print(record['id_pendaftaran'], record['attempts'], record['error'][:120])
+
+  else:
+    epus_Kunjungan_Garut = epus_Kunjungan()
+    epus_Kunjungan_Garut.testing = False
+    epus_Kunjungan_Garut.debug   = False
+    if args.token_file: epus_Kunjungan_Garut.token_filename = args.token_file
+
+    results = epus_Dead_Letter_Garut.replay(epus_Kunjungan_Garut, args.workers, args.batch_size, args.limit, args.status, args.stage)
+    print(json.dumps(results))
+
+  epus_Dead_Letter_Garut.close()
@@ -7,16 +7,81 @@ Created on Tue Sep  5 10:29:05 2024
 '''
 
 import requests
+import codecs
+import copy
+import hashlib
 import io
-import pandas as pd
-import msoffcrypto
 import re
-import numpy as np
 import os
 from datetime import datetime
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
 import json
+import logging
+
+from epus_metrics import metrics
+from epus_logging import get_logger, setup_logging
+from epus_tracing import tracer, SPAN_KIND_CLIENT
+
+# pandas, numpy and msoffcrypto are only needed by the Excel/CSV loaders,
+# load them on first use so HTTP-only callers start fast.
+pd          = None
+np          = None
+msoffcrypto = None
+
+re_whitespace      = re.compile(r'\s*')
+re_json_token      = re.compile(r'(?P<string>"(?:[^"\\]|\\.)*")|(?P<open>")|[{}\[\],]')
+re_token_line      = re.compile(r'^(\S+)$')
+re_allergy         = re.compile(r'^(\w+)\s*:\s*(.+)$')
+re_datetime        = re.compile(r'^(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2})$')
+
+log_row     = get_logger('row')
+log_build   = get_logger('build')
+log_request = get_logger('request')
+log_token   = get_logger('token')
+log_debug   = get_logger('debug')
+log_offline = get_logger('offline')
+
+#-----------------------------------------------------------------------------
+def load_dataframe_modules():
+  global pd, np, msoffcrypto
+  if pd is not None: return
+
+  import pandas
+  import numpy
+  import msoffcrypto as _msoffcrypto
+
+  pandas.set_option('future.no_silent_downcasting', True)
+  np          = numpy
+  msoffcrypto = _msoffcrypto
+  pd          = pandas
+
+#============================================================================
+class FHIR_Error(Exception):
+  # the server did not answer with success, status is the HTTP status code
+
+#-----------------------------------------------------------------------------
+  def __init__(self, status, text=''):
+    super().__init__(f'Error: {status} - {text}')
+    self.status = status
+    self.text   = text
+
+
+class FHIR_Version_Conflict(FHIR_Error):
+  # 412, an If-Match version was not the current one any more
+  pass
+
+
+class FHIR_Circuit_Open(FHIR_Error):
+  # refused without a request, the circuit breaker of the endpoint is open
+
+#-----------------------------------------------------------------------------
+  def __init__(self, endpoint):
+    super().__init__(503, f'circuit of {endpoint} is open')
+    self.endpoint = endpoint
 
-pd.set_option('future.no_silent_downcasting', True)
 
 class FHIR_Base:
   KEYCLOAK_URL = ''
@@ -27,14 +92,82 @@ class FHIR_Base:
   bearer_token  = ''
   headers       = {}
 
+  # merge_lists switches from scanning to hashing above len(list1) * len(list2)
+  merge_hash_threshold = 1024
+
+  deterministic_namespace = uuid.uuid5(uuid.NAMESPACE_URL, 'https://sys-ids.kemkes.go.id/epus')
+
+  # what a copy for another worker thread shares with its original, see worker_copy
+  worker_shared = ('testing', 'debug', 'delay', 'token_filename', 'base_url', 'offline', 'offline_snapshot', 'master_registry', 'master_pending', 'mirror', 'identifier_index', 'deterministic_ids', 'optimistic_writes', 'written_cache', 'written_lock', 'spool', 'park_only', 'circuit_breaker', 'request_timeout', 'dead_letter', 'bundle_tuner')
+
+  # written once per run, later visits only reference them
+  master_types = ('Patient', 'Practitioner', 'Location', 'Organization')
+
 #-----------------------------------------------------------------------------
   def __init__(self):
+    # epus_Kunjungan runs this through every FHIR_* mixin, only the first call counts
+    if getattr(self, '_base_initialized', False): return
+    self._base_initialized = True
+
     self.testing        = True
     self.debug          = True
     self.delay          = 1
     self.token_filename = 'token-dev.key'
     self.base_url       = self.FHIR_BASE_URL
-    if not self.bearer_token: self.read_bearer_token()
+    self.lookup_cache   = dict()
+    self.identifier_cache = None
+
+    # (resource_type, identifier) -> (content hash, 'Type/id') of master data this run already wrote,
+    # and the hashes of the ones still waiting for their transaction response
+    self.master_registry = dict()
+    self.master_pending  = dict()
+
+    # offline dry-run: lookups from a local snapshot, bundles to an NDJSON file, no network at all
+    self.offline                = False
+    self.offline_snapshot       = dict()
+    self.offline_output         = None
+    self.offline_request_count  = 0
+    self.offline_stats          = dict()
+
+    # optional epus_Mirror, reads of the types it holds are answered locally while it is fresh
+    self.mirror = None
+
+    # optional epus_Identifier_Index, searches for identifiers it never saw are answered empty
+    self.identifier_index = None
+
+    # PUT Type/<uuid5 of the identifier> instead of conditional PUTs, and reads instead of searches;
+    # only for a server whose resources were all written this way, older ones have random ids
+    self.deterministic_ids = False
+
+    # If-Match with the versionId the update was merged from; every resource this run wrote is
+    # kept with its new version so the next update of it needs no read, the oldest written
+    # go once there are more than written_cache_size
+    self.optimistic_writes    = False
+    self.written_cache        = dict()
+    self.written_cache_size   = 100000
+    self.written_lock         = threading.Lock()
+    self.max_conflict_retries = 3
+
+    # the searches a 412 retry must send to the server, the local copies of them are what went stale
+    self.conflict_reads = set()
+
+    # optional epus_Spool, built bundles are appended there and a drain worker sends them;
+    # with park_only they are sent right away and only the visits the server could not take are spooled
+    self.spool     = None
+    self.park_only = False
+
+    # optional epus_Circuit_Breaker, calls to an endpoint that keeps failing are refused without waiting
+    self.circuit_breaker = None
+    self.request_timeout = 60
+
+    # optional epus_Dead_Letter, the loaders put a visit that failed there and go on with the next one;
+    # visit_entries is the bundle of the last visit, None when it could not be built
+    self.dead_letter   = None
+    self.visit_entries = None
+
+    # optional epus_Bundle_Tuner, every transaction post reports its size and latency there
+    # and the bundles of several visits or of the master data are cut to its limit
+    self.bundle_tuner = None
 
 #-----------------------------------------------------------------------------
   def read_bearer_token(self, token_filename=''):
@@ -44,9 +177,9 @@ class FHIR_Base:
     if os.path.isfile(self.token_filename):
       fin = open(self.token_filename)
       for line in fin.readlines():
-        rline = re.search('^#', line)
-        if rline: continue
-        self.bearer_token = re.findall(r'^(\S+)$', line)[0]
+        if line.startswith('#'): continue
+        rline = re_token_line.match(line)
+        if rline: self.bearer_token = rline.group(1)
       
       fin.close()
 
@@ -59,17 +192,22 @@ class FHIR_Base:
 
 #-----------------------------------------------------------------------------
   def get_keycloak_token(self):
-    print('[info]: generate new token.')
+    log_token.info('generate new token')
     token_url = f'{self.KEYCLOAK_URL}/realms/{self.REALM_NAME}/protocol/openid-connect/token'
     headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
+        'Content-Type': 'application/x-www-form-urlencoded',
+        # requests drops a None header, the expired bearer token is not sent along
+        'Authorization': None
     }
     payload = {
         'client_id': self.CLIENT_ID,
         'client_secret': self.CLIENT_SECRET,
         'grant_type': 'client_credentials'
     }
-    response = requests.post(token_url, headers=headers, data=payload)
+    # through transport like every other call: request_timeout and the 'POST token' circuit
+    with metrics.timer('epus_stage_seconds', stage='token'), tracer.span('POST token', {'http.request.method': 'POST', 'url.full': token_url}, SPAN_KIND_CLIENT) as span:
+      response = self.transport('POST', token_url, 'POST token', span, headers, {'data': payload, 'timeout': self.request_timeout})
+
     response.raise_for_status()
     return response.json()['access_token']
 
@@ -86,29 +224,97 @@ class FHIR_Base:
 
 #-----------------------------------------------------------------------------
   def fullUrl_to_reference(self, fullUrl):
-    rreference = re.search(r'^'+ self.base_url +'(.+)$', fullUrl)
-    if rreference:
-      return rreference.group(1)
+    # plain prefix test, base_url is a URL and not a pattern
+    if self.base_url and len(fullUrl) > len(self.base_url) and fullUrl.startswith(self.base_url):
+      return fullUrl[len(self.base_url):]
       
     return fullUrl
+
+#-----------------------------------------------------------------------------
+  def normalize_identifier(self, value):
+    # '20241017 00001' -> '20241017-00001'; while a row is built every builder shares one result
+    if self.identifier_cache is None:
+      return str(value).replace(' ', '-')
+
+    identifier = self.identifier_cache.get(value)
+    if identifier is None:
+      identifier = self.identifier_cache[value] = str(value).replace(' ', '-')
+
+    return identifier
     
 #-----------------------------------------------------------------------------
-  def get_resource_by_identifier(self, resource_type, identifier):
-    params = {
-      'identifier': identifier
-    }
-  
-    url      = self.base_url + resource_type
-    response = requests.get(url, params=params, headers=self.headers)
-  
-    if response.status_code == 401:
-      self.get_and_save_token()
-      response = requests.get(url, params=params, headers=self.headers)
+  def request_type(self, method, url, kwargs):
+    bundle_json = kwargs.get('json')
+    if isinstance(bundle_json, dict) and bundle_json.get('resourceType') == 'Bundle':
+      return f'{method} {bundle_json.get("type", "bundle")}'
 
-    if response.status_code != 200:
-        raise Exception(f'Error: {response.status_code} - {response.text}')
-  
-    response_json = response.json()
+    if method == 'GET':
+      return 'GET search' if kwargs.get('params') or '?' in url else 'GET read'
+
+    if '$' in url:
+      return f'{method} {url[url.rindex("$"):]}'
+
+    return method
+
+#-----------------------------------------------------------------------------
+  def count_request(self, request_type, response, seconds, span):
+    prepared       = getattr(response, 'request', None)
+    bytes_sent     = len(getattr(prepared, 'body', None) or b'')
+    bytes_received = len(response.content or b'')
+
+    metrics.inc('epus_requests_total', type=request_type, status=response.status_code)
+    metrics.inc('epus_request_bytes_sent_total', bytes_sent, type=request_type)
+    metrics.inc('epus_request_bytes_received_total', bytes_received, type=request_type)
+    metrics.observe('epus_request_seconds', seconds, type=request_type)
+
+    span.set('http.response.status_code', response.status_code)
+    span.set('http.request.body.size', bytes_sent)
+    span.set('http.response.body.size', bytes_received)
+
+#-----------------------------------------------------------------------------
+  def transport(self, method, url, request_type, span, headers, kwargs):
+    # one HTTP call, through the circuit breaker of its request type when there is one
+    probe   = self.circuit_breaker.before(request_type) if self.circuit_breaker else False
+    started = time.perf_counter()
+    try:
+      response = requests.request(method, url, headers={**self.headers, **(headers or {})}, **kwargs)
+    except requests.RequestException:
+      if self.circuit_breaker: self.circuit_breaker.after(request_type, time.perf_counter() - started, None, probe)
+      raise
+
+    seconds = time.perf_counter() - started
+    if self.circuit_breaker: self.circuit_breaker.after(request_type, seconds, response.status_code, probe)
+    self.count_request(request_type, response, seconds, span)
+
+    return response
+
+#-----------------------------------------------------------------------------
+  def send_request(self, method, url, headers=None, **kwargs):
+    if not self.bearer_token: self.read_bearer_token()
+
+    kwargs.setdefault('timeout', self.request_timeout)
+    request_type = self.request_type(method, url, kwargs)
+    with tracer.span(request_type, {'http.request.method': method, 'url.full': url}, SPAN_KIND_CLIENT) as span:
+      response = self.transport(method, url, request_type, span, headers, kwargs)
+
+      if response.status_code == 401:
+        metrics.inc('epus_token_refresh_total')
+        span.set('epus.token_refreshed', True)
+        self.get_and_save_token()
+        response = self.transport(method, url, request_type, span, headers, kwargs)
+
+    return response
+
+#-----------------------------------------------------------------------------
+  def is_transient_error(self, error):
+    # the server is down, overloaded or its circuit is open; worth sending again later
+    if isinstance(error, requests.RequestException): return True
+    if not isinstance(error, FHIR_Error): return False
+
+    return error.status >= 500 or error.status in (408, 429)
+
+#-----------------------------------------------------------------------------
+  def searchset_to_resource(self, response_json):
   #  if response_json['total'] > 1:
   #    raise Exception(f'Error: we found more than one {resource_type} with identifier {identifier}')
   
@@ -119,15 +325,245 @@ class FHIR_Base:
     reference = self.fullUrl_to_reference(fullUrl)
     
     return response_json['entry'][0]['resource'], reference
+
+#-----------------------------------------------------------------------------
+  def set_offline(self, output_filename, snapshot_filename=''):
+    self.offline          = True
+    self.offline_snapshot = dict()
+    self.offline_output   = open(output_filename, 'w') if output_filename else None
+    self.offline_stats    = {'rows': 0, 'requests': 0, 'entries': 0, 'build_time': 0.0}
+    if snapshot_filename: self.load_offline_snapshot(snapshot_filename)
+
+#-----------------------------------------------------------------------------
+  def close_offline(self):
+    if self.offline_output:
+      self.offline_output.close()
+      self.offline_output = None
+
+    rows = self.offline_stats.get('rows', 0)
+    if not rows: return
+
+    requests_count = self.offline_stats['requests']
+    build_time     = self.offline_stats['build_time']
+    log_offline.info('%s rows, %s requests (%.1f/row), %s entries, build %.3fs (%.0f rows/s)', rows, requests_count, requests_count / rows, self.offline_stats['entries'], build_time, rows / build_time if build_time else 0)
+
+#-----------------------------------------------------------------------------
+  def print_offline_report(self, label, json_data, build_time):
+    self.offline_stats['rows']       += 1
+    self.offline_stats['requests']   += self.offline_request_count
+    self.offline_stats['entries']    += len(json_data)
+    self.offline_stats['build_time'] += build_time
+
+    if log_offline.isEnabledFor(logging.INFO):
+      log_offline.info('%s requests=%s entries=%s build=%.2fms', label, self.offline_request_count, len(json_data), build_time * 1000)
+
+#-----------------------------------------------------------------------------
+  def load_offline_snapshot(self, snapshot_filename):
+    # NDJSON of FHIR resources or Bundles, indexed like the server answers identifier=<value>
+    fin = open(snapshot_filename)
+    for line in fin:
+      line = line.strip()
+      if not line: continue
+
+      resource  = json.loads(line)
+      resources = [resource]
+      if resource.get('resourceType') == 'Bundle':
+        resources = [entry['resource'] for entry in resource.get('entry', []) if 'resource' in entry]
+
+      for resource in resources:
+        reference = f'{resource["resourceType"]}/{resource.get("id", "")}'
+        self.offline_snapshot[reference] = (resource, reference)
+        for identifier in resource.get('identifier', []):
+          self.offline_snapshot.setdefault((resource['resourceType'], identifier.get('value')), (resource, reference))
+
+    fin.close()
+
+#-----------------------------------------------------------------------------
+  def get_offline_resource(self, read):
+    resource, reference = self.offline_snapshot.get(read, ({}, ''))
+    return copy.deepcopy(resource), reference
+
+#-----------------------------------------------------------------------------
+  def worker_copy(self):
+    # same settings and run state for another thread, its own lookup caches
+    kunjungan = type(self)()
+    for name in self.worker_shared:
+      setattr(kunjungan, name, getattr(self, name))
+
+    return kunjungan
+
+#-----------------------------------------------------------------------------
+  def set_spool(self, spool, park_only=False):
+    self.spool     = spool
+    self.park_only = park_only
+
+#-----------------------------------------------------------------------------
+  def set_dead_letter(self, dead_letter):
+    self.dead_letter = dead_letter
+
+#-----------------------------------------------------------------------------
+  def set_bundle_tuner(self, bundle_tuner):
+    self.bundle_tuner = bundle_tuner
+
+#-----------------------------------------------------------------------------
+  def set_circuit_breaker(self, circuit_breaker):
+    self.circuit_breaker = circuit_breaker
+
+#-----------------------------------------------------------------------------
+  def park_visit(self, data, entries, error):
+    # the server cannot take the visit now: into the spool for the drain instead of failing it,
+    # entries is None when it could not even be built
+    if self.spool is None or self.testing or not self.is_transient_error(error): return False
+
+    self.spool.append(data, entries)
+    metrics.inc('epus_parked_visits_total', built=entries is not None)
+    log_request.warning('visit %s parked: %s', data.get('id_pendaftaran'), error)
+
+    return True
+
+#-----------------------------------------------------------------------------
+  def set_mirror(self, mirror):
+    self.mirror = mirror
+
+#-----------------------------------------------------------------------------
+  def get_mirror_resource(self, read):
+    # (resource, reference) from the mirror, None when it cannot answer
+    if isinstance(read, str):
+      resource = self.mirror.get_resource_by_reference(read)
+      if resource is None: return None
+      return (resource, read) if resource else ({}, '')
+
+    return self.mirror.get_resource_by_identifier(read[0], read[1])
+
+#-----------------------------------------------------------------------------
+  def set_identifier_index(self, identifier_index):
+    self.identifier_index = identifier_index
+
+#-----------------------------------------------------------------------------
+  def get_local_resource(self, read):
+    # answered without the server: what this run wrote, identifiers the index never saw,
+    # then the mirror; None otherwise
+    if self.conflict_reads and not isinstance(read, str) and read in self.conflict_reads: return None
+
+    written = self.written_cache.get(read) if self.written_cache and not isinstance(read, str) else None
+    if written:
+      metrics.inc('epus_lookup_cache_total', type=read[0], result='written')
+      resource, reference = written
+      return copy.deepcopy(resource), reference
+
+    if self.identifier_index and not isinstance(read, str) and not self.identifier_index.might_exist(read[0], read[1]):
+      return {}, ''
+
+    if self.mirror: return self.get_mirror_resource(read)
+    return None
+
+#-----------------------------------------------------------------------------
+  def write_offline_bundle(self, json_data):
+    bundle_json = {
+      'resourceType': 'Bundle',
+      'type': 'transaction',
+      'entry': self.direct_entries(json_data) if self.deterministic_ids else json_data
+    }
+
+    self.offline_request_count += 1
+    if self.offline_output:
+      self.offline_output.write(json.dumps(bundle_json) + '\n')
+
+#-----------------------------------------------------------------------------
+  def get_resource_by_identifier(self, resource_type, identifier):
+    with tracer.span('lookup', {'fhir.resource_type': resource_type, 'fhir.identifier': identifier}) as span:
+      return self.__get_resource_by_identifier(resource_type, identifier, span)
+
+#-----------------------------------------------------------------------------
+  def __get_resource_by_identifier(self, resource_type, identifier, span):
+    if (resource_type, identifier) in self.lookup_cache:
+      metrics.inc('epus_lookup_cache_total', type=resource_type, result='hit')
+      span.set('epus.cache_hit', True)
+      resource, reference = self.lookup_cache[(resource_type, identifier)]
+      return copy.deepcopy(resource), reference
+
+    span.set('epus.cache_hit', False)
+    metrics.inc('epus_lookup_cache_total', type=resource_type, result='miss')
+
+    if self.offline:
+      self.offline_request_count += 1
+      return self.get_offline_resource((resource_type, identifier))
+
+    result = self.get_local_resource((resource_type, identifier))
+    if result is not None: return result
+
+    if self.deterministic_ids:
+      return self.read_deterministic_resource(resource_type, identifier)
+
+    params = {
+      'identifier': identifier
+    }
+  
+    url = self.base_url + resource_type
+    with metrics.timer('epus_stage_seconds', stage='lookup'):
+      response = self.send_request('GET', url, params=params)
+
+    if response.status_code != 200:
+        raise FHIR_Error(response.status_code, response.text)
+  
+    resource, reference = self.searchset_to_resource(response.json())
+    if self.identifier_index: self.identifier_index.observe(resource_type, bool(reference))
+
+    return resource, reference
     
+#-----------------------------------------------------------------------------
+  def deterministic_reference(self, resource_type, identifier):
+    return f'{resource_type}/{self.deterministic_id(resource_type, identifier)}'
+
+#-----------------------------------------------------------------------------
+  def read_deterministic_resource(self, resource_type, identifier):
+    reference = self.deterministic_reference(resource_type, identifier)
+    with metrics.timer('epus_stage_seconds', stage='lookup'):
+      response = self.send_request('GET', f'{self.base_url}{reference}')
+
+    if response.status_code in (404, 410): return {}, ''
+    if response.status_code != 200:
+      raise FHIR_Error(response.status_code, response.text)
+
+    return response.json(), reference
+
+#-----------------------------------------------------------------------------
+  def direct_entries(self, entries):
+    # every conditional PUT as PUT Type/<id>, the urn:uuid placeholders as the real references
+    references     = dict()
+    direct_entries = []
+    for entry in entries:
+      request = entry.get('request', {})
+      resource_type, _, identifier = request.get('url', '').partition('?identifier=')
+      if request.get('method') != 'PUT' or not identifier:
+        direct_entries.append(entry)
+        continue
+
+      reference = self.deterministic_reference(resource_type, identifier)
+      references[entry['fullUrl']] = reference
+      direct_entries.append({
+        'fullUrl': f'{self.base_url}{reference}',
+        'resource': dict(entry['resource'], id=reference.split('/')[1]),
+        'request': dict(request, url=reference)
+      })
+
+    # on a copy, the entries stay as they were built
+    direct_entries = copy.deepcopy(direct_entries)
+    self.rewrite_references(direct_entries, lambda value: references.get(value, value))
+    return direct_entries
+
 #-----------------------------------------------------------------------------
   def get_resource_by_reference(self, reference):
-    url = f'{self.base_url}{reference}'
-    response = requests.get(url, headers=self.headers)
+    if self.offline:
+      self.offline_request_count += 1
+      return self.get_offline_resource(reference)[0]
 
-    if response.status_code == 401:
-      self.get_and_save_token()
-      response = requests.get(url, headers=self.headers)
+    if self.mirror:
+      result = self.get_mirror_resource(reference)
+      if result is not None: return result[0]
+
+    url = f'{self.base_url}{reference}'
+    response = self.send_request('GET', url)
 
     if response.status_code == 200:
       response_json = response.json()
@@ -136,24 +572,292 @@ class FHIR_Base:
       tmp = dict()
       return tmp
 
+#-----------------------------------------------------------------------------
+  def get_resources_batch(self, reads, batch_size=100):
+    # reads are references ('Patient/123') or (resource_type, identifier) searches,
+    # answered as (resource, reference) in the same order with one batch bundle per batch_size reads
+    if self.offline:
+      self.offline_request_count += (len(reads) + batch_size - 1) // batch_size
+      return [self.get_offline_resource(read) for read in reads]
+
+    if self.mirror or self.identifier_index or self.written_cache:
+      results = [self.get_local_resource(read) for read in reads]
+      remote  = [no for no, result in enumerate(results) if result is None]
+      if remote:
+        for no, result in zip(remote, self.__get_resources_batch([reads[no] for no in remote], batch_size)):
+          results[no] = result
+          if self.identifier_index and not isinstance(reads[no], str): self.identifier_index.observe(reads[no][0], bool(result[1]))
+
+      return results
+
+    return self.__get_resources_batch(reads, batch_size)
+
+#-----------------------------------------------------------------------------
+  def __get_resources_batch(self, reads, batch_size):
+    if self.deterministic_ids:
+      # a search by identifier becomes a read of the id the identifier maps to
+      reads = [read if isinstance(read, str) else self.deterministic_reference(read[0], read[1]) for read in reads]
+
+    results = []
+    for start in range(0, len(reads), batch_size):
+      entries = []
+      for read in reads[start:start + batch_size]:
+        if isinstance(read, str):
+          url = read
+        else:
+          url = f'{read[0]}?{urlencode({"identifier": read[1]})}'
+
+        entries.append({
+          'request': {
+            'method': 'GET',
+            'url': url
+          }
+        })
+
+      bundle_json = {
+        'resourceType': 'Bundle',
+        'type': 'batch',
+        'entry': entries
+      }
+
+      response = self.send_request('POST', self.base_url, json=bundle_json)
+
+      if response.status_code != 200:
+        raise FHIR_Error(response.status_code, response.text)
+
+      # one answer per request or the reads cannot be matched up, an incomplete batch is a bad gateway answer
+      batch_reads      = reads[start:start + batch_size]
+      response_entries = response.json().get('entry', [])
+      if len(response_entries) != len(batch_reads):
+        raise FHIR_Error(502, f'batch of {len(batch_reads)} reads answered with {len(response_entries)} entries')
+
+      for read, entry in zip(batch_reads, response_entries):
+        status   = entry.get('response', {}).get('status', '')
+        resource = entry.get('resource', {})
+        if isinstance(read, str):
+          results.append((resource, read) if status.startswith('200') else ({}, ''))
+        elif status.startswith('200'):
+          results.append(self.searchset_to_resource(resource))
+        else:
+          raise FHIR_Error(int(status[:3] or 0), json.dumps(resource))
+
+    return results
+
+#-----------------------------------------------------------------------------
+  def fetch_resources_by_identifier(self, lookups):
+    lookups = list(dict.fromkeys(lookups))
+    with metrics.timer('epus_stage_seconds', stage='lookup'), tracer.span('prefetch', {'epus.lookups': len(lookups)}):
+      results = self.get_resources_batch(lookups)
+
+    return dict(zip(lookups, results))
+
+#-----------------------------------------------------------------------------
+  def prefetch_resources_by_identifier(self, lookups):
+    self.lookup_cache = self.fetch_resources_by_identifier(lookups)
+
 #-----------------------------------------------------------------------------
   def post_bundle_transaction(self, json):
+    if self.optimistic_writes: json = self.set_if_match(json)
+
     bundle_json = {
       'resourceType': 'Bundle',
       'type': 'transaction',
-      'entry': json
+      'entry': self.direct_entries(json) if self.deterministic_ids else json
     }
   
-    response = requests.post(self.base_url, json=bundle_json, headers=self.headers)
-    
-    if response.status_code == 401:
-      self.get_and_save_token()
-      response = requests.post(self.base_url, json=bundle_json, headers=self.headers)
+    started = time.perf_counter()
+    with metrics.timer('epus_stage_seconds', stage='post'), tracer.span('post', {'epus.entries': len(json)}):
+      try:
+        response = self.send_request('POST', self.base_url, json=bundle_json)
+      except requests.RequestException:
+        if self.bundle_tuner: self.bundle_tuner.observe(len(json), 0, time.perf_counter() - started)
+        raise
+
+    if self.bundle_tuner:
+      self.bundle_tuner.observe(len(json), len(getattr(response.request, 'body', None) or b''), time.perf_counter() - started, response.status_code)
+
+    if response.status_code == 412:
+      metrics.inc('epus_bundles_total', status='conflict')
+      raise FHIR_Version_Conflict(response.status_code, response.text)
 
     if response.status_code != 200:
-      raise Exception(f'Error: {response.status_code} - {response.text}')
+      metrics.inc('epus_bundles_total', status='error')
+      raise FHIR_Error(response.status_code, response.text)
   
-    print('  Success send transaction bundle')
+    metrics.inc('epus_bundles_total', status='ok')
+    metrics.inc('epus_bundle_entries_total', len(json))
+    log_request.info('success send transaction bundle, %s entries', len(json))
+
+    response_json = response.json()
+    if self.identifier_index: self.identifier_index.add_transaction(json, response_json)
+    if self.optimistic_writes or self.mirror:
+      written = self.written_resources(json, response_json)
+      if self.optimistic_writes: self.remember_written_entries(written)
+      if self.mirror: self.mirror.store_written([resource for resource_type, identifier, resource, reference in written])
+
+    return response_json
+
+#-----------------------------------------------------------------------------
+  def set_if_match(self, entries):
+    # the version a conditional update was merged from, the server answers 412 when it moved on;
+    # on copies of the entries, a retry of the caller's list must not send the stale version again
+    if_match_entries = []
+    for entry in entries:
+      request    = entry.get('request', {})
+      version_id = entry.get('resource', {}).get('meta', {}).get('versionId')
+      if request.get('method') == 'PUT' and version_id:
+        entry = dict(entry, request=dict(request, ifMatch=f'W/"{version_id}"'))
+
+      if_match_entries.append(entry)
+
+    return if_match_entries
+
+#-----------------------------------------------------------------------------
+  def written_resources(self, entries, response_json):
+    # (resource_type, identifier, resource, reference) of every conditional write as the server
+    # stored it: placeholders resolved, id and new versionId from the location
+    locations  = [response_entry.get('response', {}).get('location', '').split('/') for response_entry in response_json.get('entry', [])]
+    references = {entry['fullUrl']: '/'.join(location[:2]) for entry, location in zip(entries, locations) if entry.get('fullUrl') and len(location) >= 2}
+    written    = []
+    for entry, location in zip(entries, locations):
+      resource_type, _, identifier = entry.get('request', {}).get('url', '').partition('?identifier=')
+      if 'resource' not in entry or len(location) < 4 or location[2] != '_history': continue
+
+      resource = copy.deepcopy(entry['resource'])
+      self.rewrite_references(resource, lambda value: references.get(value, value))
+      resource['id']   = location[1]
+      resource['meta'] = dict(resource.get('meta', {}), versionId=location[3])
+      written.append((resource_type, identifier, resource, f'{location[0]}/{location[1]}'))
+
+    return written
+
+#-----------------------------------------------------------------------------
+  def remember_written_entries(self, written):
+    # written again moves to the end, the eviction goes oldest written first
+    with self.written_lock:
+      for resource_type, identifier, resource, reference in written:
+        if not identifier: continue
+
+        self.written_cache.pop((resource_type, identifier), None)
+        self.written_cache[(resource_type, identifier)] = (resource, reference)
+
+      while len(self.written_cache) > self.written_cache_size:
+        del self.written_cache[next(iter(self.written_cache))]
+
+#-----------------------------------------------------------------------------
+  def forget_written_entries(self, entries):
+    # a 412 on these entries: the next build reads them from the server, not from a local copy
+    for entry in entries:
+      resource_type, _, identifier = entry.get('request', {}).get('url', '').partition('?identifier=')
+      if not identifier: continue
+
+      with self.written_lock:
+        self.written_cache.pop((resource_type, identifier), None)
+
+      self.conflict_reads.add((resource_type, identifier))
+
+#-----------------------------------------------------------------------------
+  def content_hash(self, resource):
+    return hashlib.sha1(json.dumps(resource, sort_keys=True).encode('utf-8')).hexdigest()
+
+#-----------------------------------------------------------------------------
+  def registered_master_entry(self, resource_type, identifier, full_url, updated_resource):
+    # same content as what this run already wrote: an entry without request that only carries the reference
+    content_hash = self.content_hash(updated_resource)
+    registered   = self.master_registry.get((resource_type, identifier))
+    if registered and registered[0] == content_hash:
+      metrics.inc('epus_master_dedup_total', type=resource_type)
+      return {'fullUrl': full_url, 'reference': registered[1]}
+
+    self.master_pending[(resource_type, identifier)] = content_hash
+    return None
+
+#-----------------------------------------------------------------------------
+  def resolve_registered_entries(self, entries):
+    references = {entry['fullUrl']: entry['reference'] for entry in entries if 'request' not in entry}
+    if not references: return entries
+
+    entries = [entry for entry in entries if 'request' in entry]
+    self.rewrite_references(entries, lambda value: references.get(value, value))
+    return entries
+
+#-----------------------------------------------------------------------------
+  def register_master_entries(self, entries, response_json):
+    # a committed transaction answers every entry with its location, 'Practitioner/123/_history/1'
+    for entry, response_entry in zip(entries, response_json.get('entry', [])):
+      resource_type, _, identifier = entry.get('request', {}).get('url', '').partition('?identifier=')
+      if resource_type not in self.master_types or not identifier: continue
+
+      location = response_entry.get('response', {}).get('location', '').split('/')
+      if resource_type not in location[:-1]: continue
+
+      content_hash = self.master_pending.pop((resource_type, identifier), None)
+      if content_hash:
+        no = location.index(resource_type)
+        self.master_registry[(resource_type, identifier)] = (content_hash, f'{resource_type}/{location[no + 1]}')
+
+#-----------------------------------------------------------------------------
+  def rewrite_references(self, element, rewrite):
+    if isinstance(element, dict):
+      for key, value in element.items():
+        if key in ('fullUrl', 'reference') and isinstance(value, str):
+          element[key] = rewrite(value)
+        else:
+          self.rewrite_references(value, rewrite)
+
+    elif isinstance(element, list):
+      for item in element:
+        self.rewrite_references(item, rewrite)
+
+#-----------------------------------------------------------------------------
+  def deterministic_id(self, resource_type, identifier):
+    # the id follows from what the conditional PUT matches on, Type?identifier=<identifier>;
+    # the bulk export and the direct PUTs of deterministic_ids share it so they find each other
+    return str(uuid.uuid5(self.deterministic_namespace, f'{resource_type}|{identifier}'))
+
+#-----------------------------------------------------------------------------
+  def assign_deterministic_ids(self, entries):
+    # keeps an id that came from the server, otherwise derives one, then points
+    # the urn:uuid placeholders of the bundle at the real Type/<id> references
+    references = dict()
+    for entry in entries:
+      resource = entry['resource']
+      if not resource.get('id'):
+        resource_type, _, identifier = entry.get('request', {}).get('url', '').partition('?identifier=')
+        if not identifier: identifier = (resource.get('identifier') or [{}])[0].get('value', '')
+        resource['id'] = self.deterministic_id(resource['resourceType'], identifier)
+
+      references[entry['fullUrl']] = f'{resource["resourceType"]}/{resource["id"]}'
+
+    self.rewrite_references(entries, lambda value: references.get(value, value))
+    return entries
+
+#-----------------------------------------------------------------------------
+  def combine_bundle_entries(self, visit_entries_list):
+    # every visit uses the same urn:uuid placeholders, make them unique per visit
+    # and fold repeated conditional PUTs (same patient, practitioner, ...) into one entry
+    combined_list = []
+    url_entries   = dict()
+    for no, visit_entries in enumerate(visit_entries_list):
+      prefix = f'urn:uuid:visit{no}_'
+      self.rewrite_references(visit_entries, lambda value: value.replace('urn:uuid:', prefix, 1))
+
+      merged_full_urls = dict()
+      for entry in visit_entries:
+        url = entry['request']['url']
+        if url in url_entries and url_entries[url][0] != no:
+          first_entry = url_entries[url][1]
+          self.update_fhir_json(first_entry['resource'], entry['resource'])
+          merged_full_urls[entry['fullUrl']] = first_entry['fullUrl']
+          continue
+
+        url_entries[url] = (no, entry)
+        combined_list.append(entry)
+
+      if merged_full_urls:
+        self.rewrite_references(visit_entries, lambda value: merged_full_urls.get(value, value))
+
+    return combined_list
       
 #-----------------------------------------------------------------------------
   def update_fhir_json(self, fhir_json, update_json):
@@ -174,16 +878,43 @@ class FHIR_Base:
 
     return fhir_json
 
+#-----------------------------------------------------------------------------
+  def merge_key(self, item):
+    # bucket of a list item from identifier system+value, coding system+code or a reference;
+    # items that compare equal always share a bucket, so == inside the bucket decides as before
+    if isinstance(item, dict):
+      return (len(item), item.get('system'), item.get('value'), item.get('code'), item.get('reference'))
+
+    return item
+
 #-----------------------------------------------------------------------------
   def merge_lists(self, list1, list2):
     # Basic merging logic for lists (no duplicates)
     combined_list = list1[:]
+    if len(list1) * len(list2) > self.merge_hash_threshold:
+      try:
+        buckets = dict()
+        for item in combined_list:
+          buckets.setdefault(self.merge_key(item), []).append(item)
+
+        for item in list2:
+          bucket = buckets.setdefault(self.merge_key(item), [])
+          if item not in bucket:
+            bucket.append(item)
+            combined_list.append(item)
+
+        return combined_list
+
+      except TypeError:
+        # a key with a dict or list in it (a CodeableConcept code), scan instead
+        combined_list = list1[:]
+
     for item in list2:
       if item not in combined_list:
         combined_list.append(item)
 
     return combined_list
-    
+
 #-----------------------------------------------------------------------------
   def merge_nested_dicts(self, dict1, dict2):
     result = dict1.copy()
@@ -219,8 +950,8 @@ class FHIR_Patient(FHIR_Base):
         
 #----------------------------------------------------------------------------
   def __get_updated_json(self, emr_no, patient_name):
-    identifier          = emr_no
-    resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
+    identifier = emr_no
+    full_url   = 'urn:uuid:patient_fullUrl'
 
     updated_resource = {
       'resourceType': f'{self.__resource_type}',
@@ -237,10 +968,14 @@ class FHIR_Patient(FHIR_Base):
       }]
     }
 
-    new_resource = self._build_new_resource(resource, updated_resource)
+    registered_json = self.registered_master_entry(self.__resource_type, identifier, full_url, updated_resource)
+    if registered_json: return registered_json
+
+    resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
+    new_resource        = self._build_new_resource(resource, updated_resource)
 
     request_json = {
-      'fullUrl': 'urn:uuid:patient_fullUrl',
+      'fullUrl': full_url,
       'resource': new_resource,
       'request': {
         'method': f'{self.__method}',
@@ -248,13 +983,15 @@ class FHIR_Patient(FHIR_Base):
       }
     }
         
-    print(f'  {self.__method} {self.__resource_type} {identifier}')
+    if log_build.isEnabledFor(logging.DEBUG):
+      log_build.debug('%s %s %s', self.__method, self.__resource_type, identifier)
 
     return request_json
   
 #----------------------------------------------------------------------------
   def get_updated_json(self, emr_no, patient_name):
-    return self.__get_updated_json(emr_no, patient_name)
+    with metrics.timer('epus_build_seconds', resource_type='Patient'), tracer.span('build', {'fhir.resource_type': 'Patient'}):
+      return self.__get_updated_json(emr_no, patient_name)
     
 #----------------------------------------------------------------------------
   def update_fhir_data(self, emr_no, patient_name):
@@ -277,8 +1014,8 @@ class FHIR_Practitioner(FHIR_Base):
 
 #----------------------------------------------------------------------------
   def __get_updated_json(self, practitioner_type, practitioner_id, nama_practitioner):
-    identifier          = practitioner_id
-    resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
+    identifier = practitioner_id
+    full_url   = f'urn:uuid:practitioner_{practitioner_type}_fullUrl'
 
     updated_resource = {
       'resourceType': f'{self.__resource_type}',
@@ -295,10 +1032,14 @@ class FHIR_Practitioner(FHIR_Base):
       }]
     }
 
-    new_resource = self._build_new_resource(resource, updated_resource)
+    registered_json = self.registered_master_entry(self.__resource_type, identifier, full_url, updated_resource)
+    if registered_json: return registered_json
+
+    resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
+    new_resource        = self._build_new_resource(resource, updated_resource)
 
     request_json = {
-      'fullUrl': f'urn:uuid:practitioner_{practitioner_type}_fullUrl',
+      'fullUrl': full_url,
       'resource': new_resource,
       'request': {
         'method': f'{self.__method}',
@@ -306,13 +1047,15 @@ class FHIR_Practitioner(FHIR_Base):
       }
     }
         
-    print(f'  {self.__method} {self.__resource_type} {identifier}')
+    if log_build.isEnabledFor(logging.DEBUG):
+      log_build.debug('%s %s %s', self.__method, self.__resource_type, identifier)
 
     return request_json
   
 #----------------------------------------------------------------------------
   def get_updated_json(self, practitioner_type, practitioner_id, nama_practitioner):
-    return self.__get_updated_json(practitioner_type, practitioner_id, nama_practitioner)
+    with metrics.timer('epus_build_seconds', resource_type='Practitioner'), tracer.span('build', {'fhir.resource_type': 'Practitioner'}):
+      return self.__get_updated_json(practitioner_type, practitioner_id, nama_practitioner)
 
 #----------------------------------------------------------------------------
   def update_fhir_data(self, practitioner_type, practitioner_id, nama_practitioner):
@@ -335,7 +1078,7 @@ class FHIR_Observation(FHIR_Base):
 
 #----------------------------------------------------------------------------
   def __get_updated_json(self, id_pendaftaran, patient_name, nama_practitioner_periksa_fisik, tanggal_periksa_fisik, suhu='', denyut_nadi='', nafas='', sistolik='', diastolik='', lingkar_perut='', tinggi_badan='', berat_badan=''):
-    identifier          = id_pendaftaran.replace(' ', '-')
+    identifier          = self.normalize_identifier(id_pendaftaran)
     resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
     
     indicator = ''
@@ -568,13 +1311,15 @@ class FHIR_Observation(FHIR_Base):
       }
     }
             
-    print(f'  {self.__method} {self.__resource_type} {identifier}-{indicator}')
+    if log_build.isEnabledFor(logging.DEBUG):
+      log_build.debug('%s %s %s-%s', self.__method, self.__resource_type, identifier, indicator)
 
     return request_json
 
 #----------------------------------------------------------------------------
   def get_updated_json(self, id_pendaftaran, patient_name, nama_practitioner_periksa_fisik, tanggal_periksa_fisik, suhu='', denyut_nadi='', nafas='', sistolik='', diastolik='', lingkar_perut='', tinggi_badan='', berat_badan=''):
-    return self.__get_updated_json(id_pendaftaran, patient_name, nama_practitioner_periksa_fisik, tanggal_periksa_fisik, suhu, denyut_nadi, nafas, sistolik, diastolik, lingkar_perut, tinggi_badan, berat_badan)
+    with metrics.timer('epus_build_seconds', resource_type='Observation'), tracer.span('build', {'fhir.resource_type': 'Observation'}):
+      return self.__get_updated_json(id_pendaftaran, patient_name, nama_practitioner_periksa_fisik, tanggal_periksa_fisik, suhu, denyut_nadi, nafas, sistolik, diastolik, lingkar_perut, tinggi_badan, berat_badan)
 
 #----------------------------------------------------------------------------
   def update_fhir_data(self, id_pendaftaran, patient_name, nama_practitioner_periksa_fisik, tanggal_periksa_fisik, suhu='', denyut_nadi='', nafas='', sistolik='', diastolik='', lingkar_perut='', tinggi_badan='', berat_badan=''):
@@ -597,8 +1342,8 @@ class FHIR_Location(FHIR_Base):
 
 #----------------------------------------------------------------------------
   def __get_updated_json(self, location_id, nama_location):
-    identifier          = location_id.replace(' ', '-')
-    resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
+    identifier = self.normalize_identifier(location_id)
+    full_url   = 'urn:uuid:location_fullUrl'
       
     updated_resource = {
       'resourceType': f'{self.__resource_type}',
@@ -610,10 +1355,14 @@ class FHIR_Location(FHIR_Base):
       'name': f'{nama_location}'
     }
 
-    new_resource = self._build_new_resource(resource, updated_resource)
+    registered_json = self.registered_master_entry(self.__resource_type, identifier, full_url, updated_resource)
+    if registered_json: return registered_json
+
+    resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
+    new_resource        = self._build_new_resource(resource, updated_resource)
 
     request_json = {
-      'fullUrl': 'urn:uuid:location_fullUrl',
+      'fullUrl': full_url,
       'resource': new_resource,
       'request': {
         'method': f'{self.__method}',
@@ -621,13 +1370,15 @@ class FHIR_Location(FHIR_Base):
       }
     }
 
-    print(f'  {self.__method} {self.__resource_type} {identifier}')
+    if log_build.isEnabledFor(logging.DEBUG):
+      log_build.debug('%s %s %s', self.__method, self.__resource_type, identifier)
         
     return request_json
 
 #-------------------------------------------------------------------
   def get_updated_json(self, location_id, nama_location):
-    return self.__get_updated_json(location_id, nama_location)
+    with metrics.timer('epus_build_seconds', resource_type='Location'), tracer.span('build', {'fhir.resource_type': 'Location'}):
+      return self.__get_updated_json(location_id, nama_location)
   
 #----------------------------------------------------------------------------
   def update_fhir_data(self, location_id, nama_location):
@@ -651,7 +1402,7 @@ class FHIR_Encounter(FHIR_Base):
 
 #----------------------------------------------------------------------------
   def __get_updated_json(self, id_pendaftaran, encounter_date, history_arrived_start_period, history_arrived_end_period, history_inprogress_start_period, history_inprogress_end_period, history_finished_start_period, history_finished_end_period, period_start, period_end, suhu='', denyut_nadi='', nafas='', sistolik='', diastolik='', lingkar_perut='', tinggi_badan='', berat_badan='', location_id='', icdx_primer='', nama_icdx_primer='', icdx_sekunder='', nama_icdx_sekunder=''):
-    identifier          = id_pendaftaran.replace(' ', '-')
+    identifier          = self.normalize_identifier(id_pendaftaran)
     resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
       
     updated_resource = {
@@ -824,13 +1575,15 @@ class FHIR_Encounter(FHIR_Base):
       }
     }
 
-    print(f'  {self.__method} {self.__resource_type} {identifier}')
+    if log_build.isEnabledFor(logging.DEBUG):
+      log_build.debug('%s %s %s', self.__method, self.__resource_type, identifier)
         
     return request_json
 
 #-------------------------------------------------------------------
   def get_updated_json(self, id_pendaftaran, encounter_date, history_arrived_start_period, history_arrived_end_period, history_inprogress_start_period, history_inprogress_end_period, history_finished_start_period, history_finished_end_period, period_start, period_end, suhu='', denyut_nadi='', nafas='', sistolik='', diastolik='', lingkar_perut='', tinggi_badan='', berat_badan='', location_id='', icdx_primer='', nama_icdx_primer='', icdx_sekunder='', nama_icdx_sekunder=''):
-    return self.__get_updated_json(id_pendaftaran, encounter_date, history_arrived_start_period, history_arrived_end_period, history_inprogress_start_period, history_inprogress_end_period, history_finished_start_period, history_finished_end_period, period_start, period_end, suhu, denyut_nadi, nafas, sistolik, diastolik, lingkar_perut, tinggi_badan, berat_badan, location_id, icdx_primer, nama_icdx_primer, icdx_sekunder, nama_icdx_sekunder)
+    with metrics.timer('epus_build_seconds', resource_type='Encounter'), tracer.span('build', {'fhir.resource_type': 'Encounter'}):
+      return self.__get_updated_json(id_pendaftaran, encounter_date, history_arrived_start_period, history_arrived_end_period, history_inprogress_start_period, history_inprogress_end_period, history_finished_start_period, history_finished_end_period, period_start, period_end, suhu, denyut_nadi, nafas, sistolik, diastolik, lingkar_perut, tinggi_badan, berat_badan, location_id, icdx_primer, nama_icdx_primer, icdx_sekunder, nama_icdx_sekunder)
   
 #----------------------------------------------------------------------------
   def update_fhir_data(self, id_pendaftaran, encounter_date, history_arrived_start_period, history_arrived_end_period, history_inprogress_start_period, history_inprogress_end_period, history_finished_start_period, history_finished_end_period, period_start, period_end, suhu='', denyut_nadi='', nafas='', sistolik='', diastolik='', lingkar_perut='', tinggi_badan='', berat_badan='', location_id='', icdx_primer='', nama_icdx_primer='', icdx_sekunder='', nama_icdx_sekunder=''):
@@ -853,8 +1606,8 @@ class FHIR_Organization(FHIR_Base):
 
 #----------------------------------------------------------------------------
   def __get_updated_json(self, organization_id):
-    identifier          = str(organization_id).replace(' ', '-')
-    resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
+    identifier = self.normalize_identifier(organization_id)
+    full_url   = 'urn:uuid:organization_fullUrl'
       
     updated_resource = {
       'resourceType': f'{self.__resource_type}',
@@ -865,10 +1618,14 @@ class FHIR_Organization(FHIR_Base):
       }]
     }
     
-    new_resource = self._build_new_resource(resource, updated_resource)
+    registered_json = self.registered_master_entry(self.__resource_type, identifier, full_url, updated_resource)
+    if registered_json: return registered_json
+
+    resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
+    new_resource        = self._build_new_resource(resource, updated_resource)
 
     request_json = {
-      'fullUrl': 'urn:uuid:organization_fullUrl',
+      'fullUrl': full_url,
       'resource': new_resource,
       'request': {
         'method': f'{self.__method}',
@@ -876,13 +1633,15 @@ class FHIR_Organization(FHIR_Base):
       }
     }
         
-    print(f'  {self.__method} {self.__resource_type} {identifier}')
+    if log_build.isEnabledFor(logging.DEBUG):
+      log_build.debug('%s %s %s', self.__method, self.__resource_type, identifier)
 
     return request_json
 
 #----------------------------------------------------------------------------
   def get_updated_json(self, organization_id):
-    return self.__get_updated_json(organization_id)
+    with metrics.timer('epus_build_seconds', resource_type='Organization'), tracer.span('build', {'fhir.resource_type': 'Organization'}):
+      return self.__get_updated_json(organization_id)
 
 #----------------------------------------------------------------------------
   def update_fhir_data(self, organization_id):
@@ -901,7 +1660,7 @@ class FHIR_Condition(FHIR_Base):
 
 #----------------------------------------------------------------------------
   def __get_updated_json(self, condition_type, id_pendaftaran, tanggal, patient_name, nama_practitioner, keluhan='', icdx_primer='', nama_icdx_primer='', icdx_sekunder='', nama_icdx_sekunder=''):
-    identifier          = id_pendaftaran.replace(' ', '-')
+    identifier          = self.normalize_identifier(id_pendaftaran)
     resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
 
     updated_resource = {
@@ -1006,13 +1765,15 @@ class FHIR_Condition(FHIR_Base):
       }
     }
         
-    print(f'  {self.__method} {self.__resource_type} {identifier}')
+    if log_build.isEnabledFor(logging.DEBUG):
+      log_build.debug('%s %s %s', self.__method, self.__resource_type, identifier)
 
     return request_json
 
 #-------------------------------------------------------------------
   def get_updated_json(self, condition_type, id_pendaftaran, tanggal, patient_name, nama_practitioner, keluhan='', icdx_primer='', nama_icdx_primer='', icdx_sekunder='', nama_icdx_sekunder=''):
-    return self.__get_updated_json(condition_type, id_pendaftaran, tanggal, patient_name, nama_practitioner, keluhan, icdx_primer, nama_icdx_primer, icdx_sekunder, nama_icdx_sekunder)
+    with metrics.timer('epus_build_seconds', resource_type='Condition'), tracer.span('build', {'fhir.resource_type': 'Condition'}):
+      return self.__get_updated_json(condition_type, id_pendaftaran, tanggal, patient_name, nama_practitioner, keluhan, icdx_primer, nama_icdx_primer, icdx_sekunder, nama_icdx_sekunder)
   
 #----------------------------------------------------------------------------
   def update_fhir_data(self, condition_type, id_pendaftaran, tanggal, patient_name, nama_practitioner, keluhan='', icdx_primer='', nama_icdx_primer='', icdx_sekunder='', nama_icdx_sekunder=''):
@@ -1036,7 +1797,7 @@ class FHIR_AllergyIntolerance(FHIR_Base):
 
 #----------------------------------------------------------------------------
   def __get_updated_json(self, id_pendaftaran, alergi):
-    identifier          = id_pendaftaran.replace(' ', '-')
+    identifier          = self.normalize_identifier(id_pendaftaran)
     alergi              = alergi.capitalize()
     resource, reference = self.get_resource_by_identifier(self.__resource_type, identifier)
     
@@ -1044,7 +1805,7 @@ class FHIR_AllergyIntolerance(FHIR_Base):
     allergy_value = ''
     allergy_type  = ''
     
-    rallergy = re.search(r'^(\w+)\s*:\s*(.+)$', alergi)
+    rallergy = re_allergy.match(alergi)
     if rallergy:
       allergy_text  = rallergy.group(1)
       allergy_value = rallergy.group(2)
@@ -1128,13 +1889,15 @@ class FHIR_AllergyIntolerance(FHIR_Base):
       }
     }
         
-    print(f'  {self.__method} {self.__resource_type} {identifier}-{allergy_type}')
+    if log_build.isEnabledFor(logging.DEBUG):
+      log_build.debug('%s %s %s-%s', self.__method, self.__resource_type, identifier, allergy_type)
 
     return request_json
 
 #-------------------------------------------------------------------
   def get_updated_json(self, id_pendaftaran, alergi):
-    return self.__get_updated_json(id_pendaftaran, alergi)
+    with metrics.timer('epus_build_seconds', resource_type='AllergyIntolerance'), tracer.span('build', {'fhir.resource_type': 'AllergyIntolerance'}):
+      return self.__get_updated_json(id_pendaftaran, alergi)
   
 #----------------------------------------------------------------------------
   def update_fhir_data(self, id_pendaftaran, alergi):
@@ -1175,13 +1938,15 @@ class decrypt_Excel:
  
 #------------------------------------------------------------------
   def open_excel_file(self, directory='', filename=''):
+    load_dataframe_modules()
     self.set_directory(directory)
     self.set_filename(filename)
       
-    with open(self.path, 'rb') as file:
-      office_file = msoffcrypto.OfficeFile(file)
-      office_file.load_key(password=self.passwd)
-      office_file.decrypt(self.decrypted_workbook)
+    with metrics.timer('epus_stage_seconds', stage='decrypt'):
+      with open(self.path, 'rb') as file:
+        office_file = msoffcrypto.OfficeFile(file)
+        office_file.load_key(password=self.passwd)
+        office_file.decrypt(self.decrypted_workbook)
     
     workbook = pd.ExcelFile(self.decrypted_workbook)
     self.sheet_name_list = workbook.sheet_names
@@ -1189,6 +1954,29 @@ class decrypt_Excel:
   
 #============================================================================
 class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Observation, FHIR_Condition, FHIR_AllergyIntolerance, FHIR_Location, FHIR_Organization, decrypt_Excel):
+
+  # columns of the master data, for the Excel and the CSV loader
+  master_columns = {
+    'emr_no': 'EMR_No',
+    'patient_name': 'Patient_Name',
+    'location_id': 'Location_ID',
+    'nama_location': 'Nama_Location',
+    'organization_id': 'Organization_ID',
+    'practitioner_id_periksa_fisik': 'Practitioner_ID_Periksa_Fisik',
+    'practitioners': [('Practitioner_ID_Anamnesa', 'Nama_Practitioner_Anamnesa'), ('Practitioner_ID_Periksa_Fisik', 'Nama_Practitioner_Periksa_Fisik'), ('Practitioner_ID_Diagnosis', 'Nama_Practitioner_Diagnosis')]
+  }
+
+  csv_master_columns = {
+    'emr_no': 'EMR_No TEXT',
+    'patient_name': 'Nama_Pasien TEXT',
+    'location_id': 'Location_ID TEXT',
+    'nama_location': 'Nama_Location TEXT',
+    'organization_id': 'Organization_ID TEXT',
+    'practitioner_id_periksa_fisik': 'Practitioner_ID_Periksa_Fisik TEXT',
+    'practitioners': [('Practitioner_ID_Anamnesa TEXT', 'Nama_Practitioner_Anamnesa TEXT'), ('Practitioner_ID_Periksa_Fisik TEXT', 'Nama_Practitioner_Periksa_Fisik TEXT'), ('Practitioner_ID_Diagnosis TEXT', 'Nama_Practitioner_Diagnosis TEXT')]
+  }
+
+  csv_df_headers = ['ID_Pendaftaran TEXT', 'EMR_No TEXT', 'Nama_Pasien TEXT', 'Payment_Type TEXT', 'Encounter_Date DATETIME', 'History_Arrived_start_period DATETIME', 'History_Arrived_end_period DATETIME', 'History_Inprogress_start_period DATETIME', 'History_Inprogress_end_period DATETIME', 'History_Finished_start_period DATETIME', 'History_Finished_end_period DATETIME', 'Period_Start DATETIME', 'Period_End DATETIME', 'Location_ID TEXT', 'Nama_Location TEXT', 'Practitioner_ID_Anamnesa TEXT', 'Nama_Practitioner_Anamnesa TEXT', 'Tanggal_Anamnesa DATETIME', 'Keluhan TEXT', 'Alergi TEXT', 'Practitioner_ID_Periksa_Fisik TEXT', 'Nama_Practitioner_Periksa_Fisik TEXT', 'Tanggal_Periksa_Fisik DATETIME', 'Suhu FLOAT', 'Denyut_Nadi INTEGER', 'Nafas INTEGER', 'Sistolik INTEGER', 'Diastolik INTEGER', 'Lingkar_Perut FLOAT', 'Tinggi_Badan DOUBLE', 'Berat_Badan DOUBLE', 'Practitioner_ID_Diagnosis TEXT', 'Nama_Practitioner_Diagnosis TEXT', 'Tanggal_Diagnosis DATETIME', 'ICDX_Primer TEXT', 'Nama_ICDX_Primer TEXT', 'ICDX_Sekunder TEXT', 'Nama_ICDX_Sekunder TEXT', 'Organization_ID TEXT']
   
 #----------------------------------------------------------------------------
   def __init__(self):
@@ -1210,7 +1998,66 @@ class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Obser
     FHIR_AllergyIntolerance._set_method(method)
     
 #-------------------------------------------------------------------
-  def json_to_fhir(self, data=dict()):
+  def visit_lookups(self, data):
+    # the (resource_type, identifier) searches the builders run for this visit
+    id_pendaftaran = self.normalize_identifier(data['id_pendaftaran'])
+    lookups = [
+      ('Patient', data['emr_no']),
+      ('Encounter', id_pendaftaran),
+      ('AllergyIntolerance', id_pendaftaran)
+    ]
+
+    for practitioner_key in ['practitioner_id_anamnesa', 'practitioner_id_periksa_fisik', 'practitioner_id_diagnosis']:
+      if data.get(practitioner_key):
+        lookups.append(('Practitioner', data[practitioner_key]))
+
+    if data.get('practitioner_id_anamnesa') or data.get('practitioner_id_diagnosis'):
+      lookups.append(('Condition', id_pendaftaran))
+
+    if data.get('practitioner_id_periksa_fisik'):
+      for indicator in ['suhu', 'denyut_nadi', 'nafas', 'sistolik', 'diastolik', 'lingkar_perut', 'tinggi_badan', 'berat_badan']:
+        if data.get(indicator):
+          lookups.append(('Observation', id_pendaftaran))
+          break
+
+      if data.get('location_id'):
+        lookups.append(('Location', self.normalize_identifier(data['location_id'])))
+
+      if data.get('organization_id'):
+        lookups.append(('Organization', self.normalize_identifier(data['organization_id'])))
+
+    # master data registered earlier in the run is not searched again
+    return [lookup for lookup in lookups if lookup not in self.master_registry]
+
+#-------------------------------------------------------------------
+  def normalize_visit(self, data):
+    # the lookups of the visit and the identifiers normalized on the way, for build_bundle_entries
+    self.identifier_cache = dict()
+    try:
+      return self.visit_lookups(data), self.identifier_cache
+    finally:
+      self.identifier_cache = None
+
+#-------------------------------------------------------------------
+  def build_bundle_entries(self, data=dict(), lookup_cache=None, identifier_cache=None):
+    # one batch round trip answers every builder lookup of the visit,
+    # and the identifiers are normalized once for the lookups and the builders;
+    # epus_Pipeline hands in what its normalize and prefetch stages already did
+    self.identifier_cache = dict() if identifier_cache is None else identifier_cache
+    try:
+      if lookup_cache is None:
+        self.prefetch_resources_by_identifier(self.visit_lookups(data))
+      else:
+        self.lookup_cache = lookup_cache
+
+      with metrics.timer('epus_stage_seconds', stage='build'):
+        return self.resolve_registered_entries(self.__build_bundle_entries(data))
+    finally:
+      self.lookup_cache     = dict()
+      self.identifier_cache = None
+
+#-------------------------------------------------------------------
+  def __build_bundle_entries(self, data=dict()):
     id_pendaftaran                  = data['id_pendaftaran']
     emr_no                          = data['emr_no']
     patient_name                    = data['patient_name']
@@ -1355,94 +2202,233 @@ class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Obser
       json_condition_diagnosis    = FHIR_Condition.get_updated_json(self, 'diagnosis', id_pendaftaran, tanggal_diagnosis, patient_name, nama_practitioner_diagnosis, icdx_primer=icdx_primer, nama_icdx_primer=nama_icdx_primer, icdx_sekunder=icdx_sekunder, nama_icdx_sekunder=nama_icdx_sekunder)
       json_data.append(json_practitioner_diagnosis)
       json_data.append(json_condition_diagnosis)
-     
-    if not self.testing:
-      self.post_bundle_transaction(json_data)
-    
-    if self.debug:
-#      time.sleep(self.delay)
-      print('  === JSON REQUEST ==========')
-      print(json.dumps(json_data, indent=2))
-      print('  === JSON RESOURCES ========')
-      response, reference = self.get_resource_by_identifier('Patient', emr_no)
-      if response: print(response)
-      
-      if practitioner_id_anamnesa:
-        response, reference = self.get_resource_by_identifier('Practitioner', practitioner_id_anamnesa)
-        if response: print(response)
-      
-      if practitioner_id_periksa_fisik:
-        response, reference = self.get_resource_by_identifier('Practitioner', practitioner_id_periksa_fisik)
-        if response: print(response)
 
-      if practitioner_id_diagnosis:
-        response, reference = self.get_resource_by_identifier('Practitioner', practitioner_id_diagnosis)
-        if response: print(response)
+    return json_data
 
-      if suhu:
-        response, reference = self.get_resource_by_identifier('Observation', f'{id_pendaftaran}-suhu')
-        if response: print(response)
+#-------------------------------------------------------------------
+  def master_data_from_dataframes(self, dataframes, columns, limit=0):
+    # the distinct patients, practitioners, locations and organizations of whole sheets,
+    # as (resource_type, identifier, builder arguments); the last name seen for an id wins
+    frames = []
+    for df in dataframes:
+      if limit > 0: df = df[0:limit]
+      frames.append(df.replace(np.nan, ''))
 
-      if denyut_nadi:
-        response, reference = self.get_resource_by_identifier('Observation', f'{id_pendaftaran}-denyut_nadi')
-        if response: print(response)
+    if not frames: return []
 
-      if nafas:
-        response, reference = self.get_resource_by_identifier('Observation', f'{id_pendaftaran}-nafas')
-        if response: print(response)
+    df = pd.concat(frames, ignore_index=True)
+    practitioner_columns = [column for pair in columns['practitioners'] for column in pair]
+    if not set(practitioner_columns + [column for key, column in columns.items() if key != 'practitioners']) <= set(df.columns):
+      log_row.warning('master data columns not found, no pre-sync')
+      return []
 
-      if sistolik:
-        response, reference = self.get_resource_by_identifier('Observation', f'{id_pendaftaran}-sistolik')
-        if response: print(response)
+    masters = dict()
+    patients = df[[columns['emr_no'], columns['patient_name']]].drop_duplicates(columns['emr_no'], keep='last')
+    for emr_no, patient_name in patients.itertuples(index=False):
+      if emr_no: masters[('Patient', emr_no)] = (emr_no, patient_name)
 
-      if diastolik:
-        response, reference = self.get_resource_by_identifier('Observation', f'{id_pendaftaran}-diastolik')
-        if response: print(response)
+    practitioners = pd.concat([df[[id_column, name_column]].set_axis(['id', 'name'], axis=1) for id_column, name_column in columns['practitioners']])
+    for practitioner_id, nama_practitioner in practitioners.drop_duplicates('id', keep='last').itertuples(index=False):
+      if practitioner_id: masters[('Practitioner', practitioner_id)] = (practitioner_id, nama_practitioner)
 
-      if lingkar_perut:
-        response, reference = self.get_resource_by_identifier('Observation', f'{id_pendaftaran}-lingkar_perut')
-        if response: print(response)
+    # the visits only write Location and Organization when there is a physical examination
+    examined  = df[df[columns['practitioner_id_periksa_fisik']] != '']
+    locations = examined[[columns['location_id'], columns['nama_location']]].drop_duplicates(columns['location_id'], keep='last')
+    for location_id, nama_location in locations.itertuples(index=False):
+      if location_id: masters[('Location', self.normalize_identifier(location_id))] = (location_id, nama_location)
 
-      if tinggi_badan:
-        response, reference = self.get_resource_by_identifier('Observation', f'{id_pendaftaran}-tinggi_badan')
-        if response: print(response)
+    for organization_id in examined[columns['organization_id']].unique():
+      if organization_id: masters[('Organization', self.normalize_identifier(organization_id))] = (organization_id,)
 
-      if berat_badan:
-        response, reference = self.get_resource_by_identifier('Observation', f'{id_pendaftaran}-berat_badan')
-        if response: print(response)
+    return [(resource_type, identifier, args) for (resource_type, identifier), args in masters.items()]
 
-      response, reference = self.get_resource_by_identifier('Encounter', id_pendaftaran)
-      if response: print(response)
-      
-      for element in alergi_list:
-        element = element.capitalize()
-        response, reference = self.get_resource_by_identifier('AllergyIntolerance', f'{id_pendaftaran}-{element}')
-        if response: print(response)
+#-------------------------------------------------------------------
+  def build_master_entry(self, resource_type, args):
+    if resource_type == 'Patient'     : return FHIR_Patient.get_updated_json(self, *args)
+    if resource_type == 'Practitioner': return FHIR_Practitioner.get_updated_json(self, 'presync', *args)
+    if resource_type == 'Location'    : return FHIR_Location.get_updated_json(self, *args)
+    if resource_type == 'Organization': return FHIR_Organization.get_updated_json(self, *args)
 
-      response, reference = self.get_resource_by_identifier('Condition', id_pendaftaran)
-      if response: print(response)
+#-------------------------------------------------------------------
+  def presync_master_data(self, masters, bundle_size=200):
+    # phase one: every distinct master resource in a few transaction bundles, the registry keeps
+    # their references so the visits of phase two only carry clinical resources
+    if self.testing and not self.offline: return
+
+    masters = [master for master in masters if master[:2] not in self.master_registry]
+    with tracer.span('presync', {'epus.masters': len(masters)}):
+      start = 0
+      while start < len(masters):
+        # one entry per master, the tuner's limit when there is one
+        chunk  = masters[start:start + (self.bundle_tuner.entries_limit() if self.bundle_tuner else bundle_size)]
+        start += len(chunk)
+        try:
+          self.prefetch_resources_by_identifier([master[:2] for master in chunk])
+          entries = []
+          for resource_type, identifier, args in chunk:
+            entry = self.build_master_entry(resource_type, args)
+            if 'request' not in entry: continue
+
+            entry['fullUrl'] = f'urn:uuid:master_{len(entries)}'
+            entries.append(entry)
+
+          if not entries: continue
+          if self.offline:
+            self.write_offline_bundle(entries)
+            continue
+
+          response_json = self.post_bundle_transaction(entries)
+          self.register_master_entries(entries, response_json)
+
+        except Exception as e:
+          # nothing lost, the visits write what is missing inline
+          log_request.warning('master data bundle of %s resources failed: %s', len(chunk), e)
+
+        finally:
+          self.lookup_cache = dict()
+
+    log_request.info('pre-sync of %s master resources, %s registered', len(masters), len(self.master_registry))
 
-      response, reference = self.get_resource_by_identifier('Location', location_id)
-      if response: print(response)
-      
-      if organization_id:
-        response, reference = self.get_resource_by_identifier('Organization', organization_id)
-        if response: print(response)
+#-------------------------------------------------------------------
+  def json_to_fhir(self, data=dict()):
+    # 'ok' once the server took the visit (or testing / offline), 'parked' when it waits in the spool
+    with tracer.span('visit', {'epus.id_pendaftaran': data['id_pendaftaran'], 'epus.emr_no': data['emr_no']}):
+      return self.__json_to_fhir(data)
+
+#-------------------------------------------------------------------
+  def __json_to_fhir(self, data=dict()):
+    self.offline_request_count = 0
+    self.visit_entries         = None
+    build_start = time.perf_counter()
+    try:
+      json_data = self.build_bundle_entries(data)
+    except Exception as e:
+      if self.offline or not self.park_visit(data, None, e): raise
+      return 'parked'
+
+    build_time         = time.perf_counter() - build_start
+    self.visit_entries = json_data
+
+    if self.offline:
+      self.write_offline_bundle(json_data)
+      self.print_offline_report(data['id_pendaftaran'], json_data, build_time)
+    elif not self.testing and self.spool is not None and not self.park_only:
+      self.spool.append(data, json_data)
+      return 'parked'
+    elif not self.testing:
+      try:
+        json_data, response_json = self.post_visit(data, json_data)
+      except Exception as e:
+        if not self.park_visit(data, json_data, e): raise
+        return 'parked'
+
+      self.register_master_entries(json_data, response_json)
+    
+    if self.debug:
+      self.print_debug_resources(data, json_data)
+
+    return 'ok'
+
+#-------------------------------------------------------------------
+  def post_visit(self, data, json_data):
+    try:
+      for retry in range(self.max_conflict_retries + 1):
+        try:
+          return json_data, self.post_bundle_transaction(json_data)
+        except FHIR_Version_Conflict:
+          # somebody else wrote in between: read the current versions, merge again and retry
+          if retry == self.max_conflict_retries: raise
+          metrics.inc('epus_version_conflict_total')
+          log_request.warning('version conflict on %s, merge again', data['id_pendaftaran'])
+          self.forget_written_entries(json_data)
+          json_data = self.build_bundle_entries(data)
+    finally:
+      self.conflict_reads.clear()
+
+#-------------------------------------------------------------------
+  def collect_visit(self, data):
+    # one row of a loader, a failed visit goes to the dead-letter store and the loop goes on
+    try:
+      self.json_to_fhir(data)
+    except Exception as e:
+      if self.dead_letter is None: raise
+      self.dead_letter.add(data, self.visit_entries, e)
+
+#-------------------------------------------------------------------
+  def print_debug_resources(self, data, json_data):
+    # the readback only feeds the debug log, skip the round trip when nobody reads it
+    if not log_debug.isEnabledFor(logging.DEBUG): return
+
+    id_pendaftaran                = self.normalize_identifier(data['id_pendaftaran'])
+    emr_no                        = data['emr_no']
+    location_id                   = self.normalize_identifier(data.get('location_id', ''))
+    alergi_list                   = data.get('alergi', '').split('|')
+    practitioner_id_anamnesa      = data.get('practitioner_id_anamnesa', '')
+    practitioner_id_periksa_fisik = data.get('practitioner_id_periksa_fisik', '')
+    practitioner_id_diagnosis     = data.get('practitioner_id_diagnosis', '')
+    suhu                          = data.get('suhu', '')
+    denyut_nadi                   = data.get('denyut_nadi', '')
+    nafas                         = data.get('nafas', '')
+    sistolik                      = data.get('sistolik', '')
+    diastolik                     = data.get('diastolik', '')
+    lingkar_perut                 = data.get('lingkar_perut', '')
+    tinggi_badan                  = data.get('tinggi_badan', '')
+    berat_badan                   = data.get('berat_badan', '')
+    organization_id               = self.normalize_identifier(data.get('organization_id', ''))
+
+#    time.sleep(self.delay)
+    log_debug.debug('request %s', id_pendaftaran, extra={'fields': {'bundle': json_data}})
+    reads = [('Patient', emr_no)]
+    
+    if practitioner_id_anamnesa     : reads.append(('Practitioner', practitioner_id_anamnesa))
+    if practitioner_id_periksa_fisik: reads.append(('Practitioner', practitioner_id_periksa_fisik))
+    if practitioner_id_diagnosis    : reads.append(('Practitioner', practitioner_id_diagnosis))
+    if suhu                         : reads.append(('Observation', f'{id_pendaftaran}-suhu'))
+    if denyut_nadi                  : reads.append(('Observation', f'{id_pendaftaran}-denyut_nadi'))
+    if nafas                        : reads.append(('Observation', f'{id_pendaftaran}-nafas'))
+    if sistolik                     : reads.append(('Observation', f'{id_pendaftaran}-sistolik'))
+    if diastolik                    : reads.append(('Observation', f'{id_pendaftaran}-diastolik'))
+    if lingkar_perut                : reads.append(('Observation', f'{id_pendaftaran}-lingkar_perut'))
+    if tinggi_badan                 : reads.append(('Observation', f'{id_pendaftaran}-tinggi_badan'))
+    if berat_badan                  : reads.append(('Observation', f'{id_pendaftaran}-berat_badan'))
+
+    reads.append(('Encounter', id_pendaftaran))
+    
+    for element in alergi_list:
+      element = element.capitalize()
+      reads.append(('AllergyIntolerance', f'{id_pendaftaran}-{element}'))
+
+    reads.append(('Condition', id_pendaftaran))
+    reads.append(('Location', location_id))
+    
+    if organization_id:
+      reads.append(('Organization', organization_id))
+
+    for response, reference in self.get_resources_batch(reads):
+      if response: log_debug.debug('resource %s', reference, extra={'fields': {'resource': response}})
 
 #----------------------------------------------------------------------------
-  def collect_from_excel(self, directory='', filename='', limit=0):
+  def read_excel_dataframes(self, directory='', filename=''):
+    load_dataframe_modules()
     self.open_excel_file(directory, filename)
     for sheet_name in self.sheet_name_list:
-      df = pd.read_excel(self.decrypted_workbook, sheet_name=sheet_name)
+      with metrics.timer('epus_stage_seconds', stage='parse'):
+        df = pd.read_excel(self.decrypted_workbook, sheet_name=sheet_name)
+
+      yield df
+
+#----------------------------------------------------------------------------
+  def iter_excel_data(self, directory='', filename='', limit=0, dataframes=None):
+    load_dataframe_modules()
+    if dataframes is None: dataframes = self.read_excel_dataframes(directory, filename)
+    for df in dataframes:
       df_headers = df.columns.values.tolist()
       if not self.df_headers:
-        print(df_headers)
+        log_row.info('headers %s', df_headers)
         break
 
       if self.df_headers != df_headers:
-        print('Warning: header not matches!')
-
-      print('{no}|{id_pendaftaran}|{emr_no}|{patient_name}|{payment_type}|{encounter_date}|{history_arrived_start_period}|{history_arrived_end_period}|{history_inprogress_start_period}|{history_inprogress_end_period}|{history_finished_start_period}|{history_finished_end_period}|{period_start}|{period_end}|{location_id}|{nama_location}|{practitioner_id_anamnesa}|{nama_practitioner_anamnesa}|{tanggal_anamnesa}|{keluhan}|{alergi}|{practitioner_id_periksa_fisik}|{nama_practitioner_periksa_fisik}|{tanggal_periksa_fisik}|{suhu}|{denyut_nadi}|{nafas}|{sistolik}|{diastolik}|{lingkar_perut}|{tinggi_badan}|{berat_badan}|{practitioner_id_diagnosis}|{nama_practitioner_diagnosis}|{tanggal_diagnosis}|{icdx_primer}|{nama_icdx_primer}|{icdx_sekunder}|{nama_icdx_sekunder}|{organization_id}')
+        log_row.warning('header not matches!')
 
       if df.empty: return
 
@@ -1490,8 +2476,6 @@ class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Obser
         nama_icdx_sekunder              = row['Nama_ICDX_Sekunder']
         organization_id                 = row['Organization_ID']
         
-        print(f'{no}|{id_pendaftaran}|{emr_no}|{patient_name}|{payment_type}|{encounter_date}|{history_arrived_start_period}|{history_arrived_end_period}|{history_inprogress_start_period}|{history_inprogress_end_period}|{history_finished_start_period}|{history_finished_end_period}|{period_start}|{period_end}|{location_id}|{nama_location}|{practitioner_id_anamnesa}|{nama_practitioner_anamnesa}|{tanggal_anamnesa}|{keluhan}|{alergi}|{practitioner_id_periksa_fisik}|{nama_practitioner_periksa_fisik}|{tanggal_periksa_fisik}|{suhu}|{denyut_nadi}|{nafas}|{sistolik}|{diastolik}|{lingkar_perut}|{tinggi_badan}|{berat_badan}|{practitioner_id_diagnosis}|{nama_practitioner_diagnosis}|{tanggal_diagnosis}|{icdx_primer}|{nama_icdx_primer}|{icdx_sekunder}|{nama_icdx_sekunder}|{organization_id}')
-
         if encounter_date                 : encounter_date                  = encounter_date.strftime('%Y-%m-%dT%H:%M:%S')
         if tanggal_anamnesa               : tanggal_anamnesa                = tanggal_anamnesa.strftime('%Y-%m-%dT%H:%M:%S')
         if tanggal_diagnosis              : tanggal_diagnosis               = tanggal_diagnosis.strftime('%Y-%m-%dT%H:%M:%S')
@@ -1546,11 +2530,25 @@ class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Obser
         data['nama_icdx_sekunder']              = nama_icdx_sekunder
         data['organization_id']                 = organization_id
         
-        self.json_to_fhir(data)
+        metrics.inc('epus_rows_total', source='excel')
+        if log_row.isEnabledFor(logging.DEBUG):
+          log_row.debug('row %s %s', no, id_pendaftaran, extra={'fields': dict(data)})
+
+        yield data
+
+#----------------------------------------------------------------------------
+  def collect_from_excel(self, directory='', filename='', limit=0, presync=True):
+    dataframes = None
+    if presync:
+      dataframes = list(self.read_excel_dataframes(directory, filename))
+      self.presync_master_data(self.master_data_from_dataframes(dataframes, self.master_columns, limit))
+
+    for data in self.iter_excel_data(directory, filename, limit, dataframes):
+      self.collect_visit(data)
         
 #----------------------------------------------------------------------------
   def reformat_datetime(self, datetime_str):
-    rdatetime = re.search(r'^(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2})$', datetime_str)
+    rdatetime = re_datetime.match(datetime_str)
     if rdatetime:
       mydate = rdatetime.group(1)
       mytime = rdatetime.group(2)
@@ -1560,19 +2558,25 @@ class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Obser
     return datetime_str
 
 #----------------------------------------------------------------------------
-  def collect_from_csv(self, directory='', filename='', limit=0):
-    self.df_headers = ['ID_Pendaftaran TEXT', 'EMR_No TEXT', 'Nama_Pasien TEXT', 'Payment_Type TEXT', 'Encounter_Date DATETIME', 'History_Arrived_start_period DATETIME', 'History_Arrived_end_period DATETIME', 'History_Inprogress_start_period DATETIME', 'History_Inprogress_end_period DATETIME', 'History_Finished_start_period DATETIME', 'History_Finished_end_period DATETIME', 'Period_Start DATETIME', 'Period_End DATETIME', 'Location_ID TEXT', 'Nama_Location TEXT', 'Practitioner_ID_Anamnesa TEXT', 'Nama_Practitioner_Anamnesa TEXT', 'Tanggal_Anamnesa DATETIME', 'Keluhan TEXT', 'Alergi TEXT', 'Practitioner_ID_Periksa_Fisik TEXT', 'Nama_Practitioner_Periksa_Fisik TEXT', 'Tanggal_Periksa_Fisik DATETIME', 'Suhu FLOAT', 'Denyut_Nadi INTEGER', 'Nafas INTEGER', 'Sistolik INTEGER', 'Diastolik INTEGER', 'Lingkar_Perut FLOAT', 'Tinggi_Badan DOUBLE', 'Berat_Badan DOUBLE', 'Practitioner_ID_Diagnosis TEXT', 'Nama_Practitioner_Diagnosis TEXT', 'Tanggal_Diagnosis DATETIME', 'ICDX_Primer TEXT', 'Nama_ICDX_Primer TEXT', 'ICDX_Sekunder TEXT', 'Nama_ICDX_Sekunder TEXT', 'Organization_ID TEXT']
+  def read_csv_dataframe(self, directory='', filename=''):
+    load_dataframe_modules()
     path = directory + filename
-    df = pd.read_csv(path, sep=',', quotechar="'", quoting=2, na_values="NULL", on_bad_lines="warn")
+    with metrics.timer('epus_stage_seconds', stage='parse'):
+      return pd.read_csv(path, sep=',', quotechar="'", quoting=2, na_values="NULL", on_bad_lines="warn")
+
+#----------------------------------------------------------------------------
+  def iter_csv_data(self, directory='', filename='', limit=0, df=None):
+    self.df_headers = self.csv_df_headers
+    load_dataframe_modules()
+    if df is None: df = self.read_csv_dataframe(directory, filename)
+
     df_headers = df.columns.values.tolist()
     if not self.df_headers:
-      print(df_headers)
+      log_row.info('headers %s', df_headers)
       return
 
     if self.df_headers != df_headers:
-      print('Warning: header not matches!')
-
-    print('{no}|{id_pendaftaran}|{emr_no}|{patient_name}|{payment_type}|{encounter_date}|{history_arrived_start_period}|{history_arrived_end_period}|{history_inprogress_start_period}|{history_inprogress_end_period}|{history_finished_start_period}|{history_finished_end_period}|{period_start}|{period_end}|{location_id}|{nama_location}|{practitioner_id_anamnesa}|{nama_practitioner_anamnesa}|{tanggal_anamnesa}|{keluhan}|{alergi}|{practitioner_id_periksa_fisik}|{nama_practitioner_periksa_fisik}|{tanggal_periksa_fisik}|{suhu}|{denyut_nadi}|{nafas}|{sistolik}|{diastolik}|{lingkar_perut}|{tinggi_badan}|{berat_badan}|{practitioner_id_diagnosis}|{nama_practitioner_diagnosis}|{tanggal_diagnosis}|{icdx_primer}|{nama_icdx_primer}|{icdx_sekunder}|{nama_icdx_sekunder}|{organization_id}')
+      log_row.warning('header not matches!')
 
     if df.empty: return
 
@@ -1620,8 +2624,6 @@ class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Obser
       nama_icdx_sekunder              = row['Nama_ICDX_Sekunder TEXT']
       organization_id                 = row['Organization_ID TEXT']
       
-      print(f'{no}|{id_pendaftaran}|{emr_no}|{patient_name}|{payment_type}|{encounter_date}|{history_arrived_start_period}|{history_arrived_end_period}|{history_inprogress_start_period}|{history_inprogress_end_period}|{history_finished_start_period}|{history_finished_end_period}|{period_start}|{period_end}|{location_id}|{nama_location}|{practitioner_id_anamnesa}|{nama_practitioner_anamnesa}|{tanggal_anamnesa}|{keluhan}|{alergi}|{practitioner_id_periksa_fisik}|{nama_practitioner_periksa_fisik}|{tanggal_periksa_fisik}|{suhu}|{denyut_nadi}|{nafas}|{sistolik}|{diastolik}|{lingkar_perut}|{tinggi_badan}|{berat_badan}|{practitioner_id_diagnosis}|{nama_practitioner_diagnosis}|{tanggal_diagnosis}|{icdx_primer}|{nama_icdx_primer}|{icdx_sekunder}|{nama_icdx_sekunder}|{organization_id}')
-
       if encounter_date : encounter_date = datetime.strptime(encounter_date, '%Y-%m-%d %H:%M:%S')
       if tanggal_anamnesa               : tanggal_anamnesa                = datetime.strptime(tanggal_anamnesa, '%Y-%m-%d %H:%M:%S')
       if tanggal_diagnosis              : tanggal_diagnosis               = datetime.strptime(tanggal_diagnosis, '%Y-%m-%d %H:%M:%S')
@@ -1676,16 +2678,30 @@ class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Obser
       data['nama_icdx_sekunder']              = nama_icdx_sekunder
       data['organization_id']                 = organization_id
       
-      self.json_to_fhir(data)
+      metrics.inc('epus_rows_total', source='csv')
+      if log_row.isEnabledFor(logging.DEBUG):
+        log_row.debug('row %s %s', no, id_pendaftaran, extra={'fields': dict(data)})
+
+      yield data
+
+#----------------------------------------------------------------------------
+  def collect_from_csv(self, directory='', filename='', limit=0, presync=True):
+    df = None
+    if presync:
+      df = self.read_csv_dataframe(directory, filename)
+      self.presync_master_data(self.master_data_from_dataframes([df], self.csv_master_columns, limit))
+
+    for data in self.iter_csv_data(directory, filename, limit, df):
+      self.collect_visit(data)
   
 #-------------------------------------------------------------------
-  def collect_from_request(self, request):
-    request_json = request.get_json(silent=True)
+  def request_json_to_data(self, request_json):
     data = dict()
     data['id_pendaftaran']                  = request_json['ID_Pendaftaran']
     data['emr_no']                          = request_json['EMR_No']
     data['patient_name']                    = request_json['Patient_Name']
-    data['payment_type']                    = request_json['Encounter_Date']
+    data['payment_type']                    = request_json.get('Payment_Type', '')
+    data['encounter_date']                  = request_json['Encounter_Date']
     data['history_arrived_start_period']    = request_json['History_Arrived_start_period']
     data['history_arrived_end_period']      = request_json['History_Arrived_end_period']
     data['history_inprogress_start_period'] = request_json['History_Inprogress_start_period']
@@ -1710,18 +2726,202 @@ class epus_Kunjungan(FHIR_Patient, FHIR_Practitioner, FHIR_Encounter, FHIR_Obser
     data['sistolik']                        = request_json['Sistolik']
     data['diastolik']                       = request_json['Diastolik']
     data['lingkar_perut']                   = request_json['Lingkar_Perut']
+    data['tinggi_badan']                    = request_json.get('Tinggi_Badan', '')
+    data['berat_badan']                     = request_json.get('Berat_Badan', '')
+    data['practitioner_id_diagnosis']       = request_json.get('Practitioner_ID_Diagnosis', '')
+    data['nama_practitioner_diagnosis']     = request_json.get('Nama_Practitioner_Diagnosis', '')
+    data['tanggal_diagnosis']               = request_json.get('Tanggal_Diagnosis', '')
+    data['icdx_primer']                     = request_json.get('ICDX_Primer', '')
     data['nama_icdx_primer']                = request_json['Nama_ICDX_Primer']
     data['icdx_sekunder']                   = request_json['ICDX_Sekunder']
     data['nama_icdx_sekunder']              = request_json['Nama_ICDX_Sekunder']
     data['organization_id']                 = request_json['Organization_ID']
 
+    return data
+
+#-------------------------------------------------------------------
+  def collect_from_request(self, request):
+    request_json = request.get_json(silent=True)
+    data = self.request_json_to_data(request_json)
+
     self.json_to_fhir(data)
 
+#-------------------------------------------------------------------
+  def iter_request_records(self, stream, chunk_size=65536):
+    # yields (request_json, error) from a JSON array or NDJSON body without reading it all first
+    decoder  = json.JSONDecoder()
+    utf8     = codecs.getincrementaldecoder('utf-8')()
+    buffer   = ''
+    in_array = None
+    expect   = 'first'
+    eof      = False
+
+    record_lines = ''
+    while not eof:
+      chunk = stream.read(chunk_size)
+      eof   = not chunk
+      buffer += utf8.decode(chunk or b'', final=eof) if not isinstance(chunk, str) else chunk
+
+      if in_array is None:
+        buffer = buffer.lstrip()
+        if not buffer: continue
+
+        in_array = buffer[0] == '['
+        if in_array: buffer = buffer[1:]
+
+      if not in_array:
+        lines  = buffer.split('\n')
+        buffer = '' if eof else lines.pop()
+        for line in lines:
+          if not line.strip(): continue
+
+          # a record spread over several lines is one record, unless a line is a record on its own
+          if record_lines:
+            record, error = self.decode_json(line)
+            if not error:
+              record_lines = ''
+              yield None, 'invalid JSON: unterminated record'
+              yield record, ''
+              continue
+
+          record, error = self.decode_json(record_lines + line)
+          if not error:
+            record_lines = ''
+            yield record, ''
+            continue
+
+          end, depth = self.json_scan(record_lines + line)
+          if end is None and depth != 0:
+            record_lines += line + '\n'
+            continue
+
+          record_lines = ''
+          yield None, error
+
+        continue
+
+      # expect: 'first' right after [, 'value' after a comma, 'separator' after a value
+      pos = 0
+      while True:
+        pos = re_whitespace.match(buffer, pos).end()
+        if pos == len(buffer): break
+
+        if buffer[pos] == ']':
+          if expect == 'value': yield None, 'invalid JSON: comma before ]'
+          return
+
+        if expect == 'separator':
+          if buffer[pos] == ',':
+            pos, expect = pos + 1, 'value'
+            continue
+
+          error = 'invalid JSON: expected , or ] after a record'
+        else:
+          try:
+            record, end = decoder.raw_decode(buffer, pos)
+          except json.JSONDecodeError as e:
+            error = f'invalid JSON: {e}'
+          else:
+            # a value that ends with the buffer might go on in the next chunk
+            if end == len(buffer) and not eof: break
+
+            pos, expect = end, 'separator'
+            yield record, ''
+            continue
+
+        # a broken element is reported once and skipped up to the , or ] that ends it;
+        # an element that only ends in a later chunk is waited for
+        end, depth = self.json_scan(buffer, pos)
+        if end is None and not eof: break
+
+        yield None, error
+        if end is None: return
+        pos, expect = end, 'separator'
+
+      buffer = buffer[pos:]
+
+    if in_array:
+      yield None, 'invalid JSON: unterminated array'
+    elif record_lines:
+      yield None, 'invalid JSON: unterminated record'
+
+#-------------------------------------------------------------------
+  def decode_json(self, text):
+    try:
+      return json.loads(text), ''
+    except json.JSONDecodeError as e:
+      return None, f'invalid JSON: {e}'
+
+#-------------------------------------------------------------------
+  def json_scan(self, text, pos=0):
+    # (position of the first , or ] outside any object, array or string, nesting depth at the end
+    # of text); the position is None when there is none, the depth None inside an unfinished string
+    depth = 0
+    for token in re_json_token.finditer(text, pos):
+      if token.lastgroup == 'open': return None, None
+      if token.lastgroup == 'string': continue
+
+      value = token.group()
+      if value in '{[':
+        depth += 1
+      elif depth == 0 and value in ',]':
+        return token.start(), 0
+      elif value in '}]':
+        depth = max(0, depth - 1)
+
+    return None, depth
+
+#-------------------------------------------------------------------
+  def iter_request_data(self, stream):
+    for request_json, error in self.iter_request_records(stream):
+      if not error and not isinstance(request_json, dict):
+        error = 'expected a JSON object'
+
+      if error:
+        yield None, error
+        continue
+
+      try:
+        yield self.request_json_to_data(request_json), ''
+      except KeyError as e:
+        yield None, f'missing field {e}'
+
+#-------------------------------------------------------------------
+  def collect_from_data(self, data_list):
+    # one status per row, a bad row is reported and the rest keeps going
+    for no, (data, error) in enumerate(data_list, 1):
+      status = {
+        'no': no,
+        'id_pendaftaran': data['id_pendaftaran'] if data else '',
+        'status': 'ok'
+      }
+
+      if not error:
+        try:
+          status['status'] = self.json_to_fhir(data)
+        except Exception as e:
+          error = str(e)
+          if self.dead_letter: self.dead_letter.add(data, self.visit_entries, e)
+
+      if error:
+        status['status'] = 'error'
+        status['error']  = error
+
+      yield status
+
+#-------------------------------------------------------------------
+  def collect_from_bulk_request(self, request):
+    return self.collect_from_data(self.iter_request_data(request.stream))
+
 #===========================================================================
 if __name__ == '__main__':
+  setup_logging('INFO', levels={'build': 'DEBUG'})
   epus_Kunjungan_Garut = epus_Kunjungan()
   epus_Kunjungan_Garut.testing = False
   epus_Kunjungan_Garut.debug   = False
+#  epus_Kunjungan_Garut.set_offline('dry_run/20241017_bundles.ndjson', 'dry_run/snapshot.ndjson')
 #  epus_Kunjungan_Garut.collect_from_excel('data/bayongbong_garut/', 'kunjungan_info_1.xls', 3)
   epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv', 3)
 #  epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'pelayanan_non_ranap.csv', 3)
+#  epus_Kunjungan_Garut.close_offline()
+#  metrics.dump('sql_dump/20241017/metrics.prom')
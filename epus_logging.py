@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 19:48:31 2026
+
+@author: anwar
+'''
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+from epus_metrics import metrics
+
+# categories: row (one per loaded row), build (one per resource), request, token,
+# debug (bundles and readback), offline, service, bulk; all under the 'epus' logger
+log_name = 'epus'
+
+#----------------------------------------------------------------------------
+def get_logger(category):
+  return logging.getLogger(f'{log_name}.{category}')
+
+#============================================================================
+class Sample_Filter(logging.Filter):
+  # keeps a fraction of the records below WARNING, warnings and errors always pass
+
+#----------------------------------------------------------------------------
+  def __init__(self, rate):
+    super().__init__()
+    self.rate = rate
+
+#----------------------------------------------------------------------------
+  def filter(self, record):
+    return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+#============================================================================
+class Text_Formatter(logging.Formatter):
+
+#----------------------------------------------------------------------------
+  def __init__(self):
+    super().__init__('%(asctime)s %(levelname)-7s %(name)s: %(message)s')
+
+#----------------------------------------------------------------------------
+  def format(self, record):
+    line   = super().format(record)
+    fields = getattr(record, 'fields', None)
+    if not fields: return line
+
+    values = []
+    for key, value in fields.items():
+      if isinstance(value, (dict, list)):
+        value = json.dumps(value, indent=2, default=str)
+
+      values.append(f'{key}={value}')
+
+    return line + ' ' + ' '.join(values)
+
+
+#============================================================================
+class JSON_Formatter(logging.Formatter):
+
+#----------------------------------------------------------------------------
+  def format(self, record):
+    record_json = {
+      'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+      'level': record.levelname,
+      'logger': record.name,
+      'message': record.getMessage()
+    }
+
+    record_json.update(getattr(record, 'fields', None) or {})
+    if record.exc_text:
+      record_json['exception'] = record.exc_text
+
+    return json.dumps(record_json, default=str)
+
+
+#============================================================================
+class Dropping_Queue_Handler(logging.handlers.QueueHandler):
+  # never blocks the caller: a full queue drops the record and counts it
+
+#----------------------------------------------------------------------------
+  def prepare(self, record):
+    # only the %-merge happens on the calling thread, the formatter runs in the listener
+    record.msg      = record.getMessage()
+    record.args     = None
+    if record.exc_info:
+      record.exc_text = logging.Formatter().formatException(record.exc_info)
+      record.exc_info = None
+
+    return record
+
+#----------------------------------------------------------------------------
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      metrics.inc('epus_log_dropped_total', logger=record.name)
+
+
+listener = None
+
+#----------------------------------------------------------------------------
+def setup_logging(level='INFO', levels=None, sample=None, filename='', json_format=False, queue_size=10000):
+  # levels={'row': 'DEBUG'} and sample={'row': 0.01} are per category
+  global listener
+  stop_logging()
+
+  if filename:
+    handler = logging.FileHandler(filename)
+  else:
+    handler = logging.StreamHandler(sys.stdout)
+
+  handler.setFormatter(JSON_Formatter() if json_format else Text_Formatter())
+
+  logger = logging.getLogger(log_name)
+  for old_handler in list(logger.handlers):
+    logger.removeHandler(old_handler)
+
+  logger.addHandler(Dropping_Queue_Handler(queue.Queue(maxsize=queue_size)))
+  logger.setLevel(level)
+  logger.propagate = False
+
+  for category, category_level in (levels or {}).items():
+    get_logger(category).setLevel(category_level)
+
+  for category, rate in (sample or {}).items():
+    category_logger = get_logger(category)
+    for old_filter in list(category_logger.filters):
+      if isinstance(old_filter, Sample_Filter): category_logger.removeFilter(old_filter)
+
+    category_logger.addFilter(Sample_Filter(rate))
+
+  listener = logging.handlers.QueueListener(logger.handlers[0].queue, handler, respect_handler_level=True)
+  listener.start()
+
+#----------------------------------------------------------------------------
+def stop_logging():
+  # flushes what is still queued
+  global listener
+  if listener is None: return
+
+  listener.stop()
+  for handler in listener.handlers:
+    handler.close()
+
+  listener = None
+
+
+atexit.register(stop_logging)
+
+
+#===========================================================================
+if __name__ == '__main__':
+  from epus_kunjungan import epus_Kunjungan
+
+  setup_logging('INFO', levels={'row': 'DEBUG'}, sample={'row': 0.01}, filename='sql_dump/20241017/epus.log', json_format=True)
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing = False
+  epus_Kunjungan_Garut.debug   = False
+  epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
+  stop_logging()
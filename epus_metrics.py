@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 18:10:52 2026
+
+@author: anwar
+'''
+
+import contextlib
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# get_logger('metrics') of epus_logging, which imports this module
+log_metrics = logging.getLogger('epus.metrics')
+
+#============================================================================
+class epus_Metrics:
+  # seconds; the last bucket is +Inf
+  buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+#----------------------------------------------------------------------------
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+#----------------------------------------------------------------------------
+  def reset(self):
+    with self.lock:
+      self.counters   = dict()
+      self.gauges     = dict()
+      self.histograms = dict()
+
+#----------------------------------------------------------------------------
+  def key(self, name, labels):
+    # label values as text, a status can come as 413 and as 'no_answer' and both must sort
+    return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+#----------------------------------------------------------------------------
+  def inc(self, name, value=1, **labels):
+    key = self.key(name, labels)
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+#----------------------------------------------------------------------------
+  def gauge(self, name, value, **labels):
+    key = self.key(name, labels)
+    with self.lock:
+      self.gauges[key] = value
+
+#----------------------------------------------------------------------------
+  def observe(self, name, seconds, **labels):
+    key = self.key(name, labels)
+    with self.lock:
+      histogram = self.histograms.get(key)
+      if histogram is None:
+        histogram = self.histograms[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+
+      for no, bound in enumerate(self.buckets):
+        if seconds <= bound:
+          histogram['buckets'][no] += 1
+          break
+      else:
+        histogram['buckets'][-1] += 1
+
+      histogram['sum']   += seconds
+      histogram['count'] += 1
+
+#----------------------------------------------------------------------------
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - started, **labels)
+
+#----------------------------------------------------------------------------
+  def escape_label(self, value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+#----------------------------------------------------------------------------
+  def format_labels(self, labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels: return ''
+
+    return '{' + ','.join(f'{key}="{self.escape_label(value)}"' for key, value in labels) + '}'
+
+#----------------------------------------------------------------------------
+  def to_prometheus(self):
+    # text exposition format 0.0.4
+    with self.lock:
+      counters   = sorted(self.counters.items())
+      gauges     = sorted(self.gauges.items())
+      histograms = sorted((key, dict(histogram, buckets=list(histogram['buckets']))) for key, histogram in self.histograms.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+      if name not in typed:
+        lines.append(f'# TYPE {name} counter')
+        typed.add(name)
+
+      lines.append(f'{name}{self.format_labels(labels)} {value}')
+
+    for (name, labels), value in gauges:
+      if name not in typed:
+        lines.append(f'# TYPE {name} gauge')
+        typed.add(name)
+
+      lines.append(f'{name}{self.format_labels(labels)} {value}')
+
+    for (name, labels), histogram in histograms:
+      if name not in typed:
+        lines.append(f'# TYPE {name} histogram')
+        typed.add(name)
+
+      cumulative = 0
+      for bound, count in zip(self.buckets + ('+Inf',), histogram['buckets']):
+        cumulative += count
+        lines.append(f'{name}_bucket{self.format_labels(labels, [("le", bound)])} {cumulative}')
+
+      lines.append(f'{name}_sum{self.format_labels(labels)} {histogram["sum"]:.6f}')
+      lines.append(f'{name}_count{self.format_labels(labels)} {histogram["count"]}')
+
+    return '\n'.join(lines) + '\n'
+
+#----------------------------------------------------------------------------
+  def dump(self, filename):
+    # written next to the run output so node_exporter's textfile collector (or a human) can pick it up
+    with open(filename + '.tmp', 'w') as fout:
+      fout.write(self.to_prometheus())
+
+    os.replace(filename + '.tmp', filename)
+    log_metrics.info('metrics written to %s', filename)
+
+#----------------------------------------------------------------------------
+  def serve(self, host='0.0.0.0', port=9108):
+    handler = type('epus_Metrics_Handler', (Metrics_Handler,), {'metrics': self})
+    server  = ThreadingHTTPServer((host, port), handler)
+    thread  = threading.Thread(target=server.serve_forever, name='epus-metrics', daemon=True)
+    thread.start()
+
+    return server
+
+
+#============================================================================
+class Metrics_Handler(BaseHTTPRequestHandler):
+  metrics = None
+
+#----------------------------------------------------------------------------
+  def log_message(self, format, *args):
+    pass
+
+#----------------------------------------------------------------------------
+  def do_GET(self):
+    if self.path.split('?')[0] != '/metrics':
+      self.send_response(404)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+
+    payload = self.metrics.to_prometheus().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+
+# one registry per process, shared by every epus_Kunjungan and thread
+metrics = epus_Metrics()
+
+
+#===========================================================================
+if __name__ == '__main__':
+  from epus_kunjungan import epus_Kunjungan
+
+  metrics_server = metrics.serve(port=9108)
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing = False
+  epus_Kunjungan_Garut.debug   = False
+  epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
+
+  metrics.dump('sql_dump/20241017/metrics.prom')
+  metrics_server.shutdown()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 21:52:37 2026
+
+@author: anwar
+'''
+
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+
+from epus_metrics import metrics
+from epus_logging import get_logger, setup_logging
+
+log_mirror = get_logger('mirror')
+
+#============================================================================
+class epus_Mirror:
+  # local SQLite copy of the resource types we read over and over, kept current by
+  # _lastUpdated searches and by the transactions of this run (store_written); a type synced
+  # less than max_staleness seconds ago is answered from here, anything else returns None and
+  # the caller asks the server. A stale type is synced on a background thread with auto_sync,
+  # run sync_all() before the load for the first copy.
+  # Deletes on the server are not seen, the mirror only learns about writes
+  mirror_types = ('Patient', 'Practitioner', 'Location', 'Organization', 'Encounter')
+
+#----------------------------------------------------------------------------
+  def __init__(self, client, filename='fhir_mirror.sqlite', max_staleness=300, resource_types=None, page_size=200, auto_sync=True):
+    self.client         = client
+    self.filename       = filename
+    self.max_staleness  = max_staleness
+    self.resource_types = tuple(resource_types or self.mirror_types)
+    self.page_size      = page_size
+    self.auto_sync      = auto_sync
+    self.lock           = threading.RLock()
+    self.sync_lock      = threading.Lock()
+    self.syncing        = set()
+    self.connection     = sqlite3.connect(filename, check_same_thread=False)
+    self.create_tables()
+
+    self.synced_at = {resource_type: synced_at for resource_type, synced_at in self.connection.execute('SELECT type, synced_at FROM sync_state')}
+
+#----------------------------------------------------------------------------
+  def create_tables(self):
+    with self.lock, self.connection:
+      self.connection.executescript('''
+        CREATE TABLE IF NOT EXISTS resources (type TEXT, id TEXT, version_id TEXT, last_updated TEXT, json TEXT, PRIMARY KEY (type, id));
+        CREATE TABLE IF NOT EXISTS identifiers (type TEXT, value TEXT, id TEXT, PRIMARY KEY (type, value, id));
+        CREATE TABLE IF NOT EXISTS refs (reference TEXT, type TEXT, id TEXT, PRIMARY KEY (reference, type, id));
+        CREATE TABLE IF NOT EXISTS sync_state (type TEXT PRIMARY KEY, last_updated TEXT, synced_at REAL);
+      ''')
+
+#----------------------------------------------------------------------------
+  def close(self):
+    with self.lock:
+      self.connection.close()
+
+#----------------------------------------------------------------------------
+  def request(self, url, params=None):
+    # epus_Kunjungan counts and traces its requests, get_resource.FHIR_Base only has the token
+    if hasattr(self.client, 'send_request'):
+      return self.client.send_request('GET', url, params=params)
+
+    response = requests.get(url, params=params, headers=self.client.headers)
+    if response.status_code == 401:
+      self.client.get_and_save_token()
+      response = requests.get(url, params=params, headers=self.client.headers)
+
+    return response
+
+#----------------------------------------------------------------------------
+  def references(self, element, references):
+    if isinstance(element, dict):
+      for key, value in element.items():
+        if key == 'reference' and isinstance(value, str):
+          references.add(value)
+        else:
+          self.references(value, references)
+
+    elif isinstance(element, list):
+      for item in element:
+        self.references(item, references)
+
+    return references
+
+#----------------------------------------------------------------------------
+  def store(self, resources):
+    # upserts and returns the newest meta.lastUpdated of the page
+    last_updated = ''
+    with self.lock, self.connection:
+      for resource in resources:
+        resource_type = resource['resourceType']
+        resource_id   = resource['id']
+        meta          = resource.get('meta', {})
+        last_updated  = max(last_updated, meta.get('lastUpdated', ''))
+
+        self.connection.execute('INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?)', (resource_type, resource_id, meta.get('versionId', ''), meta.get('lastUpdated', ''), json.dumps(resource)))
+        self.connection.execute('DELETE FROM identifiers WHERE type = ? AND id = ?', (resource_type, resource_id))
+        self.connection.execute('DELETE FROM refs WHERE type = ? AND id = ?', (resource_type, resource_id))
+
+        # searched like the server answers identifier=<value> and identifier=<system>|<value>
+        for identifier in resource.get('identifier', []):
+          for value in (identifier.get('value'), f'{identifier.get("system")}|{identifier.get("value")}'):
+            self.connection.execute('INSERT OR IGNORE INTO identifiers VALUES (?, ?, ?)', (resource_type, value, resource_id))
+
+        for reference in self.references(resource, set()):
+          self.connection.execute('INSERT OR IGNORE INTO refs VALUES (?, ?, ?)', (reference, resource_type, resource_id))
+
+    return last_updated
+
+#----------------------------------------------------------------------------
+  def next_link(self, bundle_json):
+    for link in bundle_json.get('link', []):
+      if link.get('relation') == 'next':
+        url = link.get('url', '')
+        return url if '://' in url else self.client.base_url + url
+
+    return ''
+
+#----------------------------------------------------------------------------
+  def sync(self, resource_type):
+    # everything changed since the last sync, ge instead of gt so a page cut between
+    # two writes of the same instant is not lost, the upsert makes the overlap harmless
+    started = time.time()
+    with self.lock:
+      row = self.connection.execute('SELECT last_updated FROM sync_state WHERE type = ?', (resource_type,)).fetchone()
+    last_updated = row[0] if row else ''
+
+    params = {'_sort': '_lastUpdated', '_count': self.page_size}
+    if last_updated: params['_lastUpdated'] = f'ge{last_updated}'
+
+    url   = self.client.base_url + resource_type
+    count = 0
+    with metrics.timer('epus_mirror_sync_seconds', type=resource_type):
+      while url:
+        response = self.request(url, params)
+        if response.status_code != 200:
+          raise Exception(f'Error: {response.status_code} - {response.text}')
+
+        bundle_json  = response.json()
+        resources    = [entry['resource'] for entry in bundle_json.get('entry', []) if 'resource' in entry]
+        last_updated = max(last_updated, self.store(resources))
+        count       += len(resources)
+        url, params  = self.next_link(bundle_json), None
+
+    with self.lock, self.connection:
+      self.connection.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)', (resource_type, last_updated, started))
+
+    self.synced_at[resource_type] = started
+    metrics.inc('epus_mirror_synced_total', count, type=resource_type)
+    log_mirror.info('%s synced, %s resources changed', resource_type, count)
+
+    return count
+
+#----------------------------------------------------------------------------
+  def sync_all(self):
+    for resource_type in self.resource_types:
+      self.sync(resource_type)
+
+#----------------------------------------------------------------------------
+  def is_fresh(self, resource_type):
+    if resource_type not in self.resource_types: return False
+    if time.time() - self.synced_at.get(resource_type, 0) <= self.max_staleness: return True
+
+    if self.auto_sync: self.sync_in_background(resource_type)
+    return False
+
+#----------------------------------------------------------------------------
+  def sync_in_background(self, resource_type):
+    # one sync per type at a time, the lookups go to the server until it is done
+    with self.sync_lock:
+      if resource_type in self.syncing: return
+      self.syncing.add(resource_type)
+
+    threading.Thread(target=self.__background_sync, args=(resource_type,), name=f'epus-mirror-{resource_type}', daemon=True).start()
+
+#----------------------------------------------------------------------------
+  def __background_sync(self, resource_type):
+    try:
+      self.sync(resource_type)
+    except Exception as e:
+      log_mirror.warning('cannot sync %s: %s', resource_type, e)
+    finally:
+      with self.sync_lock:
+        self.syncing.discard(resource_type)
+
+#----------------------------------------------------------------------------
+  def store_written(self, resources):
+    # what a transaction of this run stored, a lookup right after it must not answer from before it
+    resources = [resource for resource in resources if resource.get('resourceType') in self.resource_types]
+    if resources: self.store(resources)
+
+#----------------------------------------------------------------------------
+  def get_resource_by_identifier(self, resource_type, identifier):
+    # (resource, reference) like the server search, ({}, '') when it does not exist, None when stale
+    if not self.is_fresh(resource_type):
+      metrics.inc('epus_mirror_reads_total', type=resource_type, result='stale')
+      return None
+
+    with self.lock:
+      row = self.connection.execute('SELECT r.id, r.json FROM identifiers i JOIN resources r ON r.type = i.type AND r.id = i.id WHERE i.type = ? AND i.value = ? LIMIT 1', (resource_type, str(identifier))).fetchone()
+
+    metrics.inc('epus_mirror_reads_total', type=resource_type, result='hit' if row else 'miss')
+    if not row: return {}, ''
+
+    return json.loads(row[1]), f'{resource_type}/{row[0]}'
+
+#----------------------------------------------------------------------------
+  def get_resource_by_reference(self, reference):
+    # the resource, {} when it does not exist, None when stale
+    resource_type, _, resource_id = reference.partition('/')
+    if not self.is_fresh(resource_type):
+      metrics.inc('epus_mirror_reads_total', type=resource_type, result='stale')
+      return None
+
+    with self.lock:
+      row = self.connection.execute('SELECT json FROM resources WHERE type = ? AND id = ?', (resource_type, resource_id.split('/')[0])).fetchone()
+
+    metrics.inc('epus_mirror_reads_total', type=resource_type, result='hit' if row else 'miss')
+    return json.loads(row[0]) if row else {}
+
+#----------------------------------------------------------------------------
+  def get_referencing_resources(self, reference):
+    # mirrored resources that point at reference, 'Patient/123' -> its Encounters
+    with self.lock:
+      rows = self.connection.execute('SELECT r.json FROM refs f JOIN resources r ON r.type = f.type AND r.id = f.id WHERE f.reference = ?', (reference,)).fetchall()
+
+    return [json.loads(row[0]) for row in rows]
+
+
+#===========================================================================
+if __name__ == '__main__':
+  from epus_kunjungan import epus_Kunjungan
+
+  setup_logging('INFO')
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing = False
+  epus_Kunjungan_Garut.debug   = False
+  epus_Kunjungan_Garut.set_mirror(epus_Mirror(epus_Kunjungan_Garut, 'sql_dump/fhir_mirror.sqlite', max_staleness=600))
+  epus_Kunjungan_Garut.mirror.sync_all()
+  epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 21:14:06 2026
+
+@author: anwar
+'''
+
+import queue
+import threading
+import time
+
+from epus_kunjungan import epus_Kunjungan
+from epus_metrics import metrics
+from epus_logging import get_logger, setup_logging
+
+log_pipeline = get_logger('pipeline')
+
+#============================================================================
+class epus_Pipeline:
+  # source -> normalize -> prefetch -> build -> send, every arrow a bounded queue; the source
+  # (the csv/excel/request loaders) runs on the calling thread, each stage on its own workers.
+  # A full queue blocks the stage before it, epus_pipeline_queue_depth shows where work piles up
+  stages = ('normalize', 'prefetch', 'build', 'send')
+
+#----------------------------------------------------------------------------
+  def __init__(self, kunjungan=None, workers=None, batch_sizes=None, queue_size=100):
+    self.kunjungan   = kunjungan or epus_Kunjungan()
+    self.workers     = dict({'normalize': 1, 'prefetch': 4, 'build': 1, 'send': 4}, **(workers or {}))
+    self.batch_sizes = dict({'normalize': 1, 'prefetch': 10, 'build': 1, 'send': 1}, **(batch_sizes or {}))
+    self.queue_size  = queue_size
+    self.lock        = threading.Lock()
+    self.results     = {'ok': 0, 'error': 0, 'parked': 0}
+    self.remaining   = dict()
+
+    # called with the items of every send that went through, the dead-letter replay resolves them
+    self.on_sent = None
+
+#----------------------------------------------------------------------------
+  def worker_kunjungan(self):
+    # one epus_Kunjungan per worker thread, the master data bookkeeping is shared by all of them
+    return self.kunjungan.worker_copy()
+
+#----------------------------------------------------------------------------
+  def put(self, stage, outbox, next_stage, item):
+    try:
+      outbox.put_nowait(item)
+    except queue.Full:
+      started = time.perf_counter()
+      outbox.put(item)
+      metrics.inc('epus_pipeline_blocked_seconds_total', time.perf_counter() - started, stage=stage)
+
+    metrics.gauge('epus_pipeline_queue_depth', outbox.qsize(), queue=next_stage)
+
+#----------------------------------------------------------------------------
+  def get_batch(self, stage, inbox):
+    # blocks for the first item and takes what else is already waiting, up to the stage's batch size
+    batch_size = self.batch_sizes[stage]
+    if stage == 'send' and self.kunjungan.bundle_tuner: batch_size = max(batch_size, self.kunjungan.bundle_tuner.visit_limit())
+
+    items = [inbox.get()]
+    while items[-1] is not None and len(items) < batch_size:
+      try:
+        items.append(inbox.get_nowait())
+      except queue.Empty:
+        break
+
+    metrics.gauge('epus_pipeline_queue_depth', inbox.qsize(), queue=stage)
+    stopping = items[-1] is None
+    if stopping: items.pop()
+
+    return items, stopping
+
+#----------------------------------------------------------------------------
+  def fail(self, stage, item, error):
+    metrics.inc('epus_pipeline_visits_total', stage=stage, status='error')
+    with self.lock:
+      self.results['error'] += 1
+
+    log_pipeline.error('%s of %s failed: %s', stage, item['data'].get('id_pendaftaran'), error)
+    if self.kunjungan.dead_letter: self.kunjungan.dead_letter.add(item['data'], item.get('entries'), error, stage)
+
+#----------------------------------------------------------------------------
+  def park(self, kunjungan, items, error):
+    # spooled for the drain when the server is unavailable, False when they still have to be failed
+    if kunjungan.spool is None or kunjungan.testing or not kunjungan.is_transient_error(error): return False
+
+    for item in items:
+      kunjungan.park_visit(item['data'], item.get('entries'), error)
+
+    with self.lock:
+      self.results['parked'] += len(items)
+
+    return True
+
+#----------------------------------------------------------------------------
+  def normalize_stage(self, kunjungan, items):
+    for item in items:
+      item['lookups'], item['identifier_cache'] = kunjungan.normalize_visit(item['data'])
+
+    return items
+
+#----------------------------------------------------------------------------
+  def prefetch_stage(self, kunjungan, items):
+    # the lookups of the whole batch go out in one batch bundle
+    try:
+      lookup_cache = kunjungan.fetch_resources_by_identifier([lookup for item in items for lookup in item['lookups']])
+    except Exception as e:
+      # the builders search on their own
+      log_pipeline.warning('prefetch of %s visits failed: %s', len(items), e)
+      lookup_cache = None
+
+    for item in items:
+      item['lookup_cache'] = lookup_cache
+
+    return items
+
+#----------------------------------------------------------------------------
+  def build_stage(self, kunjungan, items):
+    built_items = []
+    for item in items:
+      try:
+        item['entries'] = kunjungan.build_bundle_entries(item['data'], item['lookup_cache'], item['identifier_cache'])
+        built_items.append(item)
+      except Exception as e:
+        if not self.park(kunjungan, [item], e): self.fail('build', item, e)
+
+    return built_items
+
+#----------------------------------------------------------------------------
+  def send_stage(self, kunjungan, items):
+    if kunjungan.offline:
+      with self.lock:
+        for item in items:
+          self.kunjungan.write_offline_bundle(item['entries'])
+
+    elif not kunjungan.testing and kunjungan.spool is not None and not kunjungan.park_only:
+      for item in items:
+        kunjungan.spool.append(item['data'], item['entries'])
+
+    elif not kunjungan.testing:
+      # the tuner cuts the batch into bundles of its size, without one it is one bundle
+      if kunjungan.bundle_tuner:
+        groups = [[items[no] for no in group] for group in kunjungan.bundle_tuner.split([item['entries'] for item in items])]
+      else:
+        groups = [items]
+
+      items = [item for group in groups for item in self.send_bundle(kunjungan, group)]
+
+    if self.on_sent and items: self.on_sent(items)
+
+    metrics.inc('epus_pipeline_visits_total', len(items), stage='send', status='ok')
+    with self.lock:
+      self.results['ok'] += len(items)
+
+    return items
+
+#----------------------------------------------------------------------------
+  def send_bundle(self, kunjungan, items):
+    # the visits of items in one transaction, returns the ones that went through
+    try:
+      if len(items) == 1:
+        combined_entries = items[0]['entries']
+      else:
+        combined_entries = kunjungan.combine_bundle_entries([item['entries'] for item in items])
+
+      response_json = kunjungan.post_bundle_transaction(combined_entries)
+      kunjungan.register_master_entries(combined_entries, response_json)
+    except Exception as e:
+      if self.park(kunjungan, items, e): return []
+
+      # one bad visit fails the whole transaction and a version conflict needs a fresh merge,
+      # json_to_fhir builds and sends them one by one instead
+      log_pipeline.warning('batch of %s visits failed, retry per visit: %s', len(items), e)
+      sent_items = []
+      for item in items:
+        try:
+          status = kunjungan.json_to_fhir(item['data'])
+        except Exception as e:
+          self.fail('send', item, e)
+          continue
+
+        if status == 'ok':
+          sent_items.append(item)
+        else:
+          with self.lock:
+            self.results['parked'] += 1
+
+      return sent_items
+
+    return items
+
+#----------------------------------------------------------------------------
+  def __worker(self, stage, inbox, outbox, next_stage):
+    kunjungan = self.worker_kunjungan()
+    function  = getattr(self, f'{stage}_stage')
+    stopping  = False
+    while not stopping:
+      items, stopping = self.get_batch(stage, inbox)
+      if not items: continue
+
+      try:
+        with metrics.timer('epus_pipeline_stage_seconds', stage=stage):
+          items = function(kunjungan, items)
+      except Exception as e:
+        for item in items:
+          self.fail(stage, item, e)
+        continue
+
+      if outbox is None: continue
+      for item in items:
+        self.put(stage, outbox, next_stage, item)
+
+    # the last worker of a stage passes the end on, once to every worker of the next one
+    with self.lock:
+      self.remaining[stage] -= 1
+      last = self.remaining[stage] == 0
+
+    if last and outbox is not None:
+      for no in range(self.workers[next_stage]):
+        outbox.put(None)
+
+#----------------------------------------------------------------------------
+  def run(self, data_list):
+    queues  = {stage: queue.Queue(maxsize=self.queue_size) for stage in self.stages}
+    threads = []
+    self.results   = {'ok': 0, 'error': 0, 'parked': 0}
+    self.remaining = dict(self.workers)
+    for no, stage in enumerate(self.stages):
+      next_stage = self.stages[no + 1] if no + 1 < len(self.stages) else None
+      outbox     = queues[next_stage] if next_stage else None
+      for worker_no in range(self.workers[stage]):
+        thread = threading.Thread(target=self.__worker, args=(stage, queues[stage], outbox, next_stage), name=f'epus-{stage}-{worker_no}', daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    started = time.perf_counter()
+    try:
+      for data in data_list:
+        self.put('source', queues['normalize'], 'normalize', {'data': data})
+    finally:
+      for no in range(self.workers['normalize']):
+        queues['normalize'].put(None)
+
+      for thread in threads:
+        thread.join()
+
+    log_pipeline.info('%s visits sent, %s parked, %s failed in %.1fs', self.results['ok'], self.results['parked'], self.results['error'], time.perf_counter() - started)
+    return self.results
+
+#----------------------------------------------------------------------------
+  def collect_from_csv(self, directory='', filename='', limit=0, presync=True):
+    df = self.kunjungan.read_csv_dataframe(directory, filename)
+    if presync:
+      self.kunjungan.presync_master_data(self.kunjungan.master_data_from_dataframes([df], self.kunjungan.csv_master_columns, limit))
+
+    return self.run(self.kunjungan.iter_csv_data(directory, filename, limit, df))
+
+#----------------------------------------------------------------------------
+  def collect_from_excel(self, directory='', filename='', limit=0, presync=True):
+    dataframes = list(self.kunjungan.read_excel_dataframes(directory, filename))
+    if presync:
+      self.kunjungan.presync_master_data(self.kunjungan.master_data_from_dataframes(dataframes, self.kunjungan.master_columns, limit))
+
+    return self.run(self.kunjungan.iter_excel_data(directory, filename, limit, dataframes))
+
+
+#===========================================================================
+if __name__ == '__main__':
+  setup_logging('INFO')
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing = False
+  epus_Kunjungan_Garut.debug   = False
+
+  epus_Pipeline_Garut = epus_Pipeline(epus_Kunjungan_Garut, workers={'prefetch': 4, 'send': 4}, batch_sizes={'send': 10})
+  epus_Pipeline_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
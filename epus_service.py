@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 09:12:40 2026
+
+@author: anwar
+'''
+
+import json
+import queue
+import threading
+import time
+
+from epus_kunjungan import epus_Kunjungan
+from epus_metrics import metrics
+from epus_tracing import tracer
+from epus_logging import get_logger, setup_logging
+
+log_service = get_logger('service')
+
+#============================================================================
+class epus_Ingestion_Service:
+
+#----------------------------------------------------------------------------
+  def __init__(self, batch_size=50, max_delay=0.2, workers=4, queue_size=1000, kunjungan=None):
+    self.batch_size = batch_size
+    self.max_delay  = max_delay
+    self.workers    = workers
+    self.testing    = False
+    self.debug      = False
+    self.visits     = queue.Queue(maxsize=queue_size)
+    self.batches    = queue.Queue(maxsize=workers * 2)
+    self.threads    = []
+
+    # settings, token and master data bookkeeping of the service, every worker runs on a worker_copy
+    # of it so master data written by one worker is only referenced by the others
+    self.kunjungan = kunjungan or epus_Kunjungan()
+
+#----------------------------------------------------------------------------
+  def start(self):
+    batcher = threading.Thread(target=self.__batcher, name='epus-batcher', daemon=True)
+    batcher.start()
+    self.threads.append(batcher)
+
+    for no in range(self.workers):
+      worker = threading.Thread(target=self.__worker, name=f'epus-worker-{no}', daemon=True)
+      worker.start()
+      self.threads.append(worker)
+
+#----------------------------------------------------------------------------
+  def stop(self):
+    # the batcher flushes what is left and passes one stop marker to each worker
+    self.visits.put(None)
+    for thread in self.threads:
+      thread.join()
+
+    self.threads = []
+
+#----------------------------------------------------------------------------
+  def submit(self, data, done=None, block=False):
+    # raises queue.Full when the service is saturated and block is False, callers answer 503;
+    # done(data, status, error) is called once the visit is through, status 'ok', 'parked' or 'error'
+    self.visits.put((data, done), block=block)
+    metrics.inc('epus_rows_total', source='request')
+
+#----------------------------------------------------------------------------
+  def __batcher(self):
+    running = True
+    while running:
+      visit = self.visits.get()
+      if visit is None: break
+
+      batch    = [visit]
+      deadline = time.monotonic() + self.max_delay
+      while len(batch) < self.batch_size:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0: break
+
+        try:
+          visit = self.visits.get(timeout=timeout)
+        except queue.Empty:
+          break
+
+        if visit is None:
+          running = False
+          break
+
+        batch.append(visit)
+
+      self.batches.put(batch)
+
+    for no in range(self.workers):
+      self.batches.put(None)
+
+#----------------------------------------------------------------------------
+  def __worker(self):
+    kunjungan = self.kunjungan.worker_copy()
+    kunjungan.testing = self.testing
+    kunjungan.debug   = self.debug
+
+    while True:
+      batch = self.batches.get()
+      if batch is None: break
+
+      self.flush_batch(kunjungan, batch)
+
+#----------------------------------------------------------------------------
+  def flush_batch(self, kunjungan, batch):
+    with tracer.span('batch', {'epus.visits': len(batch)}):
+      self.__flush_batch(kunjungan, batch)
+
+#----------------------------------------------------------------------------
+  def __flush_batch(self, kunjungan, batch):
+    built = []
+    for data, done in batch:
+      try:
+        with tracer.span('visit', {'epus.id_pendaftaran': data.get('id_pendaftaran'), 'epus.emr_no': data.get('emr_no')}):
+          built.append((data, done, kunjungan.build_bundle_entries(data)))
+      except Exception as e:
+        if kunjungan.park_visit(data, None, e):
+          self.finish(done, data, 'parked')
+        else:
+          self.fail(kunjungan, data, None, e, done)
+
+    if kunjungan.testing:
+      for data, done, entries in built:
+        self.finish(done, data, 'ok')
+      return
+
+    if kunjungan.spool is not None and not kunjungan.park_only:
+      for data, done, entries in built:
+        kunjungan.spool.append(data, entries)
+        self.finish(done, data, 'parked')
+      return
+
+    # the tuner cuts the batch into bundles of its size, without one it is one bundle
+    if kunjungan.bundle_tuner and built:
+      groups = [[built[no] for no in group] for group in kunjungan.bundle_tuner.split([entries for data, done, entries in built])]
+    else:
+      groups = [built] if built else []
+
+    for group in groups:
+      self.send_bundle(kunjungan, group)
+
+#----------------------------------------------------------------------------
+  def send_bundle(self, kunjungan, group):
+    try:
+      combined_entries = kunjungan.combine_bundle_entries([entries for data, done, entries in group])
+      response_json    = kunjungan.post_bundle_transaction(combined_entries)
+      kunjungan.register_master_entries(combined_entries, response_json)
+    except Exception as e:
+      if kunjungan.spool is not None and kunjungan.is_transient_error(e):
+        for data, done, entries in group:
+          kunjungan.park_visit(data, entries, e)
+          self.finish(done, data, 'parked')
+        return
+
+      # one bad visit fails the whole transaction, send them one by one instead
+      log_service.warning('batch of %s visits failed, retry per visit: %s', len(group), e)
+      for data, done, entries in group:
+        try:
+          status = kunjungan.json_to_fhir(data)
+        except Exception as e:
+          self.fail(kunjungan, data, kunjungan.visit_entries, e, done)
+          continue
+
+        # 'parked' when the per-visit send found the server unavailable and spooled it
+        self.finish(done, data, status)
+      return
+
+    for data, done, entries in group:
+      self.finish(done, data, 'ok')
+
+#----------------------------------------------------------------------------
+  def fail(self, kunjungan, data, entries, error, done):
+    log_service.error('cannot send %s: %s', data.get('id_pendaftaran'), error)
+    if kunjungan.dead_letter: kunjungan.dead_letter.add(data, entries, error, 'service')
+    self.finish(done, data, 'error', str(error))
+
+#----------------------------------------------------------------------------
+  def finish(self, done, data, status, error=''):
+    if done: done(data, status, error)
+
+
+#============================================================================
+def create_app(service):
+  from flask import Flask, Response, request, stream_with_context
+
+  app = Flask(__name__)
+  kunjungan = service.kunjungan
+
+#----------------------------------------------------------------------------
+  @app.route('/kunjungan', methods=['POST'])
+  def kunjungan_post():
+    request_json = request.get_json(silent=True)
+    if not isinstance(request_json, dict):
+      return {'status': 'error', 'error': 'expected a JSON object'}, 400
+
+    try:
+      data = kunjungan.request_json_to_data(request_json)
+    except KeyError as e:
+      return {'status': 'error', 'error': f'missing field {e}'}, 400
+
+    try:
+      service.submit(data)
+    except queue.Full:
+      metrics.inc('epus_rejected_total')
+      return {'status': 'busy'}, 503
+
+    return {'status': 'accepted', 'id_pendaftaran': data['id_pendaftaran']}, 202
+
+#----------------------------------------------------------------------------
+  @app.route('/kunjungan/bulk', methods=['POST'])
+  def kunjungan_bulk_post():
+    # JSON array or NDJSON body through the same queue and batcher as /kunjungan, answered with
+    # one NDJSON status line per row as it is done, in the order they finish
+    results = queue.Queue()
+
+    def generate():
+      submitted = 0
+      finished  = 0
+      for no, (data, error) in enumerate(kunjungan.iter_request_data(request.stream), 1):
+        if error:
+          yield json.dumps({'no': no, 'id_pendaftaran': '', 'status': 'error', 'error': error}) + '\n'
+          continue
+
+        def done(data, status, error, no=no):
+          results.put({'no': no, 'id_pendaftaran': data['id_pendaftaran'], 'status': status, **({'error': error} if error else {})})
+
+        service.submit(data, done, block=True)
+        submitted += 1
+        while not results.empty():
+          yield json.dumps(results.get_nowait(), default=str) + '\n'
+          finished += 1
+
+      while finished < submitted:
+        yield json.dumps(results.get(), default=str) + '\n'
+        finished += 1
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+#----------------------------------------------------------------------------
+  @app.route('/metrics', methods=['GET'])
+  def metrics_get():
+    return Response(metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+  return app
+
+
+#===========================================================================
+if __name__ == '__main__':
+  setup_logging('INFO')
+  epus_Service_Garut = epus_Ingestion_Service(batch_size=50, max_delay=0.2, workers=4)
+  epus_Service_Garut.start()
+
+  app = create_app(epus_Service_Garut)
+  app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 23:08:44 2026
+
+@author: anwar
+'''
+
+import json
+import os
+import queue
+import re
+import threading
+
+from epus_kunjungan import FHIR_Version_Conflict, epus_Kunjungan
+from epus_dead_letter import epus_Dead_Letter
+from epus_metrics import metrics
+from epus_logging import get_logger, setup_logging
+
+log_spool = get_logger('spool')
+
+re_segment = re.compile(r'^segment-(\d{6})\.ndjson$')
+
+#============================================================================
+class epus_Spool:
+  # append-only segment log of built bundles, one {'seq', 'data', 'entries'} line each, entries is
+  # None for a visit parked before it could be built;
+  # acks.log lists the sent seqs, a segment is deleted once all of it is acknowledged
+
+#----------------------------------------------------------------------------
+  def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync=False):
+    self.directory     = directory
+    self.segment_bytes = segment_bytes
+    self.fsync         = fsync
+    self.condition     = threading.Condition()
+    os.makedirs(directory, exist_ok=True)
+
+    self.acked    = self.read_acks()
+    self.segments = dict()
+    self.next_seq = 1
+    self.pending  = 0
+    for filename in sorted(os.listdir(directory)):
+      rsegment = re_segment.match(filename)
+      if rsegment: self.scan_segment(int(rsegment.group(1)))
+
+    self.current = max(self.segments, default=0)
+    if not self.current or os.path.getsize(self.segment_path(self.current)) >= segment_bytes:
+      self.current += 1
+      self.segments[self.current] = {'first': 0, 'last': 0, 'acked': 0}
+
+    self.output     = open(self.segment_path(self.current), 'ab')
+    self.ack_output = open(self.ack_path(), 'a')
+    for no in list(self.segments):
+      self.compact(no)
+
+    metrics.gauge('epus_spool_pending', self.pending)
+    log_spool.info('spool %s: %s bundles pending', directory, self.pending)
+
+#----------------------------------------------------------------------------
+  def segment_path(self, no):
+    return os.path.join(self.directory, f'segment-{no:06d}.ndjson')
+
+#----------------------------------------------------------------------------
+  def ack_path(self):
+    return os.path.join(self.directory, 'acks.log')
+
+#----------------------------------------------------------------------------
+  def read_acks(self):
+    if not os.path.isfile(self.ack_path()): return set()
+
+    with open(self.ack_path()) as fin:
+      return {int(line) for line in fin if line.strip().isdigit()}
+
+#----------------------------------------------------------------------------
+  def scan_segment(self, no):
+    # a crash can leave half a line at the end, cut it off before appending again
+    path = self.segment_path(no)
+    with open(path, 'rb') as fin:
+      content = fin.read()
+
+    if content and not content.endswith(b'\n'):
+      content = content[:content.rfind(b'\n') + 1]
+      with open(path, 'r+b') as fout:
+        fout.truncate(len(content))
+
+    segment = {'first': 0, 'last': 0, 'acked': 0}
+    for line in content.splitlines():
+      seq = json.loads(line)['seq']
+      if not segment['first']: segment['first'] = seq
+      segment['last'] = seq
+      if seq in self.acked:
+        segment['acked'] += 1
+      else:
+        self.pending += 1
+
+    self.segments[no] = segment
+    self.next_seq     = max(self.next_seq, segment['last'] + 1)
+
+#----------------------------------------------------------------------------
+  def append(self, data, entries):
+    with self.condition:
+      seq  = self.next_seq
+      line = (json.dumps({'seq': seq, 'data': data, 'entries': entries}, default=str) + '\n').encode('utf-8')
+      if self.output.tell() and self.output.tell() + len(line) > self.segment_bytes:
+        self.roll()
+
+      self.output.write(line)
+      self.output.flush()
+      if self.fsync: os.fsync(self.output.fileno())
+
+      segment = self.segments[self.current]
+      if not segment['first']: segment['first'] = seq
+      segment['last'] = seq
+      self.next_seq  += 1
+      self.pending   += 1
+      self.condition.notify_all()
+
+    metrics.inc('epus_spool_appended_total')
+    metrics.inc('epus_spool_bytes_total', len(line))
+    metrics.gauge('epus_spool_pending', self.pending)
+    return seq
+
+#----------------------------------------------------------------------------
+  def roll(self):
+    self.output.close()
+    previous     = self.current
+    self.current += 1
+    self.segments[self.current] = {'first': 0, 'last': 0, 'acked': 0}
+    self.output = open(self.segment_path(self.current), 'ab')
+    self.compact(previous)
+
+#----------------------------------------------------------------------------
+  def ack(self, seq):
+    with self.condition:
+      if seq in self.acked: return
+
+      self.acked.add(seq)
+      self.ack_output.write(f'{seq}\n')
+      self.ack_output.flush()
+      self.pending -= 1
+      for no, segment in self.segments.items():
+        if segment['first'] <= seq <= segment['last']:
+          segment['acked'] += 1
+          self.compact(no)
+          break
+
+      self.condition.notify_all()
+
+    metrics.inc('epus_spool_acked_total')
+    metrics.gauge('epus_spool_pending', self.pending)
+
+#----------------------------------------------------------------------------
+  def compact(self, no):
+    # called with the condition held; drops a finished segment and its acks
+    segment = self.segments[no]
+    if no == self.current or (segment['first'] and segment['acked'] < segment['last'] - segment['first'] + 1): return
+
+    if os.path.isfile(self.segment_path(no)): os.remove(self.segment_path(no))
+    del self.segments[no]
+    self.acked -= set(range(segment['first'], segment['last'] + 1)) if segment['first'] else set()
+
+    with open(self.ack_path() + '.tmp', 'w') as fout:
+      fout.writelines(f'{seq}\n' for seq in sorted(self.acked))
+
+    self.ack_output.close()
+    os.replace(self.ack_path() + '.tmp', self.ack_path())
+    self.ack_output = open(self.ack_path(), 'a')
+    log_spool.info('segment %s compacted', no)
+
+#----------------------------------------------------------------------------
+  def iter_pending(self, stop_event):
+    # the unacknowledged records oldest first, then follows the appends until stop_event
+    with self.condition:
+      no = min(self.segments)
+
+    offset = 0
+    while not stop_event.is_set():
+      try:
+        with open(self.segment_path(no), 'rb') as fin:
+          fin.seek(offset)
+          for line in fin:
+            if not line.endswith(b'\n'): break
+
+            offset += len(line)
+            record  = json.loads(line)
+            if record['seq'] not in self.acked: yield record
+      except FileNotFoundError:
+        pass
+
+      with self.condition:
+        if no != self.current and (no not in self.segments or offset >= os.path.getsize(self.segment_path(no))):
+          no     = min(segment_no for segment_no in self.segments if segment_no > no)
+          offset = 0
+        elif offset >= self.output.tell():
+          self.condition.wait(timeout=1.0)
+
+#----------------------------------------------------------------------------
+  def wait_empty(self, timeout=None):
+    with self.condition:
+      return self.condition.wait_for(lambda: self.pending == 0, timeout)
+
+#----------------------------------------------------------------------------
+  def close(self):
+    with self.condition:
+      self.output.close()
+      self.ack_output.close()
+
+
+#============================================================================
+class epus_Spool_Drain:
+  # sends the spooled bundles on its own threads, a bundle stays in the spool until the server took it
+  # or refused it, a refused one goes to the dead-letter store
+
+#----------------------------------------------------------------------------
+  def __init__(self, spool, kunjungan=None, workers=4, max_backoff=60.0, dead_letter=None):
+    self.spool       = spool
+    self.kunjungan   = kunjungan or epus_Kunjungan()
+    self.dead_letter = dead_letter or self.kunjungan.dead_letter or epus_Dead_Letter(os.path.join(spool.directory, 'dead_letter.sqlite'))
+    self.workers     = workers
+    self.max_backoff = max_backoff
+    self.threads     = []
+    self.stop_event  = threading.Event()
+    self.records     = None
+
+#----------------------------------------------------------------------------
+  def start(self):
+    self.stop_event.clear()
+    self.records = queue.Queue(maxsize=self.workers * 2)
+    dispatcher = threading.Thread(target=self.__dispatcher, name='epus-spool-dispatcher', daemon=True)
+    dispatcher.start()
+    self.threads = [dispatcher]
+
+    for no in range(self.workers):
+      worker = threading.Thread(target=self.__worker, name=f'epus-spool-{no}', daemon=True)
+      worker.start()
+      self.threads.append(worker)
+
+#----------------------------------------------------------------------------
+  def stop(self, wait=True, timeout=None):
+    # wait=True drains what is spooled so far first, the rest is sent after the next start
+    if wait: self.spool.wait_empty(timeout)
+
+    self.stop_event.set()
+    for thread in self.threads:
+      thread.join()
+
+    self.threads = []
+
+#----------------------------------------------------------------------------
+  def __dispatcher(self):
+    for record in self.spool.iter_pending(self.stop_event):
+      while not self.stop_event.is_set():
+        try:
+          self.records.put(record, timeout=0.5)
+          break
+        except queue.Full:
+          continue
+
+    for no in range(self.workers):
+      self.records.put(None)
+
+#----------------------------------------------------------------------------
+  def __worker(self):
+    # failures come back here: a transient one is retried, any other goes to the dead letters
+    kunjungan = self.kunjungan.worker_copy()
+    kunjungan.spool       = None
+    kunjungan.dead_letter = None
+
+    while True:
+      record = self.records.get()
+      if record is None: break
+
+      self.send(kunjungan, record)
+
+#----------------------------------------------------------------------------
+  def post(self, kunjungan, record):
+    if record['entries'] is None:
+      kunjungan.json_to_fhir(record['data'])
+      return
+
+    try:
+      response_json = kunjungan.post_bundle_transaction(record['entries'])
+      kunjungan.register_master_entries(record['entries'], response_json)
+    except FHIR_Version_Conflict:
+      kunjungan.json_to_fhir(record['data'])
+
+#----------------------------------------------------------------------------
+  def send(self, kunjungan, record):
+    backoff = 1.0
+    while True:
+      try:
+        self.post(kunjungan, record)
+      except Exception as e:
+        # server or network trouble is waited out, a bundle the server refuses is not
+        if not kunjungan.is_transient_error(e):
+          self.dead_letter.add(record['data'], record['entries'], e, 'spool')
+          metrics.inc('epus_spool_rejected_total')
+          self.spool.ack(record['seq'])
+          return
+
+        metrics.inc('epus_spool_retries_total')
+        log_spool.warning('bundle %s not sent, retry in %.0fs: %s', record['seq'], backoff, e)
+        if self.stop_event.wait(backoff): return
+        backoff = min(backoff * 2, self.max_backoff)
+        continue
+
+      self.spool.ack(record['seq'])
+      return
+
+
+#===========================================================================
+if __name__ == '__main__':
+  setup_logging('INFO')
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing = False
+  epus_Kunjungan_Garut.debug   = False
+
+  epus_Spool_Garut = epus_Spool('sql_dump/spool/')
+  epus_Kunjungan_Garut.set_spool(epus_Spool_Garut)
+  epus_Drain_Garut = epus_Spool_Drain(epus_Spool_Garut, epus_Kunjungan_Garut, workers=4)
+  epus_Drain_Garut.start()
+
+  epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
+  epus_Drain_Garut.stop(wait=True)
+  epus_Spool_Garut.close()
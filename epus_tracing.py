@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 19:05:14 2026
+
+@author: anwar
+'''
+
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT   = 3
+STATUS_OK          = 1
+STATUS_ERROR       = 2
+
+#============================================================================
+class Span:
+
+#----------------------------------------------------------------------------
+  def __init__(self, trace_id, parent_span_id, name, kind, attributes):
+    self.trace_id       = trace_id
+    self.span_id        = os.urandom(8).hex()
+    self.parent_span_id = parent_span_id
+    self.name           = name
+    self.kind           = kind
+    self.attributes     = dict(attributes or {})
+    self.start_time     = time.time_ns()
+    self.end_time       = 0
+    self.status         = {'code': STATUS_OK}
+
+#----------------------------------------------------------------------------
+  def set(self, key, value):
+    self.attributes[key] = value
+
+#----------------------------------------------------------------------------
+  def set_error(self, message):
+    self.status = {'code': STATUS_ERROR, 'message': message}
+
+#----------------------------------------------------------------------------
+  def otlp_value(self, value):
+    if isinstance(value, bool) : return {'boolValue': value}
+    if isinstance(value, int)  : return {'intValue': str(value)}
+    if isinstance(value, float): return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+#----------------------------------------------------------------------------
+  def to_otlp(self):
+    span_json = {
+      'traceId': self.trace_id,
+      'spanId': self.span_id,
+      'name': self.name,
+      'kind': self.kind,
+      'startTimeUnixNano': str(self.start_time),
+      'endTimeUnixNano': str(self.end_time),
+      'attributes': [{'key': key, 'value': self.otlp_value(value)} for key, value in self.attributes.items() if value is not None],
+      'status': self.status
+    }
+
+    if self.parent_span_id:
+      span_json['parentSpanId'] = self.parent_span_id
+
+    return span_json
+
+
+#============================================================================
+class Null_Span:
+  # handed out when the trace is not sampled, so callers never have to check
+
+#----------------------------------------------------------------------------
+  def set(self, key, value):
+    pass
+
+#----------------------------------------------------------------------------
+  def set_error(self, message):
+    pass
+
+
+null_span = Null_Span()
+
+
+#============================================================================
+class epus_Tracer:
+
+#----------------------------------------------------------------------------
+  def __init__(self):
+    self.local        = threading.local()
+    self.sample_rate  = 0.0
+    self.service_name = 'epus'
+    self.exporter     = None
+
+#----------------------------------------------------------------------------
+  def configure(self, filename, sample_rate=0.01, max_bytes=50 * 1024 * 1024, backup_count=5, service_name='epus'):
+    # one OTLP/JSON ExportTraceServiceRequest per line, the file rotates like a log file
+    self.close()
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+
+    self.exporter = logging.getLogger(f'epus_tracing.{filename}')
+    self.exporter.propagate = False
+    self.exporter.setLevel(logging.INFO)
+    self.exporter.addHandler(handler)
+
+    self.sample_rate  = sample_rate
+    self.service_name = service_name
+
+#----------------------------------------------------------------------------
+  def close(self):
+    if self.exporter is None: return
+
+    for handler in list(self.exporter.handlers):
+      handler.close()
+      self.exporter.removeHandler(handler)
+
+    self.exporter    = None
+    self.sample_rate = 0.0
+
+#----------------------------------------------------------------------------
+  @contextlib.contextmanager
+  def span(self, name, attributes=None, kind=SPAN_KIND_INTERNAL):
+    # the outermost span of a thread starts a trace and decides sampling for everything under it
+    stack = getattr(self.local, 'stack', None)
+    if stack is None:
+      stack = self.local.stack = []
+
+    if stack:
+      parent = stack[-1]
+      if parent is None:
+        span = None
+      else:
+        span = Span(parent.trace_id, parent.span_id, name, kind, attributes)
+    elif self.exporter is not None and random.random() < self.sample_rate:
+      span = Span(os.urandom(16).hex(), '', name, kind, attributes)
+      self.local.spans = []
+    else:
+      span = None
+
+    stack.append(span)
+    try:
+      yield span or null_span
+    except Exception as e:
+      if span: span.set_error(str(e))
+      raise
+    finally:
+      stack.pop()
+      if span:
+        span.end_time = time.time_ns()
+        self.local.spans.append(span)
+        if not stack:
+          self.export(self.local.spans)
+          self.local.spans = []
+
+#----------------------------------------------------------------------------
+  def export(self, spans):
+    exporter = self.exporter
+    if exporter is None: return
+
+    trace_json = {
+      'resourceSpans': [{
+        'resource': {
+          'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]
+        },
+        'scopeSpans': [{
+          'scope': {'name': 'epus_tracing'},
+          'spans': [span.to_otlp() for span in spans]
+        }]
+      }]
+    }
+
+    exporter.info(json.dumps(trace_json))
+
+
+# one tracer per process, off until configure() is called
+tracer = epus_Tracer()
+
+
+#===========================================================================
+if __name__ == '__main__':
+  from epus_kunjungan import epus_Kunjungan
+
+  tracer.configure('sql_dump/20241017/traces.ndjson', sample_rate=1.0)
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing = False
+  epus_Kunjungan_Garut.debug   = False
+  epus_Kunjungan_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv', 3)
+  tracer.close()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Tue Oct 20 00:47:15 2026
+
+@author: anwar
+'''
+
+import json
+import threading
+import time
+
+from epus_metrics import metrics
+from epus_logging import get_logger, setup_logging
+
+log_tuner = get_logger('tuner')
+
+#============================================================================
+class epus_Bundle_Tuner:
+  # entries per transaction bundle, additive increase / multiplicative decrease: every post
+  # answered within grow_below * latency_slo that used at least half the limit adds increase
+  # entries, a post that failed (no answer, 5xx, 408, 413, 429) or took longer than latency_slo
+  # multiplies it by decrease, at most once per latency_slo so a burst of concurrent failures
+  # counts once. A 413 also lowers the byte budget to what the refused bundle had minus 20%
+  transient_statuses = (408, 413, 429)
+
+#----------------------------------------------------------------------------
+  def __init__(self, start_entries=100, min_entries=10, max_entries=2000, max_bytes=4 * 1024 * 1024, latency_slo=5.0, increase=10, decrease=0.5, grow_below=0.5):
+    self.limit       = float(start_entries)
+    self.min_entries = min_entries
+    self.max_entries = max_entries
+    self.max_bytes   = max_bytes
+    self.latency_slo = latency_slo
+    self.increase    = increase
+    self.decrease    = decrease
+    self.grow_below  = grow_below
+    self.lock        = threading.Lock()
+
+    # running averages, what the next visits will probably weigh
+    self.entries_per_visit = 10.0
+    self.bytes_per_entry   = 2048.0
+    self.decreased_at      = 0.0
+
+#----------------------------------------------------------------------------
+  def entries_limit(self):
+    # the AIMD limit, cut further by the byte budget
+    with self.lock:
+      return max(self.min_entries, min(int(self.limit), int(self.max_bytes / self.bytes_per_entry)))
+
+#----------------------------------------------------------------------------
+  def visit_limit(self):
+    return max(1, round(self.entries_limit() / self.entries_per_visit))
+
+#----------------------------------------------------------------------------
+  def split(self, visit_entries_list):
+    # consecutive visits grouped into bundles within the entries limit and the byte budget,
+    # as lists of indexes; a visit heavier than a whole bundle goes alone
+    limit  = self.entries_limit()
+    groups = []
+    group, group_entries, group_bytes = [], 0, 0
+    for no, entries in enumerate(visit_entries_list):
+      visit_bytes = len(json.dumps(entries, default=str))
+      if group and (group_entries + len(entries) > limit or group_bytes + visit_bytes > self.max_bytes):
+        groups.append(group)
+        group, group_entries, group_bytes = [], 0, 0
+
+      group.append(no)
+      group_entries += len(entries)
+      group_bytes   += visit_bytes
+
+    if group: groups.append(group)
+
+    if visit_entries_list:
+      with self.lock:
+        self.entries_per_visit = 0.9 * self.entries_per_visit + 0.1 * sum(len(entries) for entries in visit_entries_list) / len(visit_entries_list)
+
+    return groups
+
+#----------------------------------------------------------------------------
+  def observe(self, entries, bytes_sent, seconds, status=None):
+    # one post_bundle_transaction, status None when it got no answer
+    failed = status is None or status >= 500 or status in self.transient_statuses
+    with self.lock:
+      if bytes_sent and entries:
+        self.bytes_per_entry = 0.9 * self.bytes_per_entry + 0.1 * bytes_sent / entries
+
+      if status == 413 and bytes_sent: self.max_bytes = min(self.max_bytes, int(bytes_sent * 0.8))
+
+      if failed or seconds > self.latency_slo:
+        now = time.monotonic()
+        if now - self.decreased_at >= self.latency_slo:
+          self.decreased_at = now
+          self.limit        = max(self.min_entries, self.limit * self.decrease)
+          metrics.inc('epus_bundle_tuner_decrease_total', reason=(status or 'no_answer') if failed else 'slow')
+          log_tuner.info('%s entries in %.1fs, status %s: limit down to %d', entries, seconds, status, self.limit)
+
+      elif seconds <= self.grow_below * self.latency_slo and entries >= self.limit / 2:
+        self.limit = min(self.max_entries, self.limit + self.increase)
+
+      limit = int(self.limit)
+
+    metrics.gauge('epus_bundle_tuner_entries', limit)
+    metrics.gauge('epus_bundle_tuner_max_bytes', self.max_bytes)
+
+
+#===========================================================================
+if __name__ == '__main__':
+  from epus_kunjungan import epus_Kunjungan
+  from epus_pipeline import epus_Pipeline
+
+  setup_logging('INFO')
+  epus_Kunjungan_Garut = epus_Kunjungan()
+  epus_Kunjungan_Garut.testing = False
+  epus_Kunjungan_Garut.debug   = False
+  epus_Kunjungan_Garut.set_bundle_tuner(epus_Bundle_Tuner(latency_slo=3.0, max_bytes=2 * 1024 * 1024))
+
+  epus_Pipeline_Garut = epus_Pipeline(epus_Kunjungan_Garut, workers={'prefetch': 4, 'send': 4})
+  epus_Pipeline_Garut.collect_from_csv('sql_dump/20241017/', 'P32051501012024_10_17_pelayanan_non_ranap.csv')
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 17:02:37 2026
+
+@author: anwar
+'''
+
+import argparse
+import io
+import random
+from datetime import datetime, timedelta
+
+from epus_kunjungan import decrypt_Excel, epus_Kunjungan
+
+first_names = ['Asep', 'Dede', 'Euis', 'Ujang', 'Neng', 'Cecep', 'Iis', 'Dadang', 'Yayah', 'Ade', 'Rina', 'Budi', 'Siti', 'Agus', 'Dewi', 'Hendra']
+last_names  = ['Saepudin', 'Kurniawan', 'Rahmawati', 'Hidayat', 'Nurjanah', 'Suryana', 'Permana', 'Lestari', 'Mulyana', 'Setiawan', 'Sopandi', 'Komalasari']
+complaints  = ['demam sejak 3 hari', 'batuk pilek', 'pusing dan mual', 'nyeri ulu hati', 'gatal-gatal', 'sakit gigi', 'kontrol tekanan darah', 'diare']
+allergies   = ['Obat: amoxicilin', 'Obat: paracetamol', 'Obat: antalgin', 'Makanan: udang', 'Makanan: telur', 'Makanan: kacang', 'Umum: debu', 'Umum: dingin']
+diagnoses   = [('J06.9', 'Acute upper respiratory infection'), ('I10', 'Essential (primary) hypertension'), ('K30', 'Dyspepsia'), ('A09', 'Diarrhoea and gastroenteritis'), ('K02.9', 'Dental caries'), ('L30.9', 'Dermatitis'), ('E11.9', 'Type 2 diabetes mellitus'), ('M79.1', 'Myalgia')]
+locations   = ['Poli Umum', 'Poli Gigi', 'Poli KIA', 'Poli Lansia', 'Poli MTBS', 'UGD', 'Poli TB', 'Poli Gizi']
+
+# columns a real dump leaves empty now and then; the dates stay filled because collect_from_csv needs them
+optional_columns = ['Keluhan', 'Suhu', 'Denyut_Nadi', 'Nafas', 'Sistolik', 'Diastolik', 'Lingkar_Perut', 'Tinggi_Badan', 'Berat_Badan', 'ICDX_Sekunder', 'Practitioner_ID_Anamnesa']
+
+#============================================================================
+class Dataset_Generator:
+
+#----------------------------------------------------------------------------
+  def __init__(self, rows, patient_ratio=0.3, practitioner_ratio=0.002, location_ratio=0.001, organizations=1, allergy_rate=0.1, missing_rate=0.05, start_date='2024-10-17', seed=1):
+    self.rows          = rows
+    self.patients      = max(1, int(rows * patient_ratio))
+    self.practitioners = max(3, int(rows * practitioner_ratio))
+    self.locations     = max(1, int(rows * location_ratio))
+    self.organizations = max(1, organizations)
+    self.allergy_rate  = allergy_rate
+    self.missing_rate  = missing_rate
+    self.start_date    = datetime.strptime(start_date, '%Y-%m-%d')
+    self.seed          = seed
+
+    self.excel_headers = decrypt_Excel().df_headers
+    self.csv_headers   = epus_Kunjungan.csv_df_headers
+
+#----------------------------------------------------------------------------
+  def name(self, no):
+    return f'{first_names[no % len(first_names)]} {last_names[(no // len(first_names)) % len(last_names)]} {no}'
+
+#----------------------------------------------------------------------------
+  def iter_rows(self):
+    # rows keyed by decrypt_Excel.df_headers, values as python types (datetime, float, str, None)
+    random_generator = random.Random(self.seed)
+    rows_per_day     = max(1, self.rows // 365 + 1)
+    for no in range(self.rows):
+      patient_no         = random_generator.randrange(self.patients)
+      practitioner_nos   = [random_generator.randrange(self.practitioners) for _ in range(3)]
+      location_no        = random_generator.randrange(self.locations)
+      icdx_primer        = random_generator.choice(diagnoses)
+      icdx_sekunder      = random_generator.choice(diagnoses)
+
+      arrived     = self.start_date + timedelta(days=no // rows_per_day, minutes=420 + random_generator.randrange(540))
+      in_progress = arrived + timedelta(minutes=random_generator.randrange(5, 60))
+      finished    = in_progress + timedelta(minutes=random_generator.randrange(5, 30))
+      done        = finished + timedelta(minutes=random_generator.randrange(1, 10))
+
+      alergi = ''
+      if random_generator.random() < self.allergy_rate:
+        alergi = '|'.join(random_generator.sample(allergies, random_generator.randint(1, 3)))
+
+      row = {
+        'ID_Pendaftaran': f'{arrived:%Y%m%d} {no:08d}',
+        'EMR_No': f'P{3205150101 + patient_no:011d}',
+        'Patient_Name': self.name(patient_no),
+        'Payment_Type': random_generator.choice(['BPJS', 'BPJS', 'BPJS', 'UMUM']),
+        'Encounter_Date': arrived,
+        'History_Arrived_start_period': arrived,
+        'History_Arrived_end_period': in_progress,
+        'History_Inprogress_start_period': in_progress,
+        'History_Inprogress_end_period': finished,
+        'History_Finished_start_period': finished,
+        'History_Finished_end_period': done,
+        'Period_Start': arrived,
+        'Period_End': done,
+        'Location_ID': f'LOC {location_no:04d}',
+        'Nama_Location': f'{locations[location_no % len(locations)]} {location_no}',
+        'Practitioner_ID_Anamnesa': f'N{practitioner_nos[0]:010d}',
+        'Nama_Practitioner_Anamnesa': self.name(7919 * practitioner_nos[0]),
+        'Tanggal_Anamnesa': in_progress,
+        'Keluhan': random_generator.choice(complaints),
+        'Alergi': alergi,
+        'Practitioner_ID_Periksa_Fisik': f'N{practitioner_nos[1]:010d}',
+        'Nama_Practitioner_Periksa_Fisik': self.name(7919 * practitioner_nos[1]),
+        'Tanggal_Periksa_Fisik': in_progress,
+        'Suhu': round(random_generator.uniform(35.8, 39.5), 1),
+        'Denyut_Nadi': random_generator.randint(60, 120),
+        'Nafas': random_generator.randint(14, 28),
+        'Sistolik': random_generator.randint(95, 180),
+        'Diastolik': random_generator.randint(60, 110),
+        'Lingkar_Perut': round(random_generator.uniform(60, 120), 1),
+        'Tinggi_Badan': round(random_generator.uniform(140, 185), 1),
+        'Berat_Badan': round(random_generator.uniform(40, 95), 1),
+        'Practitioner_ID_Diagnosis': f'N{practitioner_nos[2]:010d}',
+        'Nama_Practitioner_Diagnosis': self.name(7919 * practitioner_nos[2]),
+        'Tanggal_Diagnosis': finished,
+        'ICDX_Primer': icdx_primer[0],
+        'Nama_ICDX_Primer': icdx_primer[1],
+        'ICDX_Sekunder': icdx_sekunder[0],
+        'Nama_ICDX_Sekunder': icdx_sekunder[1],
+        'Organization_ID': f'{10000100 + (patient_no % self.organizations)}'
+      }
+
+      for column in optional_columns:
+        if random_generator.random() < self.missing_rate:
+          row[column] = None
+          if column == 'ICDX_Sekunder'           : row['Nama_ICDX_Sekunder'] = None
+          if column == 'Practitioner_ID_Anamnesa': row['Nama_Practitioner_Anamnesa'] = None
+
+      yield row
+
+#----------------------------------------------------------------------------
+  def write_csv(self, path):
+    # the dialect collect_from_csv reads: ' quoted text and dates, bare numbers, NULL when missing
+    with open(path, 'w') as fout:
+      fout.write(','.join(f"'{header}'" for header in self.csv_headers) + '\n')
+      for row in self.iter_rows():
+        values = []
+        for header, column in zip(self.csv_headers, self.excel_headers):
+          value = row[column]
+          if value is None or value == '':
+            values.append('NULL')
+          elif header.endswith('DATETIME'):
+            values.append(f"'{value:%Y-%m-%d %H:%M:%S}'")
+          elif header.endswith('TEXT'):
+            values.append("'" + str(value).replace("'", "''") + "'")
+          else:
+            values.append(str(value))
+
+        fout.write(','.join(values) + '\n')
+
+#----------------------------------------------------------------------------
+  def write_excel(self, path, password=decrypt_Excel.passwd, sheet_rows=1000000):
+    # password protected workbook like the ones open_excel_file decrypts; an xlsx sheet
+    # holds 1,048,576 rows so bigger datasets are split over several sheets
+    from openpyxl import Workbook
+    from msoffcrypto.format.ooxml import OOXMLFile
+
+    workbook = Workbook(write_only=True)
+    sheet    = None
+    for no, row in enumerate(self.iter_rows()):
+      if no % sheet_rows == 0:
+        sheet = workbook.create_sheet(f'kunjungan_{no // sheet_rows + 1}')
+        sheet.append(self.excel_headers)
+
+      sheet.append([row[column] for column in self.excel_headers])
+
+    if sheet is None:
+      workbook.create_sheet('kunjungan_1').append(self.excel_headers)
+
+    plain_workbook = io.BytesIO()
+    workbook.save(plain_workbook)
+    plain_workbook.seek(0)
+
+    with open(path, 'wb') as fout:
+      OOXMLFile(plain_workbook).encrypt(password, fout)
+
+
+#===========================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='synthetic pelayanan_non_ranap dumps for scale tests, no real patient data')
+  parser.add_argument('--rows', type=int, default=10000)
+  parser.add_argument('--csv', default='', help='write a collect_from_csv dump to this path')
+  parser.add_argument('--excel', default='', help='write an encrypted collect_from_excel workbook to this path')
+  parser.add_argument('--password', default=decrypt_Excel.passwd)
+  parser.add_argument('--patient-ratio', type=float, default=0.3, help='distinct patients per row')
+  parser.add_argument('--practitioner-ratio', type=float, default=0.002, help='distinct practitioners per row')
+  parser.add_argument('--location-ratio', type=float, default=0.001, help='distinct locations per row')
+  parser.add_argument('--organizations', type=int, default=1)
+  parser.add_argument('--allergy-rate', type=float, default=0.1, help='fraction of visits with an allergy list')
+  parser.add_argument('--missing-rate', type=float, default=0.05, help='chance each optional column is empty')
+  parser.add_argument('--sheet-rows', type=int, default=1000000)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  generator = Dataset_Generator(args.rows, args.patient_ratio, args.practitioner_ratio, args.location_ratio, args.organizations, args.allergy_rate, args.missing_rate, seed=args.seed)
+  if args.csv:
+    generator.write_csv(args.csv)
+    print(f'[info]: {args.rows} rows written to {args.csv}')
+
+  if args.excel:
+    generator.write_excel(args.excel, args.password, args.sheet_rows)
+    print(f'[info]: {args.rows} rows written to {args.excel}')
@@ -11,6 +11,8 @@ import re
 import sys
 import json
 
+re_token_line = re.compile(r'^(\S+)$')
+
 class FHIR_Base:
   KEYCLOAK_URL = ''
   REALM_NAME = ''
@@ -27,6 +29,7 @@ class FHIR_Base:
     self.method         = 'PUT'
     self.token_filename = 'token.key'
     self.base_url       = self.FHIR_BASE_URL
+    self.mirror         = None
     self.read_bearer_token()
     if not self.bearer_token: self.read_bearer_token()
 
@@ -38,9 +41,9 @@ class FHIR_Base:
     if os.path.isfile(self.token_filename):
       fin = open(self.token_filename)
       for line in fin.readlines():
-        rline = re.search('^#', line)
-        if rline: continue
-        self.bearer_token = re.findall("^(\S+)$", line)[0]
+        if line.startswith('#'): continue
+        rline = re_token_line.match(line)
+        if rline: self.bearer_token = rline.group(1)
       
       fin.close()
 
@@ -80,16 +83,21 @@ class FHIR_Base:
 
 #-----------------------------------------------------------------------------
   def fullUrl_to_reference(self, fullUrl):
-    rreference = re.search('^'+ self.base_url +'(.+)$', fullUrl)
-    if rreference:
-      return rreference.group(1)
+    if self.base_url and len(fullUrl) > len(self.base_url) and fullUrl.startswith(self.base_url):
+      return fullUrl[len(self.base_url):]
       
     return fullUrl
     
 #-----------------------------------------------------------------------------
-  def get_resource_by_identifier(self, resource_type, identifier):
+  def get_resource_by_identifier(self, resource_type, identifier, projection=None):
+    # projection: {'_elements': 'identifier'} for the reference only, {'_summary': 'count'} to test existence
+    if self.mirror and not projection:
+      result = self.mirror.get_resource_by_identifier(resource_type, identifier)
+      if result is not None: return result
+
     params = {
-        'identifier': identifier
+        'identifier': identifier,
+        **(projection or {})
     }
   
     url      = self.base_url + resource_type
@@ -103,6 +111,9 @@ class FHIR_Base:
       raise Exception(f'Error: {response.status_code} - {response.text}')
   
     response_json = response.json()
+    if 'entry' not in response_json and response_json.get('total'):
+      return {'total': response_json['total']}, ''
+
   #  if response_json['total'] > 1:
   #    raise Exception(f'Error: we found more than one {resource_type} with identifier {identifier}')
   
@@ -116,6 +127,10 @@ class FHIR_Base:
     
 #-----------------------------------------------------------------------------
   def get_resource_by_reference(self, reference):
+    if self.mirror:
+      resource = self.mirror.get_resource_by_reference(reference)
+      if resource is not None: return resource
+
     url = f"{self.base_url}{reference}"
     response = requests.get(url, headers=self.headers)
 
@@ -136,6 +151,16 @@ if __name__ == '__main__':
   resource_type = ''
   identifier    = ''
   reference     = ''
+  mirror_filename = ''
+  projection      = None
+  if len(sys.argv) > 2 and sys.argv[1] == '--mirror':
+    mirror_filename = sys.argv[2]
+    sys.argv = sys.argv[:1] + sys.argv[3:]
+
+  if len(sys.argv) > 1 and sys.argv[1] in ('--id', '--count'):
+    projection = {'_elements': 'identifier'} if sys.argv[1] == '--id' else {'_summary': 'count'}
+    sys.argv   = sys.argv[:1] + sys.argv[2:]
+
   if len(sys.argv) > 1:
     resource_type = sys.argv[1]
     if len(sys.argv) > 2:
@@ -144,17 +169,25 @@ if __name__ == '__main__':
       reference = resource_type
   else:
     print('ERROR: need parameter!')
-    print('cmd: get_resource.py <Patient> <identifier>')
-    print('     get_resource.py <reference>')
+    print('cmd: get_resource.py [--mirror <mirror.sqlite>] [--id|--count] <Patient> <identifier>')
+    print('     get_resource.py [--mirror <mirror.sqlite>] <reference>')
     print('eq: get_resource.py Patient PAS20146165')
     print('    get_resource.py Patient/e2c28481-a56a-45cf-be07-82ab269cef39')
     exit(0)
 
   epus_Resource_Garut = FHIR_Base()
+  if mirror_filename:
+    from epus_mirror import epus_Mirror
+    # a one-shot lookup, sync the type here instead of in the background
+    epus_Resource_Garut.mirror = epus_Mirror(epus_Resource_Garut, mirror_filename, auto_sync=False)
+    mirror_type = resource_type.split('/')[0]
+    if mirror_type in epus_Resource_Garut.mirror.resource_types and not epus_Resource_Garut.mirror.is_fresh(mirror_type):
+      epus_Resource_Garut.mirror.sync(mirror_type)
+
   response = ''
   if reference:
     response = epus_Resource_Garut.get_resource_by_reference(reference)
   else:
-    response, reference = epus_Resource_Garut.get_resource_by_identifier(resource_type, identifier)
+    response, reference = epus_Resource_Garut.get_resource_by_identifier(resource_type, identifier, projection)
 
   print(json.dumps(response, indent=2))
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Created on Mon Oct 19 15:05:48 2026
+
+@author: anwar
+'''
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+#============================================================================
+class Mock_FHIR_Store:
+
+#----------------------------------------------------------------------------
+  def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, unauthorized_rate=0.0, error_status=500):
+    self.latency           = latency
+    self.jitter            = jitter
+    self.error_rate        = error_rate
+    self.error_status      = error_status
+    self.unauthorized_rate = unauthorized_rate
+    self.lock              = threading.Lock()
+    self.reset()
+
+#----------------------------------------------------------------------------
+  def reset(self):
+    with self.lock:
+      self.resources    = dict()
+      self.identifiers  = dict()
+      self.tokens       = set()
+      self.token_count  = 0
+      self.imports      = dict()
+      self.stats        = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0, 'by_type': {}, 'by_status': {}}
+
+#----------------------------------------------------------------------------
+  def count(self, request_type, status, bytes_received, bytes_sent):
+    with self.lock:
+      self.stats['requests']       += 1
+      self.stats['bytes_received'] += bytes_received
+      self.stats['bytes_sent']     += bytes_sent
+      self.stats['by_type'][request_type] = self.stats['by_type'].get(request_type, 0) + 1
+      self.stats['by_status'][str(status)] = self.stats['by_status'].get(str(status), 0) + 1
+
+#----------------------------------------------------------------------------
+  def issue_token(self):
+    with self.lock:
+      self.token_count += 1
+      token = f'mock-token-{self.token_count}'
+      self.tokens.add(token)
+
+    return token
+
+#----------------------------------------------------------------------------
+  def check_token(self, authorization):
+    with self.lock:
+      if self.unauthorized_rate and random.random() < self.unauthorized_rate:
+        # simulate an expired token, every client has to refresh
+        self.tokens = set()
+
+      return authorization.startswith('Bearer ') and authorization[7:] in self.tokens
+
+#----------------------------------------------------------------------------
+  def search(self, resource_type, identifier, query=None):
+    # _summary=count answers the total only, _elements keeps id, meta and the listed elements
+    query = query or {}
+    with self.lock:
+      resource_id = self.identifiers.get((resource_type, identifier))
+      if resource_id is None and '|' in identifier:
+        resource_id = self.identifiers.get((resource_type, identifier.split('|', 1)[1]))
+
+      resource = self.resources.get((resource_type, resource_id))
+
+    bundle_json = {
+      'resourceType': 'Bundle',
+      'type': 'searchset',
+      'total': 1 if resource else 0
+    }
+
+    if resource and query.get('_summary', [''])[0] != 'count':
+      if '_elements' in query:
+        elements = set(query['_elements'][0].split(',')) | {'resourceType', 'id', 'meta'}
+        resource = {key: value for key, value in resource.items() if key in elements}
+
+      bundle_json['entry'] = [{
+        'fullUrl': f'{self.base_url}{resource_type}/{resource_id}',
+        'resource': resource
+      }]
+
+    return bundle_json
+
+#----------------------------------------------------------------------------
+  def search_updated(self, resource_type, query):
+    # _lastUpdated=ge<instant>, oldest first, paged by _count/_offset with a next link
+    since  = query.get('_lastUpdated', [''])[0]
+    count  = int(query.get('_count', ['100'])[0])
+    offset = int(query.get('_offset', ['0'])[0])
+    if since[:2] in ('ge', 'gt'): since = since[2:]
+
+    with self.lock:
+      resources = sorted((resource for (stored_type, resource_id), resource in self.resources.items() if stored_type == resource_type and resource['meta']['lastUpdated'] >= since), key=lambda resource: resource['meta']['lastUpdated'])
+
+    bundle_json = {
+      'resourceType': 'Bundle',
+      'type': 'searchset',
+      'total': len(resources),
+      'entry': [{'fullUrl': f'{self.base_url}{resource_type}/{resource["id"]}', 'resource': resource} for resource in resources[offset:offset + count]]
+    }
+
+    if offset + count < len(resources):
+      bundle_json['link'] = [{'relation': 'next', 'url': f'{self.base_url}{resource_type}?{urlencode({"_lastUpdated": f"ge{since}", "_count": count, "_offset": offset + count})}'}]
+
+    return bundle_json
+
+#----------------------------------------------------------------------------
+  def read(self, resource_type, resource_id):
+    with self.lock:
+      return self.resources.get((resource_type, resource_id))
+
+#----------------------------------------------------------------------------
+  def conditional_id(self, resource_type, url):
+    query = parse_qs(urlsplit(url).query)
+    if 'identifier' not in query:
+      return str(uuid.uuid4())
+
+    identifier = query['identifier'][0]
+    with self.lock:
+      return self.identifiers.get((resource_type, identifier)) or str(uuid.uuid4())
+
+#----------------------------------------------------------------------------
+  def put(self, resource_type, resource_id, resource):
+    with self.lock:
+      previous   = self.resources.get((resource_type, resource_id))
+      version_id = int(previous['meta']['versionId']) + 1 if previous else 1
+
+      resource['id']   = resource_id
+      resource['meta'] = {
+        'versionId': str(version_id),
+        'lastUpdated': datetime.now(timezone.utc).isoformat()
+      }
+      self.resources[(resource_type, resource_id)] = resource
+
+      for identifier in resource.get('identifier', []):
+        self.identifiers[(resource_type, identifier.get('value'))] = resource_id
+        self.identifiers[(resource_type, f'{identifier.get("system")}|{identifier.get("value")}')] = resource_id
+
+    return {
+      'status': '200 OK' if previous else '201 Created',
+      'location': f'{resource_type}/{resource_id}/_history/{version_id}',
+      'etag': f'W/"{version_id}"'
+    }
+
+#----------------------------------------------------------------------------
+  def start_import(self, parameters_json):
+    # $import kick-off: the input files are downloaded and stored on a thread of their own
+    inputs = []
+    for parameter in parameters_json.get('parameter', []):
+      if parameter.get('name') != 'input': continue
+
+      parts = {part['name']: part.get('valueCode') or part.get('valueUri') for part in parameter.get('part', [])}
+      inputs.append((parts.get('type', ''), parts.get('url', '')))
+
+    with self.lock:
+      job_id = str(len(self.imports) + 1)
+      self.imports[job_id] = {'done': False, 'polls': 0, 'output': [], 'error': []}
+
+    thread = threading.Thread(target=self.run_import, args=(job_id, inputs), name=f'mock-import-{job_id}', daemon=True)
+    thread.start()
+
+    return job_id
+
+#----------------------------------------------------------------------------
+  def run_import(self, job_id, inputs):
+    job = self.imports[job_id]
+    for resource_type, url in inputs:
+      try:
+        with urllib.request.urlopen(url) as response:
+          lines = response.read().decode('utf-8').splitlines()
+
+        count = 0
+        for line in lines:
+          if not line.strip(): continue
+
+          resource = json.loads(line)
+          self.put(resource['resourceType'], resource['id'], resource)
+          count += 1
+
+        job['output'].append({'type': resource_type, 'url': url, 'count': count})
+      except Exception as e:
+        job['error'].append({'type': 'OperationOutcome', 'url': url, 'diagnostics': str(e)})
+
+    job['done'] = True
+
+#----------------------------------------------------------------------------
+  def import_status(self, job_id):
+    # (status, manifest); the first poll always finds the job still running, like a queued one
+    with self.lock:
+      job = self.imports.get(job_id)
+      if job is None: return 404, None
+
+      job['polls'] += 1
+      if not job['done'] or job['polls'] == 1: return 202, None
+
+    return 200, {
+      'transactionTime': datetime.now(timezone.utc).isoformat(),
+      'request': f'{self.base_url}$import',
+      'requiresAccessToken': False,
+      'output': job['output'],
+      'error': job['error']
+    }
+
+#----------------------------------------------------------------------------
+  def rewrite_references(self, element, references):
+    if isinstance(element, dict):
+      for key, value in element.items():
+        if key == 'reference' and isinstance(value, str):
+          element[key] = references.get(value, value)
+        else:
+          self.rewrite_references(value, references)
+
+    elif isinstance(element, list):
+      for item in element:
+        self.rewrite_references(item, references)
+
+#----------------------------------------------------------------------------
+  def process_bundle(self, bundle_json):
+    entries = bundle_json.get('entry', [])
+
+    # like a real server, placeholders in fullUrl resolve to the ids the writes end up with
+    targets     = []
+    references  = dict()
+    conditional = dict()
+    for entry in entries:
+      request = entry.get('request', {})
+      target  = None
+      if request.get('method') in ('PUT', 'POST') and 'resource' in entry:
+        resource_type = entry['resource']['resourceType']
+        url           = request.get('url', resource_type)
+        if '?' in url:
+          if url not in conditional:
+            conditional[url] = self.conditional_id(resource_type, url)
+          target = (resource_type, conditional[url])
+        elif '/' in url:
+          target = (resource_type, url.split('/')[1])
+        else:
+          target = (resource_type, str(uuid.uuid4()))
+
+        if entry.get('fullUrl'):
+          references[entry['fullUrl']] = f'{target[0]}/{target[1]}'
+
+      targets.append(target)
+
+    # If-Match has to name the current version, or the whole transaction fails
+    for entry, target in zip(entries, targets):
+      if_match = entry.get('request', {}).get('ifMatch')
+      if not target or not if_match: continue
+
+      with self.lock:
+        current = self.resources.get(target)
+
+      if not current or f'W/"{current["meta"]["versionId"]}"' != if_match:
+        return 412, {'resourceType': 'OperationOutcome', 'issue': [{'severity': 'error', 'code': 'conflict', 'diagnostics': f'{target[0]}/{target[1]} is not at version {if_match}'}]}
+
+    response_entries = []
+    for entry, target in zip(entries, targets):
+      request = entry.get('request', {})
+      if target:
+        resource = json.loads(json.dumps(entry['resource']))
+        self.rewrite_references(resource, references)
+        response_entries.append({'response': self.put(target[0], target[1], resource)})
+        continue
+
+      url = urlsplit(request.get('url', ''))
+      if request.get('method') == 'GET' and url.query:
+        query = parse_qs(url.query)
+        response_entries.append({
+          'resource': self.search(url.path, query.get('identifier', [''])[0], query),
+          'response': {'status': '200 OK'}
+        })
+      elif request.get('method') == 'GET':
+        resource_type, resource_id = (url.path.split('/') + [''])[:2]
+        resource = self.read(resource_type, resource_id)
+        if resource:
+          response_entries.append({'resource': resource, 'response': {'status': '200 OK'}})
+        else:
+          response_entries.append({'response': {'status': '404 Not Found'}})
+      else:
+        response_entries.append({'response': {'status': '400 Bad Request'}})
+
+    return 200, {
+      'resourceType': 'Bundle',
+      'type': f'{bundle_json.get("type", "transaction")}-response',
+      'entry': response_entries
+    }
+
+
+#============================================================================
+class Mock_FHIR_Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+#----------------------------------------------------------------------------
+  def log_message(self, format, *args):
+    pass
+
+#----------------------------------------------------------------------------
+  def send_json(self, status, body, request_type, bytes_received=0, headers=None):
+    payload = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/fhir+json')
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+    if not request_type.startswith('mock'):
+      self.server.store.count(request_type, status, bytes_received, len(payload))
+
+#----------------------------------------------------------------------------
+  def read_body(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    return self.rfile.read(length) if length else b''
+
+#----------------------------------------------------------------------------
+  def operation_outcome(self, diagnostics, severity='error', code='exception'):
+    return {
+      'resourceType': 'OperationOutcome',
+      'issue': [{'severity': severity, 'code': code, 'diagnostics': diagnostics}]
+    }
+
+#----------------------------------------------------------------------------
+  def simulate(self, request_type, bytes_received):
+    # latency, injected errors and token expiry; returns False when the request is already answered
+    store = self.server.store
+    if store.latency or store.jitter:
+      time.sleep(store.latency + random.uniform(0, store.jitter))
+
+    if not store.check_token(self.headers.get('Authorization', '')):
+      self.send_json(401, self.operation_outcome('invalid or expired token'), request_type, bytes_received)
+      return False
+
+    if store.error_rate and random.random() < store.error_rate:
+      self.send_json(store.error_status, self.operation_outcome('injected error'), request_type, bytes_received)
+      return False
+
+    return True
+
+#----------------------------------------------------------------------------
+  def do_GET(self):
+    store = self.server.store
+    url   = urlsplit(self.path)
+    if url.path == '/_mock/stats':
+      with store.lock:
+        self.send_json(200, store.stats, 'mock')
+      return
+
+    if not url.path.startswith('/fhir/'):
+      self.send_json(404, self.operation_outcome('not found'), 'GET other')
+      return
+
+    parts = url.path[len('/fhir/'):].split('/')
+    if parts[0] == '$import-status':
+      if not self.simulate('GET $import-status', 0): return
+      status, manifest = store.import_status(parts[1] if len(parts) > 1 else '')
+      if status == 202:
+        self.send_json(202, {}, 'GET $import-status', headers={'X-Progress': 'in progress'})
+      elif status == 200:
+        self.send_json(200, manifest, 'GET $import-status')
+      else:
+        self.send_json(404, self.operation_outcome('unknown import job'), 'GET $import-status')
+      return
+
+    if url.query:
+      if not self.simulate('GET search', 0): return
+      query = parse_qs(url.query)
+      if 'identifier' not in query:
+        self.send_json(200, store.search_updated(parts[0], query), 'GET search')
+        return
+
+      self.send_json(200, store.search(parts[0], query.get('identifier', [''])[0], query), 'GET search')
+      return
+
+    if not self.simulate('GET read', 0): return
+    resource = store.read(parts[0], parts[1] if len(parts) > 1 else '')
+    if resource:
+      self.send_json(200, resource, 'GET read')
+    else:
+      self.send_json(404, self.operation_outcome('resource not found'), 'GET read')
+
+#----------------------------------------------------------------------------
+  def do_POST(self):
+    store = self.server.store
+    body  = self.read_body()
+    url   = urlsplit(self.path)
+    if url.path == '/_mock/reset':
+      store.reset()
+      self.send_json(200, {}, 'mock')
+      return
+
+    if url.path.endswith('/protocol/openid-connect/token'):
+      store.count('POST token', 200, len(body), 0)
+      self.send_json(200, {'access_token': store.issue_token(), 'token_type': 'Bearer'}, 'mock')
+      return
+
+    if url.path == '/fhir/$import':
+      if not self.simulate('POST $import', len(body)): return
+      job_id = store.start_import(json.loads(body or b'{}'))
+      self.send_json(202, self.operation_outcome(f'import {job_id} accepted', 'information', 'informational'), 'POST $import', len(body), {'Content-Location': f'{store.base_url}$import-status/{job_id}'})
+      return
+
+    if url.path not in ('/fhir', '/fhir/'):
+      self.send_json(404, self.operation_outcome('not found'), 'POST other', len(body))
+      return
+
+    bundle_json  = json.loads(body or b'{}')
+    request_type = f'POST {bundle_json.get("type", "bundle")}'
+    if not self.simulate(request_type, len(body)): return
+
+    status, response_json = store.process_bundle(bundle_json)
+    self.send_json(status, response_json, request_type, len(body))
+
+
+#============================================================================
+def start_mock_server(host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, unauthorized_rate=0.0, error_status=500):
+  store  = Mock_FHIR_Store(latency, jitter, error_rate, unauthorized_rate, error_status)
+  server = ThreadingHTTPServer((host, port), Mock_FHIR_Handler)
+  server.daemon_threads = True
+  server.store          = store
+  store.base_url        = f'http://{host}:{server.server_address[1]}/fhir/'
+
+  thread = threading.Thread(target=server.serve_forever, name='mock-fhir', daemon=True)
+  thread.start()
+
+  return server
+
+
+#===========================================================================
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='local stand-in for the FHIR server and the Keycloak token endpoint')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every FHIR request')
+  parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds, 0..jitter')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of FHIR requests answered with --error-status')
+  parser.add_argument('--error-status', type=int, default=500, help='HTTP status of the injected errors, e.g. 503')
+  parser.add_argument('--unauthorized-rate', type=float, default=0.0, help='fraction of FHIR requests that expire every token (401)')
+  args = parser.parse_args()
+
+  mock_server = start_mock_server(args.host, args.port, args.latency, args.jitter, args.error_rate, args.unauthorized_rate, args.error_status)
+  print(f'[info]: mock FHIR on {mock_server.store.base_url}, token endpoint on http://{args.host}:{args.port}/realms/<realm>/protocol/openid-connect/token')
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    mock_server.shutdown()